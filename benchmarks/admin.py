@@ -0,0 +1,121 @@
+"""Benchmark of the App admin actions.
+
+Compare the legacy bump (one UPDATE, then one cache EXISTS and DELETE per app)
+and the legacy metrics toggle (one `save` per app) with the set based
+:meth:`bump_sample_rate <controller.sentry.admin.AppAdmin.bump_sample_rate>` and
+:meth:`enable_disable_metrics <controller.sentry.admin.AppAdmin.enable_disable_metrics>`,
+which run a single UPDATE and store all the configs at once, over 10k apps.
+The legacy bump only drops the configs, the next request of each app rebuilds its own.
+
+It runs against a test database created from the configured one, and the configured cache.
+
+Usage::
+
+    TESTING=true python -m benchmarks.admin
+"""
+import os
+from datetime import timedelta
+from time import perf_counter
+from typing import Callable
+
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "controller.settings")
+django.setup()
+
+# pylint: disable=wrong-import-position
+from django.core.cache import cache  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from controller.sentry.choices import MetricType  # noqa: E402
+from controller.sentry.configs import app_config_key, store_app_configs  # noqa: E402
+from controller.sentry.models import App  # noqa: E402
+
+# Number of benchmarked apps
+APP_COUNT = 10000
+
+
+def legacy_bump(apps: "django.db.models.QuerySet[App]") -> None:
+    """Legacy bump, invalidating the cache of each app.
+
+    Args:
+        apps (QuerySet[App]): The apps
+    """
+    apps.update(active_sample_rate=0.5, active_window_end=timezone.now() + timedelta(minutes=30))
+    for app in apps:
+        key = app_config_key(app.reference)
+        if cache.has_key(key):
+            cache.delete(key)
+
+
+def bump(apps: "django.db.models.QuerySet[App]") -> None:
+    """Set based bump, as done by the admin action.
+
+    Args:
+        apps (QuerySet[App]): The apps
+    """
+    apps.update(active_sample_rate=0.5, active_window_end=timezone.now() + timedelta(minutes=30))
+    store_app_configs(apps)
+
+
+def legacy_metrics(apps: "django.db.models.QuerySet[App]") -> None:
+    """Legacy metrics toggle, saving each app.
+
+    Args:
+        apps (QuerySet[App]): The apps
+    """
+    for app in apps:
+        for metric in MetricType:
+            app.set_metric(metric, True)
+        app.save()
+    store_app_configs(apps)
+
+
+def metrics(apps: "django.db.models.QuerySet[App]") -> None:
+    """Set based metrics toggle, as done by the admin action.
+
+    Args:
+        apps (QuerySet[App]): The apps
+    """
+    apps.update(**{App.metric_field(metric): True for metric in MetricType})
+    store_app_configs(apps)
+
+
+def measure(func: Callable[["django.db.models.QuerySet[App]"], None]) -> float:
+    """Run an action over all the apps.
+
+    Args:
+        func (Callable[[QuerySet[App]], None]): The action
+
+    Returns:
+        float: The duration in seconds
+    """
+    store_app_configs(App.objects.all())
+    start = perf_counter()
+    func(App.objects.all())
+    return perf_counter() - start
+
+
+def main() -> None:
+    """Run the benchmark."""
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        App.objects.bulk_create(
+            [
+                App(reference=f"{i}_env_command", wsgi_metrics={"path": {f"/{path}": path for path in range(50)}})
+                for i in range(APP_COUNT)
+            ]
+        )
+        print(f"{'action':<10}{'legacy':>10}{'set based':>12}{'speedup':>10}")
+        for name, legacy, optimized in (("bump", legacy_bump, bump), ("metrics", legacy_metrics, metrics)):
+            legacy_time = measure(legacy)
+            optimized_time = measure(optimized)
+            print(f"{name:<10}{legacy_time:>9.2f}s{optimized_time:>11.2f}s{legacy_time / optimized_time:>9.1f}x")
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
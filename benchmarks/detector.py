@@ -0,0 +1,94 @@
+"""Benchmark of the spike detection.
+
+Compare the legacy :class:`SpikesDetector.compute <controller.sentry.detector.SpikesDetector.compute>`,
+which computes `statistics.mean` and `statistics.stdev` over the whole window at each step,
+with the incremental one and the NumPy batch one, over 30 and 90 days of hourly stats.
+
+Usage::
+
+    python -m benchmarks.detector
+"""
+import random
+from copy import copy
+from statistics import mean, stdev
+from timeit import timeit
+
+from controller.sentry.detector import SpikesDetector
+
+# Hours of the benchmarked periods
+PERIODS = {"30d": 30 * 24, "90d": 90 * 24}
+# Number of series of the batch run
+BATCH_SIZE = 100
+
+
+def legacy_compute(detector: SpikesDetector, data: list[float]) -> tuple[list[int], list[float], list[float]]:
+    """Legacy implementation of :meth:`SpikesDetector.compute`.
+
+    Args:
+        detector (SpikesDetector): The detector
+        data (list[float]): data
+
+    Returns:
+        list[int]: Signal
+        list[float]: avg filter
+        list[float]: std filter
+    """
+    signals = [0] * detector.lag
+    avg_filter = [0] * detector.lag
+    std_filter = [0] * detector.lag
+    filtered_data = copy(data)
+    avg_filter[detector.lag - 1] = mean(data[: detector.lag])
+    std_filter[detector.lag - 1] = stdev(data[: detector.lag])
+
+    for i, item in enumerate(data[detector.lag :], start=detector.lag):
+        threshold = max(detector.floor, avg_filter[i - 1] + detector.threshold * std_filter[i - 1])
+        if item > threshold:
+            signals.append(1 if item > avg_filter[i - 1] else 0)
+            filtered_data[i] = detector.influence * item + (1 - detector.influence) * filtered_data[i - 1]
+        else:
+            signals.append(0)
+            filtered_data[i] = data[i]
+        avg_filter.append(mean(filtered_data[(i - detector.lag) : i]))
+        std_filter.append(stdev(filtered_data[(i - detector.lag) : i]))
+
+    return signals, avg_filter, std_filter
+
+
+def generate_series(length: int, seed: int = 0) -> list[int]:
+    """Generate hourly transaction counts with a daily cycle and a few spikes.
+
+    Args:
+        length (int): Number of hours
+        seed (int): Random seed
+
+    Returns:
+        list[int]: The series
+    """
+    rng = random.Random(seed)
+    series = [int(1000 + 500 * ((hour % 24) / 24) + rng.gauss(0, 50)) for hour in range(length)]
+    for _ in range(length // 200):
+        start = rng.randrange(length)
+        for hour in range(start, min(start + rng.randint(1, 6), length)):
+            series[hour] *= rng.randint(5, 20)
+    return series
+
+
+def main() -> None:
+    """Run the benchmark."""
+    detector = SpikesDetector(lag=48, threshold=5, influence=0.01)
+    print(f"{'period':<8}{'legacy':>12}{'incremental':>14}{'speedup':>10}{'batch/series':>16}")
+    for period, length in PERIODS.items():
+        series = generate_series(length)
+        batch = [generate_series(length, seed) for seed in range(BATCH_SIZE)]
+        number = 5
+        legacy = timeit(lambda series=series: legacy_compute(detector, series), number=number) / number
+        incremental = timeit(lambda series=series: detector.compute(series), number=number) / number
+        batched = timeit(lambda batch=batch: detector.compute_many(batch), number=number) / number / BATCH_SIZE
+        print(
+            f"{period:<8}{legacy * 1000:>10.2f}ms{incremental * 1000:>12.2f}ms"
+            f"{legacy / incremental:>9.0f}x{batched * 1000:>14.3f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
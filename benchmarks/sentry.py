@@ -0,0 +1,101 @@
+"""Benchmark of the decoding of Sentry API pages.
+
+Compare decoding a page of projects with `requests` (the standard `json` module)
+with :func:`decode_json <controller.sentry.webservices.sentry.decode_json>` keeping only `id` and `slug`,
+as :func:`pull_sentry_project_slug <controller.sentry.tasks.pull_sentry_project_slug>` does.
+The peak memory is the memory allocated while decoding one page.
+
+Usage::
+
+    python -m benchmarks.sentry
+"""
+import json
+import random
+import tracemalloc
+from timeit import timeit
+from typing import Callable
+
+from controller.sentry.webservices.sentry import decode_json, orjson
+
+# Number of projects of each benchmarked page
+PAGE_SIZES = (100, 1000, 10000)
+FIELDS = ("id", "slug")
+
+
+def generate_projects(count: int, seed: int = 0) -> bytes:
+    """Generate a page of projects, shaped like the Sentry `projects/` endpoint.
+
+    Args:
+        count (int): Number of projects
+        seed (int): Random seed
+
+    Returns:
+        bytes: The JSON body
+    """
+    rng = random.Random(seed)
+    projects = []
+    for i in range(count):
+        slug = f"project-{i}-{rng.randrange(10**6)}"
+        projects.append(
+            {
+                "id": str(i),
+                "slug": slug,
+                "name": slug.replace("-", " ").title(),
+                "platform": rng.choice(["python", "javascript", "go"]),
+                "dateCreated": "2023-02-01T17:00:00.000000Z",
+                "isBookmarked": False,
+                "isMember": True,
+                "hasAccess": True,
+                "features": [f"feature-{feature}" for feature in range(rng.randint(10, 30))],
+                "firstEvent": "2023-02-01T17:00:00.000000Z",
+                "firstTransactionEvent": True,
+                "access": ["project:read", "project:write", "event:read", "event:write"],
+                "teams": [{"id": str(team), "slug": f"team-{team}", "name": f"Team {team}"} for team in range(3)],
+                "avatar": {"avatarType": "letter_avatar", "avatarUuid": None},
+                "organization": {
+                    "id": "1",
+                    "slug": "organization",
+                    "name": "Organization",
+                    "features": [f"org-feature-{feature}" for feature in range(50)],
+                    "avatar": {"avatarType": "letter_avatar", "avatarUuid": None},
+                },
+            }
+        )
+    return json.dumps(projects).encode()
+
+
+def peak_memory(decode: Callable[[], object]) -> int:
+    """Measure the peak memory allocated by a decoding.
+
+    Args:
+        decode (Callable[[], object]): The decoding
+
+    Returns:
+        int: The peak memory, in bytes
+    """
+    tracemalloc.start()
+    decode()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main() -> None:
+    """Run the benchmark."""
+    print(f"orjson: {'installed' if orjson is not None else 'missing'}")
+    print(f"{'projects':<10}{'json':>10}{'selected':>12}{'speedup':>10}{'json peak':>12}{'selected peak':>16}")
+    for size in PAGE_SIZES:
+        content = generate_projects(size)
+        number = max(1, 1000 // size)
+        full = timeit(lambda content=content: json.loads(content), number=number) / number
+        selected = timeit(lambda content=content: decode_json(content, FIELDS), number=number) / number
+        full_peak = peak_memory(lambda content=content: json.loads(content))
+        selected_peak = peak_memory(lambda content=content: decode_json(content, FIELDS))
+        print(
+            f"{size:<10}{full * 1000:>8.2f}ms{selected * 1000:>10.2f}ms{full / selected:>9.1f}x"
+            f"{full_peak / 2**20:>9.1f}MiB{selected_peak / 2**20:>13.1f}MiB"
+        )
+
+
+if __name__ == "__main__":
+    main()
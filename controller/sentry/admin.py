@@ -11,22 +11,34 @@ from admin_action_tools import (
 from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth import get_permission_codename
-from django.core.cache import cache
 from django.db import models
+from django.db.models import Sum
 from django.utils import timezone
-from django.utils.html import format_html
+from django.utils.html import format_html, format_html_join
 from django_better_admin_arrayfield.admin.mixins import DynamicArrayMixin
 from django_json_widget.widgets import JSONEditorWidget
 from django_object_actions import DjangoObjectActions, takes_instance_or_queryset
 
 from controller.sentry.choices import EventType, MetricType
+from controller.sentry.configs import delete_app_configs, store_app_configs
 from controller.sentry.filters import IsSpammingListFilter
-from controller.sentry.forms import BumpForm, MetricForm
+from controller.sentry.forms import (
+    BumpForm,
+    MetricForm,
+    PanicScopeForm,
+    UnpanicScopeForm,
+)
 from controller.sentry.inlines import AppEventInline, ProjectEventInline
 from controller.sentry.mixins import ChartMixin, PrettyTypeMixin, ProjectLinkMixin
-from controller.sentry.models import App, Event, Project
+from controller.sentry.models import App, Event, MetricBucket, Project
+from controller.sentry.panic import (
+    add_panic_scope,
+    get_panic,
+    has_panic_scopes,
+    remove_panic_scopes,
+    set_panic,
+)
 from controller.sentry.tasks import perform_detect
-from controller.sentry.utils import invalidate_cache
 
 if TYPE_CHECKING:  # pragma: no cover  # pragma: no cover
     from django.db.models import QuerySet
@@ -34,6 +46,14 @@ if TYPE_CHECKING:  # pragma: no cover  # pragma: no cover
     from django.http import HttpRequest
 
 
+# Windows of the top metrics shown on an app
+METRIC_WINDOWS = {
+    "Last hour": timedelta(hours=1),
+    "Last day": timedelta(days=1),
+    "Last week": timedelta(days=7),
+}
+
+
 @admin.register(Project)
 class ProjectAdmin(
     ChartMixin,
@@ -121,7 +141,8 @@ class ProjectAdmin(
     def save_model(self, request: "HttpRequest", obj: Project, form: "ModelForm[Project]", change: dict) -> None:
         """This method is responsible to save project in the admin.
 
-        We hook into it to start a :func:`perform_detect <controller.sentry.tasks.perform_detect>` task
+        We hook into it to start a :func:`perform_detect <controller.sentry.tasks.perform_detect>` task,
+        which recomputes the whole detection when `detection_param` changed
 
         Args:
             request (HttpRequest): The request
@@ -147,6 +168,7 @@ class EventAdmin(
     """Event Admin."""
 
     list_display = ["reference", "pretty_type", "timestamp", "get_project"]
+    list_select_related = ["project"]
 
     search_fields = ["reference", "type", "project__sentry_project_slug"]
     ordering = search_fields
@@ -175,6 +197,7 @@ class AppAdmin(
     """App Admin."""
 
     read_only_fields = ["last_seen"]
+    readonly_fields = ["get_wsgi_top_metrics", "get_celery_top_metrics"]
 
     list_display = [
         "reference",
@@ -188,6 +211,9 @@ class AppAdmin(
         "celery_collect_metrics",
     ]
 
+    # get_project and get_event_status read these on every row
+    list_select_related = ["project", "project__last_event"]
+
     list_filter = ["env", "command", IsSpammingListFilter]
 
     search_fields = ["reference", "project__sentry_project_slug", "env", "command"]
@@ -224,6 +250,7 @@ class AppAdmin(
                     "wsgi_ignore_path",
                     "wsgi_ignore_user_agent",
                     "wsgi_metrics",
+                    "get_wsgi_top_metrics",
                 ),
             },
         ],
@@ -235,12 +262,13 @@ class AppAdmin(
                     "celery_collect_metrics",
                     "celery_ignore_task",
                     "celery_metrics",
+                    "get_celery_top_metrics",
                 ),
             },
         ],
     ]
     actions = ["bump_sample_rate"]
-    changelist_actions = ["panic", "unpanic"]
+    changelist_actions = ["panic", "unpanic", "panic_scope", "unpanic_scope"]
     change_actions = ["bump_sample_rate", "enable_disable_metrics"]
 
     inlines = [AppEventInline]
@@ -249,6 +277,8 @@ class AppAdmin(
     def get_event_status(self, obj: App) -> str:
         """This method return a pretty event status html string.
 
+        The status comes from the last event of the project, which is loaded with the changelist.
+
         Args:
             obj (App): The app
 
@@ -256,7 +286,7 @@ class AppAdmin(
             str: The pretty status
         """
         text = '<b style="color:{};">{}</b>'
-        if obj.project and (event := obj.project.events.last()):
+        if obj.project and (event := obj.project.last_event):
             if event.type == EventType.DISCARD:
                 return format_html(text, "green", "No")
             return format_html(text, "red", "Yes")
@@ -275,6 +305,62 @@ class AppAdmin(
         half_hour_mark = timezone.now() - timedelta(minutes=30)
         return obj.last_seen is not None and obj.last_seen > half_hour_mark
 
+    @admin.display(description="Top WSGI metrics")
+    def get_wsgi_top_metrics(self, obj: App) -> str:
+        """This method return the most counted WSGI metrics of each window.
+
+        Args:
+            obj (App): The app
+
+        Returns:
+            str: The html tables
+        """
+        return self.get_top_metrics(obj, MetricType.WSGI)
+
+    @admin.display(description="Top Celery metrics")
+    def get_celery_top_metrics(self, obj: App) -> str:
+        """This method return the most counted Celery metrics of each window.
+
+        Args:
+            obj (App): The app
+
+        Returns:
+            str: The html tables
+        """
+        return self.get_top_metrics(obj, MetricType.CELERY)
+
+    def get_top_metrics(self, obj: App, metric_type: MetricType) -> str:
+        """This method return the `settings.METRIC_TOP_SIZE` most counted metrics of each window.
+
+        Args:
+            obj (App): The app
+            metric_type (MetricType): The metric type
+
+        Returns:
+            str: The html tables
+        """
+        now = timezone.now()
+        tables = []
+        for title, window in METRIC_WINDOWS.items():
+            top = (
+                MetricBucket.objects.filter(app_id=obj.pk, type=metric_type, hour__gt=now - window)
+                .values_list("group", "name")
+                .annotate(total=Sum("count"))
+                .order_by("-total", "group", "name")[: settings.METRIC_TOP_SIZE]
+            )
+            rows = format_html_join("", "<tr><td>{}</td><td>{}</td><td>{}</td></tr>", top)
+            tables.append(
+                (
+                    title,
+                    rows or format_html('<tr><td colspan="3">No metric</td></tr>'),
+                )
+            )
+        return format_html_join(
+            "",
+            "<h4>{}</h4><table><tr><th>Group</th><th>Name</th><th>Count</th></tr>{}</table>",
+            tables,
+        )
+
     def get_changelist_actions(self, request: "HttpRequest") -> list[str]:
         """This method return allowed changelist actions.
 
@@ -320,6 +406,8 @@ class AppAdmin(
     ) -> None:
         """This method is responsible for the bump sample rate action.
 
+        The apps are changed with a single UPDATE, then their configs are stored at once.
+
         Args:
             request (HttpRequest): The request
             queryset (QuerySet[App]): The Apps to change
@@ -329,9 +417,9 @@ class AppAdmin(
         queryset.update(
             active_sample_rate=form.cleaned_data["new_sample_rate"],
             active_window_end=new_date,
+            auto_throttled=False,
         )
-        for app in queryset:
-            invalidate_cache(f"/sentry/apps/{app.reference}/")
+        store_app_configs(queryset)
 
     bump_sample_rate.allowed_permissions = ("bump_sample_rate",)
 
@@ -347,8 +435,7 @@ class AppAdmin(
         opts = self.opts
         codename = get_permission_codename("bump_sample_rate", opts)
 
-        panic = cache.get(settings.PANIC_KEY)
-        return not panic and request.user.has_perm("%s.%s" % (opts.app_label, codename))
+        return not get_panic(request) and request.user.has_perm("%s.%s" % (opts.app_label, codename))
 
     # ----- Update Metrics
     @takes_instance_or_queryset
@@ -362,18 +449,16 @@ class AppAdmin(
     ) -> None:
         """This method is responsible for the enable/disable metrics action.
 
+        The apps are changed with a single UPDATE, then their configs are stored at once.
+
         Args:
             request (HttpRequest): The request
             queryset (QuerySet[App]): The Apps to change
             form (MetricForm): The form
         """
         metrics = form.cleaned_data["metrics"]
-        app: App
-        for app in queryset:
-            for metric in MetricType:
-                app.set_metric(metric, metric.value in metrics)
-            invalidate_cache(f"/sentry/apps/{app.reference}/")
-            app.save()
+        queryset.update(**{App.metric_field(metric): metric.value in metrics for metric in MetricType})
+        store_app_configs(queryset)
 
     enable_disable_metrics.allowed_permissions = ("enable_disable_metrics",)
 
@@ -402,7 +487,7 @@ class AppAdmin(
             request (HttpRequest): The request
             queryset (QuerySet[App]): All the Apps (unused)
         """
-        cache.set(settings.PANIC_KEY, True, timeout=None)
+        set_panic(True)
 
     panic.allowed_permissions = ("panic",)
     panic.attrs = {"style": "background-color: red;"}
@@ -416,10 +501,9 @@ class AppAdmin(
         Returns:
             bool: Is allowed
         """
-        panic = cache.get(settings.PANIC_KEY)
         opts = self.opts
         codename = get_permission_codename("panic", opts)
-        return not panic and request.user.has_perm("%s.%s" % (opts.app_label, codename))
+        return not get_panic(request) and request.user.has_perm("%s.%s" % (opts.app_label, codename))
 
     @takes_instance_or_queryset
     @confirm_action(display_queryset=False)
@@ -431,7 +515,7 @@ class AppAdmin(
             request (HttpRequest): The request
             queryset (QuerySet[App]): All the Apps (unused)
         """
-        cache.delete(settings.PANIC_KEY)
+        set_panic(False)
 
     unpanic.allowed_permissions = ("unpanic",)
     unpanic.attrs = {"style": "background-color: green;"}
@@ -445,20 +529,117 @@ class AppAdmin(
         Returns:
             bool: Is allowed
         """
-        panic = cache.get(settings.PANIC_KEY)
         opts = self.opts
         codename = get_permission_codename("panic", opts)
-        return panic and request.user.has_perm("%s.%s" % (opts.app_label, codename))
+        return get_panic(request) and request.user.has_perm("%s.%s" % (opts.app_label, codename))
+
+    # ----- Scoped Panic / Unpanic
+    @takes_instance_or_queryset
+    @add_form_to_action(PanicScopeForm)
+    @confirm_action(display_queryset=False)
+    @admin.action(description="Scoped Panic")
+    def panic_scope(
+        self,
+        request: "HttpRequest",
+        queryset: "QuerySet[App]",  # pylint: disable=unused-argument
+        form: PanicScopeForm = None,
+    ) -> None:
+        """This method activate the panic mode of a scope (env, command, project or reference glob).
+
+        Args:
+            request (HttpRequest): The request
+            queryset (QuerySet[App]): All the Apps (unused)
+            form (PanicScopeForm): The form
+        """
+        add_panic_scope(form.cleaned_data["scope"], form.cleaned_data["value"])
+
+    panic_scope.allowed_permissions = ("panic_scope",)
+    panic_scope.attrs = {"style": "background-color: orangered;"}
+
+    def has_panic_scope_permission(self, request: "HttpRequest") -> bool:
+        """This method return True if the user have the permission for scoped panic action.
+
+        Args:
+            request (HttpRequest): The request
+
+        Returns:
+            bool: Is allowed
+        """
+        opts = self.opts
+        codename = get_permission_codename("panic", opts)
+        return not get_panic(request) and request.user.has_perm("%s.%s" % (opts.app_label, codename))
+
+    @takes_instance_or_queryset
+    @add_form_to_action(UnpanicScopeForm)
+    @confirm_action(display_queryset=False)
+    @admin.action(description="Scoped UnPanic")
+    def unpanic_scope(
+        self,
+        request: "HttpRequest",
+        queryset: "QuerySet[App]",  # pylint: disable=unused-argument
+        form: UnpanicScopeForm = None,
+    ) -> None:
+        """This method deactivate the panic mode of scopes.
+
+        Args:
+            request (HttpRequest): The request
+            queryset (QuerySet[App]): All the Apps (unused)
+            form (UnpanicScopeForm): The form
+        """
+        remove_panic_scopes(form.cleaned_data["scopes"])
+
+    unpanic_scope.allowed_permissions = ("unpanic_scope",)
+    unpanic_scope.attrs = {"style": "background-color: green;"}
+
+    def has_unpanic_scope_permission(self, request: "HttpRequest") -> bool:
+        """This method return True if the user have the permission for scoped unpanic action.
+
+        Args:
+            request (HttpRequest): The request
+
+        Returns:
+            bool: Is allowed
+        """
+        opts = self.opts
+        codename = get_permission_codename("panic", opts)
+        return has_panic_scopes() and request.user.has_perm("%s.%s" % (opts.app_label, codename))
 
     # Save model
     def save_model(self, request: "HttpRequest", obj: App, form: "ModelForm", change: bool) -> None:
         """This method is responsible to save app in the admin.
 
+        A sample rate or window changed by hand is no longer restored by the spike detection.
+
         Args:
             request (HttpRequest): The request
             obj (App): The app to save
             form (ModelForm): form
             change (bool): change
         """
-        invalidate_cache(f"/sentry/apps/{obj.reference}/")
-        return super().save_model(request, obj, form, change)
+        if {"active_sample_rate", "active_window_end"} & set(form.changed_data):
+            obj.auto_throttled = False
+        super().save_model(request, obj, form, change)
+        store_app_configs([obj])
+
+    def delete_model(self, request: "HttpRequest", obj: App) -> None:
+        """This method is responsible to delete an app in the admin, along with its stored config.
+
+        Args:
+            request (HttpRequest): The request
+            obj (App): The app to delete
+        """
+        # the primary key is cleared by the deletion
+        reference = obj.reference
+        super().delete_model(request, obj)
+        delete_app_configs([reference])
+
+    def delete_queryset(self, request: "HttpRequest", queryset: "QuerySet[App]") -> None:
+        """This method is responsible to delete apps in the admin, along with their stored config.
+
+        Args:
+            request (HttpRequest): The request
+            queryset (QuerySet[App]): The apps to delete
+        """
+        references = list(queryset.values_list("reference", flat=True))
+        super().delete_queryset(request, queryset)
+        delete_app_configs(references)
@@ -0,0 +1,420 @@
+"""Backends."""
+import queue
+import threading
+from collections import defaultdict
+from time import monotonic
+from typing import Any, Optional, Union
+
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+
+from controller.sentry.utils import Singleton
+
+
+def _encode(value: Union[bytes, str, int, float]) -> bytes:
+    """Encode a value the same way redis-py does.
+
+    Args:
+        value (Union[bytes, str, int, float]): The value
+
+    Returns:
+        bytes: The encoded value
+    """
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+class LocalPipeline:
+    """Pipeline of :class:`LocalRedis`.
+
+    Commands are buffered and executed atomically on :meth:`execute`.
+
+    Attributes:
+        store (LocalRedis): The store
+        commands (list[tuple[str, tuple, dict]]): Buffered commands
+    """
+
+    def __init__(self, store: "LocalRedis") -> None:
+        """Init pipeline.
+
+        Args:
+            store (LocalRedis): The store
+        """
+        self.store = store
+        self.commands: list[tuple[str, tuple, dict]] = []
+
+    def __getattr__(self, name: str) -> Any:
+        """Buffer a command.
+
+        Args:
+            name (str): The command name
+
+        Returns:
+            Any: A function buffering the command
+        """
+
+        def command(*args, **kwargs) -> "LocalPipeline":
+            self.commands.append((name, args, kwargs))
+            return self
+
+        return command
+
+    def __enter__(self) -> "LocalPipeline":
+        """Enter context."""
+        return self
+
+    def __exit__(self, *args) -> None:
+        """Exit context."""
+        self.commands = []
+
+    def execute(self) -> list:
+        """Execute all buffered commands.
+
+        Returns:
+            list: The result of each command
+        """
+        with self.store.lock:
+            results = [getattr(self.store, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+
+class LocalPubSub:
+    """PubSub of :class:`LocalRedis`.
+
+    Attributes:
+        store (LocalRedis): The store
+        channels (set[bytes]): Subscribed channels
+        messages (queue.Queue): Received messages
+    """
+
+    def __init__(
+        self, store: "LocalRedis", ignore_subscribe_messages: bool = False  # pylint: disable=unused-argument
+    ) -> None:
+        """Init pubsub.
+
+        Args:
+            store (LocalRedis): The store
+            ignore_subscribe_messages (bool): Unused, subscribe messages are never sent
+        """
+        self.store = store
+        self.channels: set[bytes] = set()
+        self.messages: queue.Queue = queue.Queue()
+
+    def subscribe(self, *channels: str) -> None:
+        """Subscribe to channels.
+
+        Args:
+            *channels (str): The channels
+        """
+        with self.store.lock:
+            for channel in channels:
+                channel = _encode(channel)
+                self.channels.add(channel)
+                self.store._subscribers[channel].add(self)
+
+    def get_message(
+        self, ignore_subscribe_messages: bool = False, timeout: float = 0.0  # pylint: disable=unused-argument
+    ) -> Optional[dict]:
+        """Get the next message.
+
+        Args:
+            ignore_subscribe_messages (bool): Unused, subscribe messages are never sent
+            timeout (float): Time to wait for a message
+
+        Returns:
+            Optional[dict]: The message, None if no message arrived in time
+        """
+        try:
+            return self.messages.get(timeout=timeout) if timeout else self.messages.get_nowait()
+        except queue.Empty:
+            return None
+
+    def close(self) -> None:
+        """Unsubscribe from all channels."""
+        with self.store.lock:
+            for channel in self.channels:
+                self.store._subscribers[channel].discard(self)
+            self.channels = set()
+
+
+class LocalRedis(metaclass=Singleton):
+    """In-process stand-in for the subset of Redis used by the controller.
+
+    It is used when the default cache is not a Redis cache (ie: in tests).
+    Values are returned as bytes, like redis-py does.
+
+    Attributes:
+        lock (threading.RLock): Lock making each command atomic
+    """
+
+    def __init__(self) -> None:
+        """Init LocalRedis."""
+        self.lock = threading.RLock()
+        self._data: dict[str, Any] = {}
+        self._expires: dict[str, float] = {}
+        self._subscribers: dict[bytes, set[LocalPubSub]] = defaultdict(set)
+
+    def _evict(self, name: str) -> None:
+        """Remove a key if it expired.
+
+        Args:
+            name (str): The key
+        """
+        if name in self._expires and self._expires[name] <= monotonic():
+            self._data.pop(name, None)
+            self._expires.pop(name)
+
+    def pipeline(self, transaction: bool = True) -> LocalPipeline:  # pylint: disable=unused-argument
+        """Create a pipeline.
+
+        Args:
+            transaction (bool): Unused, pipelines are always atomic
+
+        Returns:
+            LocalPipeline: The pipeline
+        """
+        return LocalPipeline(self)
+
+    def pubsub(self, ignore_subscribe_messages: bool = False) -> LocalPubSub:
+        """Create a pubsub.
+
+        Args:
+            ignore_subscribe_messages (bool): Unused, subscribe messages are never sent
+
+        Returns:
+            LocalPubSub: The pubsub
+        """
+        return LocalPubSub(self, ignore_subscribe_messages)
+
+    def publish(self, channel: str, message: Any) -> int:
+        """Publish a message.
+
+        Args:
+            channel (str): The channel
+            message (Any): The message
+
+        Returns:
+            int: The number of subscribers that received the message
+        """
+        channel = _encode(channel)
+        with self.lock:
+            subscribers = list(self._subscribers[channel])
+        for subscriber in subscribers:
+            subscriber.messages.put({"type": "message", "pattern": None, "channel": channel, "data": _encode(message)})
+        return len(subscribers)
+
+    def flushdb(self) -> bool:
+        """Remove all keys."""
+        with self.lock:
+            self._data.clear()
+            self._expires.clear()
+        return True
+
+    def delete(self, *names: str) -> int:
+        """Delete keys.
+
+        Args:
+            *names (str): The keys
+
+        Returns:
+            int: The number of deleted keys
+        """
+        with self.lock:
+            deleted = 0
+            for name in names:
+                self._evict(name)
+                self._expires.pop(name, None)
+                if self._data.pop(name, None) is not None:
+                    deleted += 1
+            return deleted
+
+    def get(self, name: str) -> Optional[bytes]:
+        """Get the value of a key.
+
+        Args:
+            name (str): The key
+
+        Returns:
+            Optional[bytes]: The value, None if the key does not exist
+        """
+        with self.lock:
+            self._evict(name)
+            return self._data.get(name)
+
+    def set(  # pylint: disable=C0103
+        self, name: str, value: Any, ex: Optional[int] = None, nx: bool = False
+    ) -> Optional[bool]:
+        """Set the value of a key.
+
+        Args:
+            name (str): The key
+            value (Any): The value
+            ex (Optional[int]): Expire the key after this many seconds
+            nx (bool): Only set the key if it does not exist
+
+        Returns:
+            Optional[bool]: True, None if `nx` is set and the key exists
+        """
+        with self.lock:
+            self._evict(name)
+            if nx and name in self._data:
+                return None
+            self._data[name] = _encode(value)
+            self._expires.pop(name, None)
+            if ex is not None:
+                self._expires[name] = monotonic() + ex
+            return True
+
+    def incr(self, name: str, amount: int = 1) -> int:
+        """Increment the value of a key, a missing key counts as 0.
+
+        Args:
+            name (str): The key
+            amount (int): The increment
+
+        Returns:
+            int: The new value
+        """
+        with self.lock:
+            self._evict(name)
+            value = int(self._data.get(name, 0)) + amount
+            self._data[name] = _encode(value)
+            return value
+
+    def expire(self, name: str, time: int) -> bool:
+        """Expire a key after a number of seconds.
+
+        Args:
+            name (str): The key
+            time (int): The number of seconds
+
+        Returns:
+            bool: True if the key exists
+        """
+        with self.lock:
+            self._evict(name)
+            if name not in self._data:
+                return False
+            self._expires[name] = monotonic() + time
+            return True
+
+    def hset(self, name: str, key: Optional[str] = None, value: Any = None, mapping: Optional[dict] = None) -> int:
+        """Set fields of a hash.
+
+        Args:
+            name (str): The key
+            key (Optional[str]): The field
+            value (Any): The value
+            mapping (Optional[dict]): Multiple fields
+
+        Returns:
+            int: The number of added fields
+        """
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        with self.lock:
+            _hash = self._data.setdefault(name, {})
+            added = 0
+            for field, field_value in items.items():
+                field = _encode(field)
+                added += field not in _hash
+                _hash[field] = _encode(field_value)
+            return added
+
+    def hdel(self, name: str, *keys: str) -> int:
+        """Delete fields of a hash.
+
+        Args:
+            name (str): The key
+            *keys (str): The fields
+
+        Returns:
+            int: The number of deleted fields
+        """
+        with self.lock:
+            _hash = self._data.get(name, {})
+            deleted = 0
+            for key in keys:
+                deleted += _hash.pop(_encode(key), None) is not None
+            if not _hash:
+                self._data.pop(name, None)
+            return deleted
+
+    def hgetall(self, name: str) -> dict[bytes, bytes]:
+        """Get all the fields of a hash.
+
+        Args:
+            name (str): The key
+
+        Returns:
+            dict[bytes, bytes]: The hash
+        """
+        with self.lock:
+            return dict(self._data.get(name, {}))
+
+    def rpush(self, name: str, *values: Any) -> int:
+        """Append values to a list.
+
+        Args:
+            name (str): The key
+            *values (Any): The values
+
+        Returns:
+            int: The length of the list
+        """
+        with self.lock:
+            _list = self._data.setdefault(name, [])
+            _list.extend(_encode(value) for value in values)
+            return len(_list)
+
+    def lrange(self, name: str, start: int, end: int) -> list[bytes]:
+        """Get a range of a list, `end` is inclusive and negative indexes count from the end.
+
+        Args:
+            name (str): The key
+            start (int): The first index
+            end (int): The last index
+
+        Returns:
+            list[bytes]: The values
+        """
+        with self.lock:
+            _list = self._data.get(name, [])
+            return _list[start : end + 1 or None]
+
+    def ltrim(self, name: str, start: int, end: int) -> bool:
+        """Trim a list to a range, `end` is inclusive and negative indexes count from the end.
+
+        Args:
+            name (str): The key
+            start (int): The first index
+            end (int): The last index
+
+        Returns:
+            bool: True
+        """
+        with self.lock:
+            _list = self._data.get(name, [])[start : end + 1 or None]
+            if _list:
+                self._data[name] = _list
+            else:
+                self._data.pop(name, None)
+            return True
+
+
+def get_redis() -> Any:
+    """Get the Redis client behind the default cache.
+
+    When the default cache is not a Redis cache, the process wide
+    :class:`LocalRedis` is returned instead.
+
+    Returns:
+        Any: A redis client
+    """
+    backend = caches["default"]
+    if isinstance(backend, RedisCache):
+        return backend._cache.get_client(write=True)
+    return LocalRedis()
@@ -26,3 +26,19 @@ class EventType(TextChoices):
 
     FIRING = "FIRING", _("firing")
     DISCARD = "DISCARD", _("discard")
+
+
+class PanicScope(TextChoices):
+    """This enum is for the panic scopes.
+
+    Attributes:
+        ENV (str): Panic the apps of an env
+        COMMAND (str): Panic the apps of a command
+        PROJECT (str): Panic the apps of a project, by sentry id
+        REFERENCE (str): Panic the apps whose reference matches a glob (ie: `123_prod_*`)
+    """
+
+    ENV = "ENV", _("env")
+    COMMAND = "COMMAND", _("command")
+    PROJECT = "PROJECT", _("project")
+    REFERENCE = "REFERENCE", _("reference")
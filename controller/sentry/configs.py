@@ -0,0 +1,108 @@
+"""App Configs.
+
+The serialized configuration of each app is stored in the cache under a stable key.
+It is refreshed explicitly every time the app changes, so serving it takes a single GET.
+
+A stored document looks like ``{"etag": "<md5 of the config>", "config": {...}}``.
+"""
+import hashlib
+import json
+from typing import TYPE_CHECKING, Iterable, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import QuerySet
+
+from controller.sentry.notifications import notify_app_configs
+from controller.sentry.serializers import AppSerializer
+
+if TYPE_CHECKING:  # pragma: no cover
+    from controller.sentry.models import App
+
+
+def app_config_key(reference: str) -> str:
+    """Return the cache key of an app config.
+
+    Args:
+        reference (str): The app reference
+
+    Returns:
+        str: The cache key
+    """
+    return f"app:{reference}"
+
+
+def compute_etag(config: dict) -> str:
+    """Compute the ETag of a serialized app config.
+
+    Args:
+        config (dict): The serialized config
+
+    Returns:
+        str: The ETag (unquoted)
+    """
+    payload = json.dumps(config, sort_keys=True, separators=(",", ":"))
+    return hashlib.md5(payload.encode(), usedforsecurity=False).hexdigest()
+
+
+def get_app_config(reference: str) -> Optional[dict]:
+    """Get a stored app config document.
+
+    Args:
+        reference (str): The app reference
+
+    Returns:
+        Optional[dict]: The document, None if not stored
+    """
+    return cache.get(app_config_key(reference))
+
+
+def get_app_configs(references: Iterable[str]) -> dict[str, dict]:
+    """Get the stored config documents of many apps in one call.
+
+    Args:
+        references (Iterable[str]): The app references
+
+    Returns:
+        dict[str, dict]: The documents by app reference, missing apps are omitted
+    """
+    keys = {app_config_key(reference): reference for reference in references}
+    return {keys[key]: config for key, config in cache.get_many(keys).items()}
+
+
+def store_app_configs(apps: "Iterable[App]") -> dict[str, dict]:
+    """Serialize and store the config of apps, then notify the waiting clients.
+
+    A queryset only loads the serialized fields and the serializer fields are built once for all the apps,
+    the documents are stored with a single call.
+
+    Args:
+        apps (Iterable[App]): The apps, can be a queryset
+
+    Returns:
+        dict[str, dict]: The documents by app reference
+    """
+    if isinstance(apps, QuerySet):
+        apps = apps.only(*AppSerializer.Meta.fields)
+    documents = {}
+    for config in AppSerializer(apps, many=True).data:
+        config = dict(config)
+        documents[config["reference"]] = {"etag": compute_etag(config), "config": config}
+    if documents:
+        cache.set_many(
+            {app_config_key(reference): document for reference, document in documents.items()},
+            timeout=settings.APP_CACHE_TIMEOUT,
+        )
+        notify_app_configs(documents)
+    return documents
+
+
+def delete_app_configs(references: Iterable[str]) -> None:
+    """Delete the stored config of apps.
+
+    Args:
+        references (Iterable[str]): The app references
+    """
+    keys = [app_config_key(reference) for reference in references]
+    if keys:
+        cache.delete_many(keys)
@@ -0,0 +1,65 @@
+"""Deletion.
+
+Large deletions are split in batches of primary keys, each deleted in its own transaction.
+Locks are held for one batch only and cascades are collected for one batch at a time.
+The rows of a batch are filtered again when deleted, so a row updated meanwhile to no longer match is kept.
+
+Deleted batches are committed, so a task killed midway loses at most the current batch
+and the next run carries on with the remaining rows.
+"""
+from time import monotonic, sleep
+from typing import Callable, Optional
+
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.db import transaction
+from django.db.models import QuerySet
+
+LOGGER = get_task_logger(__name__)
+
+
+def delete_in_batches(
+    queryset: QuerySet,
+    batch_size: Optional[int] = None,
+    pause: Optional[float] = None,
+    on_batch: Optional[Callable[[list], None]] = None,
+) -> int:
+    """Delete the rows of a queryset by batches of primary keys.
+
+    Args:
+        queryset (QuerySet): The rows to delete
+        batch_size (Optional[int]): Rows per batch, `settings.DELETION_BATCH_SIZE` by default
+        pause (Optional[float]): Seconds to wait between batches, `settings.DELETION_BATCH_PAUSE` by default
+        on_batch (Optional[Callable[[list], None]]): Called with the primary keys of each deleted batch
+
+    Returns:
+        int: The number of deleted rows, without cascades
+    """
+    batch_size = batch_size or settings.DELETION_BATCH_SIZE
+    pause = settings.DELETION_BATCH_PAUSE if pause is None else pause
+    model = queryset.model
+    pks = queryset.order_by("pk").values_list("pk", flat=True)
+
+    deleted, started = 0, monotonic()
+    batch = list(pks[:batch_size])
+    while batch:
+        with transaction.atomic():
+            _, deleted_by_model = queryset.filter(pk__in=batch).delete()
+        deleted += deleted_by_model.get(model._meta.label, 0)
+        if on_batch is not None:
+            on_batch(batch)
+        if len(batch) < batch_size:
+            break
+        sleep(pause)
+        batch = list(pks.filter(pk__gt=batch[-1])[:batch_size])
+
+    if deleted:
+        elapsed = monotonic() - started
+        LOGGER.info(
+            "Deleted %s %s in %.2fs (%.0f rows/s)",
+            deleted,
+            model._meta.verbose_name_plural,
+            elapsed,
+            deleted / elapsed if elapsed else deleted,
+        )
+    return deleted
@@ -1,11 +1,79 @@
-"""Detector."""
+"""Detector.
 
-from collections import OrderedDict
-from copy import copy
-from statistics import mean, stdev
+The mean and standard deviation of the sliding window are updated incrementally
+(Welford's algorithm), so a series is processed in linear time. They match the exact
+`statistics.mean` and `statistics.stdev` of the window within a relative :data:`TOLERANCE`.
+
+Sliding large values out of the window leaves rounding errors in the sum of squared differences,
+which would dominate a window with little or no variance (ie: a flat window after a spike).
+A bound of these errors is accumulated, and the sums are recomputed from the window
+once they are no longer negligible, see :data:`CANCELLATION`.
+
+The state reached at the end of a series can be saved, to :meth:`SpikesDetector.resume`
+the computation when new data arrives.
+
+When NumPy is installed, :meth:`SpikesDetector.compute_many` processes many series at once.
+"""
+
+from collections import OrderedDict, deque
+from math import sqrt
+from typing import TYPE_CHECKING, Any
 
 from controller.sentry.exceptions import SentryNoOutcomeException
-from controller.sentry.models import Project
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+if TYPE_CHECKING:  # pragma: no cover
+    from controller.sentry.models import Project
+
+# Relative tolerance of the incremental mean and standard deviation
+TOLERANCE = 1e-9
+# The sums of the window are recomputed when the sum of squared differences falls below
+# this ratio of the bound of its rounding errors, so the relative error stays around 1e-10
+CANCELLATION = 1e-6
+
+
+def window_sums(window: Any) -> tuple[Any, Any]:
+    """Compute the mean and sum of squared differences of a window, in two passes.
+
+    Works on lists and on NumPy arrays (one window per row).
+
+    Args:
+        window (Any): The window
+
+    Returns:
+        tuple[Any, Any]: The mean and sum of squared differences
+    """
+    if numpy is not None and isinstance(window, numpy.ndarray):
+        mean = window.mean(axis=1)
+        return mean, ((window - mean[:, None]) ** 2).sum(axis=1)
+    mean = sum(window) / len(window)
+    return mean, sum((item - mean) ** 2 for item in window)
+
+
+def slide_window(mean: Any, squares: Any, size: int, old: Any, new: Any) -> tuple[Any, Any, Any]:
+    """Slide a window by one item, replacing `old` by `new`.
+
+    Works on floats and on NumPy arrays (one window per row).
+
+    Args:
+        mean (Any): The mean of the window
+        squares (Any): The sum of squared differences from the mean of the window
+        size (int): The size of the window
+        old (Any): The item leaving the window
+        new (Any): The item entering the window
+
+    Returns:
+        tuple[Any, Any, Any]: The new mean and sum of squared differences, which can be slightly negative,
+            and the magnitude of the update, bounding its rounding error once multiplied by the float epsilon
+    """
+    delta = new - old
+    new_mean = mean + delta / size
+    update = delta * (new - new_mean + old - mean)
+    return new_mean, squares + update, abs(delta) * (abs(new - new_mean) + abs(old - mean)) + abs(squares)
 
 
 class SpikesDetector:
@@ -62,7 +130,7 @@ class SpikesDetector:
         self.floor = floor
 
     @classmethod
-    def from_project(cls, project: Project) -> "SpikesDetector":
+    def from_project(cls, project: "Project") -> "SpikesDetector":
         """Class method to create a `SpikesDetector` from a :Class:`controller.sentry.models.Project`.
 
         Args:
@@ -73,15 +141,15 @@ class SpikesDetector:
         """
         return cls(**project.detection_param)
 
-    def compute_sentry(self, stats: dict) -> tuple[OrderedDict, list[tuple[str, int, int, float, float]]]:
-        """Method to compute from a sentry stats dict.
+    @staticmethod
+    def get_series(stats: dict) -> list[int]:
+        """Method to get the accepted series of a sentry stats dict.
 
         Args:
             stats (dict): The Sentry Stats
 
         Returns:
-            OrderedDict: Annotated signal
-            list[tuple[str, int, int, float, float]]: Full algorithm results
+            list[int]: The series
 
         Raises:
             SentryNoOutcomeException: When there is no series with accepted outcome
@@ -92,8 +160,24 @@ class SpikesDetector:
         )
         if series is None:
             raise SentryNoOutcomeException("No series with accepted outcome")
+        return series
+
+    @staticmethod
+    def annotate(
+        stats: dict, series: list[int], result: tuple[list[int], list[float], list[float]]
+    ) -> tuple[OrderedDict, list[tuple[str, int, int, float, float]]]:
+        """Method to annotate the result of a computation with the sentry intervals.
 
-        signal, avg_filter, std_filter = self.compute(series)
+        Args:
+            stats (dict): The Sentry Stats
+            series (list[int]): The series
+            result (tuple[list[int], list[float], list[float]]): Signal, avg filter and std filter
+
+        Returns:
+            OrderedDict: Annotated signal
+            list[tuple[str, int, int, float, float]]: Full algorithm results
+        """
+        signal, avg_filter, std_filter = result
 
         annotated_result = OrderedDict((date, sig) for date, sig in zip(stats["intervals"], signal))
         dump = []
@@ -102,7 +186,20 @@ class SpikesDetector:
 
         return annotated_result, dump
 
-    def compute(self, data) -> tuple[list[int], list[float], list[float]]:
+    def compute_sentry(self, stats: dict) -> tuple[OrderedDict, list[tuple[str, int, int, float, float]]]:
+        """Method to compute from a sentry stats dict.
+
+        Args:
+            stats (dict): The Sentry Stats
+
+        Returns:
+            OrderedDict: Annotated signal
+            list[tuple[str, int, int, float, float]]: Full algorithm results
+        """
+        series = self.get_series(stats)
+        return self.annotate(stats, series, self.compute(series))
+
+    def compute(self, data: list[float]) -> tuple[list[int], list[float], list[float]]:
         """Method to compute signals.
 
         Args:
@@ -113,22 +210,153 @@ class SpikesDetector:
             list[float]: avg filter
             list[float]: std filter
         """
-        signals = [0] * self.lag
-        avg_filter = [0] * self.lag
-        std_filter = [0] * self.lag
-        filtered_data = copy(data)
-        avg_filter[self.lag - 1] = mean(data[: self.lag])
-        std_filter[self.lag - 1] = stdev(data[: self.lag])
-
-        for i, item in enumerate(data[self.lag :], start=self.lag):
-            threshold = max(self.floor, avg_filter[i - 1] + self.threshold * std_filter[i - 1])
+        result, _ = self.compute_with_state(data)
+        return result
+
+    def compute_with_state(self, data: list[float]) -> tuple[tuple[list[int], list[float], list[float]], dict]:
+        """Method to compute signals and the state reached at the end of the data.
+
+        Args:
+            data (list[float]): data
+
+        Returns:
+            tuple[list[int], list[float], list[float]]: Signal, avg filter and std filter
+            dict: The state, to :meth:`resume` the computation with the next data
+        """
+        lag = self.lag
+        window = list(data[:lag])
+        window_mean, window_squares = window_sums(window)
+        state = {"window": window, "pending": None}
+
+        signals = [0] * lag
+        avg_filter = [0] * lag
+        std_filter = [0] * lag
+        avg_filter[lag - 1] = window_mean
+        std_filter[lag - 1] = sqrt(window_squares / (len(window) - 1))
+
+        (new_signals, new_avg_filter, new_std_filter), state = self.resume(data[lag:], state)
+        return (signals + new_signals, avg_filter + new_avg_filter, std_filter + new_std_filter), state
+
+    def resume(self, data: list[float], state: dict) -> tuple[tuple[list[int], list[float], list[float]], dict]:
+        """Method to compute the signals of new data, from the state reached at the end of the previous data.
+
+        The state holds the last `lag` filtered data (the window) and the filtered data not yet
+        in the window (`pending`, None before the first item). The mean and sum of squared differences
+        of the window are recomputed from it, so rounding errors don't pile up from one resume to the next.
+
+        Args:
+            data (list[float]): new data
+            state (dict): The state
+
+        Returns:
+            tuple[list[int], list[float], list[float]]: Signal, avg filter and std filter of the new data
+            dict: The new state
+        """
+        lag = self.lag
+        window = deque(state["window"])
+        window_mean, window_squares = window_sums(window)
+        pending = state["pending"]
+        avg, std = window_mean, sqrt(max(window_squares, 0.0) / (lag - 1))
+
+        signals, avg_filter, std_filter = [], [], []
+        errors = 0.0
+        for item in data:
+            previous = window[-1] if pending is None else pending
+            threshold = max(self.floor, avg + self.threshold * std)
             if item > threshold:
-                signals.append(1 if item > avg_filter[i - 1] else 0)
-                filtered_data[i] = self.influence * item + (1 - self.influence) * filtered_data[i - 1]
+                signals.append(1 if item > avg else 0)
+                filtered = self.influence * item + (1 - self.influence) * previous
             else:
                 signals.append(0)
-                filtered_data[i] = data[i]
-            avg_filter.append(mean(filtered_data[(i - self.lag) : i]))
-            std_filter.append(stdev(filtered_data[(i - self.lag) : i]))
+                filtered = item
+            if pending is not None:
+                window_mean, window_squares, error = slide_window(
+                    window_mean, window_squares, lag, window.popleft(), pending
+                )
+                window.append(pending)
+                errors += error
+                if window_squares <= errors * CANCELLATION:
+                    window_mean, window_squares = window_sums(window)
+                    errors = 0.0
+                window_squares = max(window_squares, 0.0)
+            pending = filtered
+            avg, std = window_mean, sqrt(window_squares / (lag - 1))
+            avg_filter.append(avg)
+            std_filter.append(std)
+
+        state = {"window": list(window), "pending": pending}
+        return (signals, avg_filter, std_filter), state
+
+    def compute_many(self, series: list[list[float]]) -> list[tuple[list[int], list[float], list[float]]]:
+        """Method to compute signals of many series, see :meth:`compute_many_with_state`.
+
+        Args:
+            series (list[list[float]]): data of each series
+
+        Returns:
+            list[tuple[list[int], list[float], list[float]]]: Signal, avg filter and std filter of each series
+        """
+        return [result for result, _ in self.compute_many_with_state(series)]
+
+    def compute_many_with_state(
+        self, series: list[list[float]]
+    ) -> list[tuple[tuple[list[int], list[float], list[float]], dict]]:
+        """Method to compute signals of many series and their state.
+
+        When NumPy is installed and all the series have the same length (ie: stats of the same period),
+        they are processed together, each step being computed over a 2-D array.
+        Otherwise each series is computed by :meth:`compute_with_state`.
+
+        Args:
+            series (list[list[float]]): data of each series
+
+        Returns:
+            list[tuple[tuple[list[int], list[float], list[float]], dict]]: Signal, avg filter and std filter,
+                and state of each series
+        """
+        lengths = {len(data) for data in series}
+        if numpy is None or len(lengths) != 1 or lengths.pop() <= self.lag:
+            return [self.compute_with_state(data) for data in series]
+
+        data = numpy.asarray(series, dtype=float)
+        lag = self.lag
+        signals = numpy.zeros(data.shape, dtype=int)
+        avg_filter = numpy.zeros(data.shape)
+        std_filter = numpy.zeros(data.shape)
+        filtered_data = data.copy()
+
+        window_mean, window_squares = window_sums(data[:, :lag])
+        errors = numpy.zeros(data.shape[0])
+        avg_filter[:, lag - 1] = window_mean
+        std_filter[:, lag - 1] = numpy.sqrt(window_squares / (lag - 1))
+
+        for i in range(lag, data.shape[1]):
+            item = data[:, i]
+            threshold = numpy.maximum(self.floor, avg_filter[:, i - 1] + self.threshold * std_filter[:, i - 1])
+            peak = item > threshold
+            signals[:, i] = peak & (item > avg_filter[:, i - 1])
+            filtered_data[:, i] = numpy.where(
+                peak, self.influence * item + (1 - self.influence) * filtered_data[:, i - 1], item
+            )
+            # the window of step i is filtered_data[:, i - lag : i]
+            if i > lag:
+                window_mean, window_squares, error = slide_window(
+                    window_mean, window_squares, lag, filtered_data[:, i - 1 - lag], filtered_data[:, i - 1]
+                )
+                errors += error
+                if (cancelled := window_squares <= errors * CANCELLATION).any():
+                    window_mean[cancelled], window_squares[cancelled] = window_sums(
+                        filtered_data[cancelled, i - lag : i]
+                    )
+                    errors[cancelled] = 0.0
+                window_squares = numpy.maximum(window_squares, 0.0)
+            avg_filter[:, i] = window_mean
+            std_filter[:, i] = numpy.sqrt(window_squares / (lag - 1))
 
-        return signals, avg_filter, std_filter
+        return [
+            (
+                (signal.tolist(), avg.tolist(), std.tolist()),
+                {"window": filtered[-1 - lag : -1].tolist(), "pending": float(filtered[-1])},
+            )
+            for signal, avg, std, filtered in zip(signals, avg_filter, std_filter, filtered_data)
+        ]
@@ -7,3 +7,39 @@ class SentryException(Exception):
 
 class SentryNoOutcomeException(Exception):
     """Exception Raised when sentry doesn't return any stats."""
+
+
+class SentryRateLimitException(SentryException):
+    """Exception Raised when a call to the Sentry API must wait for the rate limit.
+
+    Attributes:
+        retry_after (float): Seconds to wait before calling again
+    """
+
+    def __init__(self, retry_after: float) -> None:
+        """Init with the time to wait.
+
+        Args:
+            retry_after (float): Seconds to wait before calling again
+        """
+        super().__init__(f"Sentry API rate limited, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class SentryPartialStatsException(SentryRateLimitException):
+    """Exception Raised when the stats of some projects could not be fetched because of the rate limit.
+
+    Attributes:
+        retry_after (float): Seconds to wait before calling again
+        stats (dict[str, dict]): The stats fetched anyway, by sentry id
+    """
+
+    def __init__(self, retry_after: float, stats: dict[str, dict]) -> None:
+        """Init with the time to wait and the fetched stats.
+
+        Args:
+            retry_after (float): Seconds to wait before calling again
+            stats (dict[str, dict]): The stats fetched anyway, by sentry id
+        """
+        super().__init__(retry_after)
+        self.stats = stats
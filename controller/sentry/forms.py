@@ -3,11 +3,19 @@ from typing import TYPE_CHECKING
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.forms import DurationField, FloatField, Form, MultipleChoiceField
+from django.forms import (
+    CharField,
+    ChoiceField,
+    DurationField,
+    FloatField,
+    Form,
+    MultipleChoiceField,
+)
 from django.forms.widgets import CheckboxSelectMultiple
 from durationwidget.widgets import TimeDurationWidget
 
-from controller.sentry.choices import MetricType
+from controller.sentry.choices import MetricType, PanicScope
+from controller.sentry.panic import get_panic_scopes
 
 if TYPE_CHECKING:  # pragma: no cover
     from datetime import timedelta
@@ -61,3 +69,25 @@ class MetricForm(Form):
         required=False,
         help_text="Disable or Enable metric gathering",
     )
+
+
+class PanicScopeForm(Form):
+    """PanicScopeForm is used to activate the panic mode of some apps."""
+
+    scope = ChoiceField(choices=PanicScope.choices, help_text="Kind of apps to panic")
+    value = CharField(
+        max_length=255, help_text="Env, command, sentry id of the project or reference glob (ie: 123_prod_*)"
+    )
+
+
+class UnpanicScopeForm(Form):
+    """UnpanicScopeForm is used to deactivate the panic mode of some scopes."""
+
+    scopes = MultipleChoiceField(widget=CheckboxSelectMultiple, help_text="Panic scopes to deactivate")
+
+    def __init__(self, *args, **kwargs) -> None:
+        """Init the form with the active panic scopes."""
+        super().__init__(*args, **kwargs)
+        self.fields["scopes"].choices = [
+            (field, f"{field} (since {date})") for field, date in sorted(get_panic_scopes().items())
+        ]
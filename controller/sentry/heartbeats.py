@@ -0,0 +1,39 @@
+"""Heartbeats.
+
+Apps poll the controller very often, writing `last_seen` on each poll is costly.
+Heartbeats are buffered in a Redis hash and flushed to the database by
+:func:`flush_heartbeats <controller.sentry.tasks.flush_heartbeats>`.
+"""
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+from controller.sentry.backends import get_redis
+
+
+def record_heartbeats(*references: str) -> None:
+    """Record that apps have been seen now.
+
+    Args:
+        *references (str): The app references
+    """
+    if not references:
+        return
+    now = datetime.now(timezone.utc).timestamp()
+    get_redis().hset(settings.HEARTBEAT_KEY, mapping={reference: now for reference in references})
+
+
+def pop_heartbeats() -> dict[str, datetime]:
+    """Atomically get and clear all buffered heartbeats.
+
+    Returns:
+        dict[str, datetime]: The last seen date by app reference
+    """
+    pipe = get_redis().pipeline()
+    pipe.hgetall(settings.HEARTBEAT_KEY)
+    pipe.delete(settings.HEARTBEAT_KEY)
+    heartbeats, _ = pipe.execute()
+    return {
+        reference.decode(): datetime.fromtimestamp(float(timestamp), tz=timezone.utc)
+        for reference, timestamp in heartbeats.items()
+    }
@@ -1,5 +1,20 @@
 """Metrics."""
+from controller.sentry.metrics.buffer import (
+    ack_metric_batch,
+    coalesce_metrics,
+    enqueue_metrics,
+    metric_fold_lock,
+    peek_metric_batch,
+)
 from controller.sentry.metrics.celery import celery_merger
 from controller.sentry.metrics.wsgi import wsgi_merger
 
-__all__ = ["wsgi_merger", "celery_merger"]
+__all__ = [
+    "wsgi_merger",
+    "celery_merger",
+    "enqueue_metrics",
+    "metric_fold_lock",
+    "peek_metric_batch",
+    "ack_metric_batch",
+    "coalesce_metrics",
+]
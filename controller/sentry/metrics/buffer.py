@@ -0,0 +1,106 @@
+"""Metrics Buffer.
+
+Pushed metrics are appended to a Redis list, so the request never touches the database.
+The queue is drained in batches by :func:`fold_metrics <controller.sentry.tasks.fold_metrics>`,
+which sums all the payloads of the same app and writes each app once per batch.
+
+A batch is read without being removed, and acknowledged (removed) only once it is committed,
+so a failing fold never loses counts. A single fold runs at a time, see :func:`metric_fold_lock`.
+"""
+import json
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Iterator, Union
+from uuid import uuid4
+
+from django.conf import settings
+
+from controller.sentry.backends import get_redis
+from controller.sentry.choices import MetricType
+from controller.sentry.utils import depth
+
+# Group used by the legacy flat metrics
+DEFAULT_GROUP = {MetricType.WSGI: "path", MetricType.CELERY: "task"}
+
+
+def enqueue_metrics(
+    reference: str, metric_type: MetricType, data: Union[dict[str, int], dict[str, dict[str, int]]]
+) -> None:
+    """Append metrics of an app to the queue.
+
+    Args:
+        reference (str): The app reference
+        metric_type (MetricType): The metric type
+        data (Union[dict[str, int], dict[str, dict[str, int]]]): The metrics
+    """
+    payload = {"reference": reference, "type": metric_type, "data": data}
+    get_redis().rpush(settings.METRIC_QUEUE_KEY, json.dumps(payload))
+
+
+@contextmanager
+def metric_fold_lock() -> Iterator[bool]:
+    """Try to acquire the lock of the fold, it expires after `settings.METRIC_FOLD_LOCK_TIMEOUT` seconds.
+
+    Yields:
+        bool: True if the lock is acquired
+    """
+    redis = get_redis()
+    token = uuid4().hex
+    acquired = redis.set(settings.METRIC_FOLD_LOCK_KEY, token, nx=True, ex=settings.METRIC_FOLD_LOCK_TIMEOUT)
+    try:
+        yield bool(acquired)
+    finally:
+        if acquired and redis.get(settings.METRIC_FOLD_LOCK_KEY) == token.encode():
+            redis.delete(settings.METRIC_FOLD_LOCK_KEY)
+
+
+def peek_metric_batch(count: int) -> list[dict]:
+    """Get the oldest payloads of the queue, without removing them.
+
+    Args:
+        count (int): Maximum number of payloads
+
+    Returns:
+        list[dict]: The payloads
+    """
+    payloads = get_redis().lrange(settings.METRIC_QUEUE_KEY, 0, count - 1)
+    return [json.loads(payload) for payload in payloads]
+
+
+def ack_metric_batch(count: int) -> None:
+    """Remove the oldest payloads of the queue, once they are folded.
+
+    Args:
+        count (int): Number of payloads
+    """
+    get_redis().ltrim(settings.METRIC_QUEUE_KEY, count, -1)
+
+
+def coalesce_metrics(payloads: list[dict]) -> dict[str, dict[MetricType, dict[str, dict[str, int]]]]:
+    """Sum the payloads of the same app.
+
+    Args:
+        payloads (list[dict]): The payloads
+
+    Returns:
+        dict[str, dict[MetricType, dict[str, dict[str, int]]]]: The metrics by app reference and type
+    """
+    metrics: dict[str, dict[MetricType, dict[str, dict[str, int]]]] = defaultdict(
+        lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+    )
+    for payload in payloads:
+        metric_type = MetricType(payload["type"])
+        data = payload["data"]
+        if depth(data) == 1:
+            data = {DEFAULT_GROUP[metric_type]: data}
+        for group, counters in data.items():
+            for name, count in counters.items():
+                metrics[payload["reference"]][metric_type][group][name] += count
+
+    return {
+        reference: {
+            metric_type: {group: dict(counters) for group, counters in data.items()}
+            for metric_type, data in by_type.items()
+        }
+        for reference, by_type in metrics.items()
+    }
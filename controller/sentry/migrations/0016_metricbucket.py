@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("sentry", "0015_app_wsgi_ignore_user_agent_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MetricBucket",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("type", models.CharField(choices=[("WSGI", "WSGI"), ("CELERY", "CELERY")], max_length=10)),
+                ("group", models.TextField()),
+                ("name", models.TextField()),
+                ("hour", models.DateTimeField(db_index=True)),
+                ("count", models.PositiveBigIntegerField(default=0)),
+                (
+                    "app",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, related_name="metric_buckets", to="sentry.app"
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="metricbucket",
+            constraint=models.UniqueConstraint(
+                fields=("app", "type", "group", "name", "hour"), name="unique_metric_bucket"
+            ),
+        ),
+    ]
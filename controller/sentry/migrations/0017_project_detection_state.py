@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("sentry", "0016_metricbucket"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="project",
+            name="detection_state",
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
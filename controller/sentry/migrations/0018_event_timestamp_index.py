@@ -0,0 +1,20 @@
+# Generated by Django 4.2.30 on 2026-10-18 01:02
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # the index is built without locking the table
+    atomic = False
+
+    dependencies = [
+        ("sentry", "0017_project_detection_state"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="event",
+            index=models.Index(fields=["timestamp"], name="event_timestamp_idx"),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-18 01:05
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # indexes are built without locking the tables
+    atomic = False
+
+    dependencies = [
+        ("sentry", "0018_event_timestamp_index"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="app",
+            index=models.Index(
+                condition=models.Q(("active_window_end__isnull", False)),
+                fields=["active_window_end"],
+                name="app_active_window_end_idx",
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="app",
+            index=models.Index(fields=["last_seen"], name="app_last_seen_idx"),
+        ),
+        AddIndexConcurrently(
+            model_name="event",
+            index=models.Index(fields=["project", "timestamp"], name="event_project_timestamp_idx"),
+        ),
+    ]
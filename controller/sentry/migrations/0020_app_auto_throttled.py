@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 01:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("sentry", "0019_hot_query_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="app",
+            name="auto_throttled",
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
@@ -1,6 +1,6 @@
 """Models."""
 from functools import partial
-from typing import Any
+from typing import Any, Iterable
 from uuid import uuid4
 
 from django.conf import settings
@@ -35,6 +35,8 @@ class Project(models.Model):
 
     detection_param = models.JSONField(default=partial(settings_default_value, "DEFAULT_SPIKE_DETECTION_PARAM"))
     detection_result = models.JSONField(blank=True, null=True)
+    # state of the detector after the last processed interval, see SpikesDetector.resume
+    detection_state = models.JSONField(blank=True, null=True, editable=False)
     last_event = models.ForeignKey("Event", null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
 
     def __str__(self) -> str:
@@ -55,6 +57,12 @@ class Event(models.Model):
         """Meta Class of Event."""
 
         ordering = ["timestamp"]
+        indexes = [
+            # pruning of old events
+            models.Index(fields=["timestamp"], name="event_timestamp_idx"),
+            # last events of a project
+            models.Index(fields=["project", "timestamp"], name="event_project_timestamp_idx"),
+        ]
 
 
 class App(models.Model):
@@ -66,6 +74,8 @@ class App(models.Model):
     default_sample_rate = models.FloatField(default=settings.DEFAULT_SAMPLE_RATE)
     active_sample_rate = models.FloatField(default=settings.DEFAULT_SAMPLE_RATE)
     active_window_end = models.DateTimeField(null=True, blank=True)
+    # the active window was opened by the spike detection, see controller.sentry.throttling
+    auto_throttled = models.BooleanField(default=False, editable=False)
 
     # Sentry Api
     project = models.ForeignKey(Project, null=True, blank=True, on_delete=models.SET_NULL, related_name="apps")
@@ -134,14 +144,90 @@ class App(models.Model):
             metric_type (MetricType): Metric type
             metric_state (bool): Should collect metrics
         """
-        prefix = metric_type.value.lower()
-        setattr(self, f"{prefix}_collect_metrics", metric_state)
+        setattr(self, self.metric_field(metric_type), metric_state)
+
+    @staticmethod
+    def metric_field(metric_type: MetricType) -> str:
+        """Get the name of the field enabling the collection of a metric type.
+
+        Args:
+            metric_type (MetricType): Metric type
+
+        Returns:
+            str: The field name
+        """
+        return f"{metric_type.value.lower()}_collect_metrics"
+
+    @classmethod
+    def link_projects(cls, apps: Iterable["App"]) -> list["App"]:
+        """Link apps to the project of their reference, creating the missing projects.
+
+        References look like `<sentry_id>_<env>_<command>`, apps with another reference are left unlinked.
+        It takes two queries, whatever the number of apps.
+
+        Args:
+            apps (Iterable[App]): The apps, can be a queryset
+
+        Returns:
+            list[App]: The linked apps
+        """
+        linked = []
+        for app in apps:
+            parts = app.reference.split("_")
+            if len(parts) == 3:
+                app.project_id, app.env, app.command = parts
+                linked.append(app)
+        if linked:
+            sentry_ids = {app.project_id for app in linked}
+            Project.objects.bulk_create(
+                [Project(sentry_id=sentry_id) for sentry_id in sentry_ids], ignore_conflicts=True
+            )
+            cls.objects.bulk_update(linked, ["project", "env", "command"])
+        return linked
 
     class Meta:
         """Meta Class of App."""
 
+        indexes = [
+            # open windows, closed by close_window
+            models.Index(
+                fields=["active_window_end"],
+                condition=models.Q(active_window_end__isnull=False),
+                name="app_active_window_end_idx",
+            ),
+            # inactive apps, pruned by prune_inactive_app
+            models.Index(fields=["last_seen"], name="app_last_seen_idx"),
+        ]
         permissions = [
             ("bump_sample_rate_app", "Can bump sample rate"),
             ("panic_app", "Panic! Set all sample rate to 0"),
             ("enable_disable_metrics_app", "Can Enable/Disable metrics"),
         ]
+
+
+class MetricBucket(models.Model):
+    """MetricBucket Models.
+
+    The count of one metric of an app during one hour, so the write cost of the metrics
+    does not grow with the age of the app. Old buckets are rolled up into
+    `wsgi_metrics`/`celery_metrics` by
+    :func:`rollup_old_metric_bucket <controller.sentry.tasks.rollup_old_metric_bucket>`.
+    """
+
+    app = models.ForeignKey(App, on_delete=models.CASCADE, related_name="metric_buckets")
+    type = models.CharField(choices=MetricType.choices, max_length=10)
+    group = models.TextField()
+    name = models.TextField()
+    hour = models.DateTimeField(db_index=True)
+    count = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        """Meta Class of MetricBucket."""
+
+        constraints = [
+            models.UniqueConstraint(fields=["app", "type", "group", "name", "hour"], name="unique_metric_bucket")
+        ]
+
+    def __str__(self) -> str:
+        """Return MetricBucket as a string."""
+        return f"MetricBucket<{self.app_id}, {self.type}, {self.group}, {self.name}, {self.hour.isoformat()}>"
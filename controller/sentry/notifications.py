@@ -0,0 +1,154 @@
+"""Notifications.
+
+App config changes are published on a Redis channel, so the requests waiting for a new
+config (see :meth:`AppViewSet.watch <controller.sentry.views.AppViewSet.watch>`) are
+woken up as soon as it changes.
+
+Each process runs a single :class:`ConfigListener` subscribed to the channel, which
+dispatches the notifications to the requests waiting in this process.
+"""
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional
+
+from django.conf import settings
+
+from controller.sentry.backends import get_redis
+from controller.sentry.utils import Singleton
+
+LOGGER = logging.getLogger(__name__)
+
+# Notify every app, used when panic changes
+ALL_APPS = "*"
+
+
+def notify_app_configs(references: Iterable[str]) -> None:
+    """Notify that the config of apps changed.
+
+    Args:
+        references (Iterable[str]): The app references
+    """
+    references = list(references)
+    if references:
+        get_redis().publish(settings.APP_CONFIG_CHANNEL, json.dumps(references))
+
+
+def notify_panic() -> None:
+    """Notify that the panic mode changed, this concerns every app."""
+    notify_app_configs([ALL_APPS])
+
+
+class ConfigListener(metaclass=Singleton):
+    """ConfigListener dispatch config notifications to the waiting requests.
+
+    Attributes:
+        lock (threading.Lock): Lock protecting the waiters
+        waiters (dict[str, set[threading.Event]]): Events of the waiting requests by app reference
+        subscribed (threading.Event): Set once the listener is subscribed
+        thread (Optional[threading.Thread]): The listening thread
+    """
+
+    def __init__(self) -> None:
+        """Init ConfigListener."""
+        self.lock = threading.Lock()
+        self.waiters: dict[str, set[threading.Event]] = defaultdict(set)
+        self.subscribed = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start the listening thread if it is not running (ie: after a fork)."""
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.subscribed.clear()
+                self.thread = threading.Thread(target=self.run, name="config-listener", daemon=True)
+                self.thread.start()
+        self.subscribed.wait(timeout=1)
+
+    def run(self) -> None:
+        """Listen forever, reconnecting on failure."""
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                LOGGER.exception("Config listener failed, reconnecting")
+                self.subscribed.clear()
+                # notifications may have been missed
+                self.wake(ALL_APPS)
+                time.sleep(1)
+
+    def listen(self) -> None:
+        """Subscribe to the channel and dispatch notifications."""
+        pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(settings.APP_CONFIG_CHANNEL)
+            self.subscribed.set()
+            while True:
+                message = pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is not None:
+                    for reference in json.loads(message["data"]):
+                        self.wake(reference)
+        finally:
+            pubsub.close()
+
+    def wake(self, reference: str) -> None:
+        """Wake the requests waiting for an app.
+
+        Args:
+            reference (str): The app reference or :data:`ALL_APPS`
+        """
+        with self.lock:
+            if reference == ALL_APPS:
+                # waiters of ALL_APPS (ie: the panic flag) are woken first, so the others see their change
+                events = list(self.waiters.get(ALL_APPS, ()))
+                events += [event for key, events in self.waiters.items() if key != ALL_APPS for event in events]
+            else:
+                events = list(self.waiters.get(reference, ()))
+        for event in events:
+            event.set()
+
+    @contextmanager
+    def wait_for(self, reference: str) -> Iterator[threading.Event]:
+        """Register a waiter for an app.
+
+        Args:
+            reference (str): The app reference
+
+        Yields:
+            threading.Event: Set when the app config changes
+        """
+        self.start()
+        event = self.add_waiter(reference)
+        try:
+            yield event
+        finally:
+            self.remove_waiter(reference, event)
+
+    def add_waiter(self, reference: str) -> threading.Event:
+        """Register a waiter for an app, until :meth:`remove_waiter` is called.
+
+        Args:
+            reference (str): The app reference or :data:`ALL_APPS`
+
+        Returns:
+            threading.Event: Set when the app config changes
+        """
+        event = threading.Event()
+        with self.lock:
+            self.waiters[reference].add(event)
+        return event
+
+    def remove_waiter(self, reference: str, event: threading.Event) -> None:
+        """Unregister a waiter.
+
+        Args:
+            reference (str): The app reference or :data:`ALL_APPS`
+            event (threading.Event): The event returned by :meth:`add_waiter`
+        """
+        with self.lock:
+            self.waiters[reference].discard(event)
+            if not self.waiters[reference]:
+                del self.waiters[reference]
@@ -0,0 +1,253 @@
+"""Panic.
+
+The panic flag is stored in the cache under :data:`settings.PANIC_KEY <controller.settings.PANIC_KEY>`.
+Each process keeps a copy for at most :data:`settings.PANIC_CACHE_TTL <controller.settings.PANIC_CACHE_TTL>`
+seconds, which bounds the delay before a change is seen everywhere.
+The copy is dropped as soon as the :class:`ConfigListener <controller.sentry.notifications.ConfigListener>`
+of the process receives the panic notification, so it is usually seen right away.
+
+Panic can also be scoped to some apps, see :class:`PanicScope <controller.sentry.choices.PanicScope>`.
+Scopes are stored in a Redis hash under :data:`settings.PANIC_SCOPES_KEY <controller.settings.PANIC_SCOPES_KEY>`,
+with fields like `ENV:prod`, and follow the same process local copy as the flag.
+"""
+import fnmatch
+import re
+import threading
+from time import monotonic
+from typing import TYPE_CHECKING, Iterable, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from controller.sentry.backends import get_redis
+from controller.sentry.choices import PanicScope
+from controller.sentry.notifications import ALL_APPS, ConfigListener, notify_panic
+from controller.sentry.utils import Singleton
+
+if TYPE_CHECKING:  # pragma: no cover
+    from django.http import HttpRequest
+
+
+def panic_scope_field(scope: PanicScope, value: str) -> str:
+    """Return the hash field of a panic scope.
+
+    Args:
+        scope (PanicScope): The scope
+        value (str): The env, command, sentry id or reference glob
+
+    Returns:
+        str: The field
+    """
+    return f"{scope}:{value}"
+
+
+class PanicScopes:
+    """Panic scopes, indexed to match an app reference without looping over them.
+
+    Attributes:
+        values (dict[PanicScope, set[str]]): The panicked values by scope
+        pattern (Optional[re.Pattern]): All the reference globs compiled at once
+    """
+
+    def __init__(self, fields: Iterable[str] = ()) -> None:
+        """Init PanicScopes.
+
+        Args:
+            fields (Iterable[str]): The hash fields, see :func:`panic_scope_field`
+        """
+        self.values: dict[PanicScope, set[str]] = {scope: set() for scope in PanicScope}
+        for field in fields:
+            scope, _, value = field.partition(":")
+            self.values[PanicScope(scope)].add(value)
+        globs = sorted(self.values[PanicScope.REFERENCE])
+        self.pattern = re.compile("|".join(map(fnmatch.translate, globs))) if globs else None
+
+    def match(self, reference: str) -> bool:
+        """Return True if an app is in a panic scope.
+
+        Args:
+            reference (str): The app reference, like `<sentry_id>_<env>_<command>`
+
+        Returns:
+            bool: Is the app panicked
+        """
+        parts = reference.split("_")
+        if len(parts) == 3:
+            sentry_id, env, command = parts
+            if any(
+                value in self.values[scope]
+                for scope, value in (
+                    (PanicScope.PROJECT, sentry_id),
+                    (PanicScope.ENV, env),
+                    (PanicScope.COMMAND, command),
+                )
+            ):
+                return True
+        return self.pattern is not None and self.pattern.match(reference) is not None
+
+    def __bool__(self) -> bool:
+        """Return True if any scope is panicked.
+
+        Returns:
+            bool: Has scopes
+        """
+        return any(self.values.values())
+
+
+class PanicState(metaclass=Singleton):
+    """Process local copy of the panic flag and scopes.
+
+    Attributes:
+        lock (threading.Lock): Lock protecting the copy
+        value (bool): The panic flag
+        scopes (PanicScopes): The panic scopes
+        expires_at (float): Monotonic time after which the flag is read again
+        changed (Optional[threading.Event]): Set by the listener when panic changes
+    """
+
+    def __init__(self) -> None:
+        """Init PanicState."""
+        self.lock = threading.Lock()
+        self.value = False
+        self.scopes = PanicScopes()
+        self.expires_at = 0.0
+        self.changed: Optional[threading.Event] = None
+
+    def get(self, reference: Optional[str] = None) -> bool:
+        """Get the panic flag, it is read from the cache when the copy expired or changed.
+
+        Args:
+            reference (Optional[str]): An app reference, also matched against the panic scopes
+
+        Returns:
+            bool: Is panic activated
+        """
+        with self.lock:
+            self.refresh()
+            return self.value or (reference is not None and self.scopes.match(reference))
+
+    @property
+    def has_scopes(self) -> bool:
+        """Is any panic scope activated, the scopes are read like the flag in :meth:`get`.
+
+        Returns:
+            bool: Has scopes
+        """
+        with self.lock:
+            self.refresh()
+            return bool(self.scopes)
+
+    def refresh(self) -> None:
+        """Read the flag and the scopes again when the copy expired or changed, the lock must be held."""
+        if self.changed is None:
+            self.changed = ConfigListener().add_waiter(ALL_APPS)
+        if self.changed.is_set() or monotonic() >= self.expires_at:
+            self.changed.clear()
+            # the listener is restarted if it died, ie: after a fork
+            ConfigListener().start()
+            self.value = bool(cache.get(settings.PANIC_KEY))
+            self.scopes = PanicScopes(field.decode() for field in get_redis().hgetall(settings.PANIC_SCOPES_KEY))
+            self.expires_at = monotonic() + settings.PANIC_CACHE_TTL
+
+    def invalidate(self) -> None:
+        """Drop the copy, the next :meth:`get` reads the cache."""
+        with self.lock:
+            self.expires_at = 0.0
+
+
+def get_panic(request: "Optional[HttpRequest]" = None) -> bool:
+    """Get the panic flag, it is read once per request.
+
+    Args:
+        request (Optional[HttpRequest]): The request remembering the flag
+
+    Returns:
+        bool: Is panic activated
+    """
+    if request is None:
+        return PanicState().get()
+    if not hasattr(request, "_panic"):
+        request._panic = PanicState().get()
+    return request._panic
+
+
+def get_app_panic(reference: str) -> bool:
+    """Get the panic flag of an app, either global or from a panic scope.
+
+    Args:
+        reference (str): The app reference
+
+    Returns:
+        bool: Is panic activated for the app
+    """
+    return PanicState().get(reference)
+
+
+def has_panic_scopes() -> bool:
+    """Return True if any panic scope is activated, from the process local copy.
+
+    Returns:
+        bool: Has scopes
+    """
+    return PanicState().has_scopes
+
+
+def set_panic(panic: bool) -> None:
+    """Activate or deactivate the panic mode, then notify every process.
+
+    Args:
+        panic (bool): Activate panic
+    """
+    if panic:
+        cache.set(settings.PANIC_KEY, True, timeout=None)
+    else:
+        cache.delete(settings.PANIC_KEY)
+    PanicState().invalidate()
+    notify_panic()
+
+
+def is_panic_activated(request: "HttpRequest") -> dict:
+    """This function return True if panic mode is activated.
+
+    Args:
+        request (HttpRequest): The request
+
+    Returns:
+        dict: The template context
+    """
+    return {"PANIC": get_panic(request)}
+
+
+def get_panic_scopes() -> dict[str, str]:
+    """Get the panic scopes, read from Redis.
+
+    Returns:
+        dict[str, str]: The activation date of each scope by hash field
+    """
+    return {field.decode(): date.decode() for field, date in get_redis().hgetall(settings.PANIC_SCOPES_KEY).items()}
+
+
+def add_panic_scope(scope: PanicScope, value: str) -> None:
+    """Activate the panic mode of a scope, then notify every process.
+
+    Args:
+        scope (PanicScope): The scope
+        value (str): The env, command, sentry id or reference glob
+    """
+    get_redis().hset(settings.PANIC_SCOPES_KEY, panic_scope_field(scope, value), timezone.now().isoformat())
+    PanicState().invalidate()
+    notify_panic()
+
+
+def remove_panic_scopes(fields: Iterable[str]) -> None:
+    """Deactivate the panic mode of scopes, then notify every process.
+
+    Args:
+        fields (Iterable[str]): The hash fields, see :func:`panic_scope_field`
+    """
+    fields = list(fields)
+    if fields:
+        get_redis().hdel(settings.PANIC_SCOPES_KEY, *fields)
+        PanicState().invalidate()
+        notify_panic()
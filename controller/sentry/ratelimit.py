@@ -0,0 +1,85 @@
+"""Sentry Rate Limit.
+
+All the workers share a budget of `settings.SENTRY_API_RATE_LIMIT` calls
+per window of `settings.SENTRY_API_RATE_LIMIT_WINDOW` seconds, counted in Redis.
+The budget also learns from the `x-sentry-rate-limit-*` headers of the responses:
+once Sentry reports an exhausted quota, every worker is blocked until its reset.
+
+A blocked call raises :class:`SentryRateLimitException <controller.sentry.exceptions.SentryRateLimitException>`,
+so tasks reschedule themselves instead of sleeping in a worker slot.
+"""
+from math import ceil
+from time import time
+from typing import Mapping, Optional
+
+from django.conf import settings
+
+from controller.sentry.backends import get_redis
+from controller.sentry.exceptions import SentryRateLimitException
+
+
+def blocked_key() -> str:
+    """Return the key of the date until which calls are blocked.
+
+    Returns:
+        str: The key
+    """
+    return f"{settings.SENTRY_RATE_LIMIT_KEY}:blocked"
+
+
+def acquire_call() -> None:
+    """Take one call from the shared budget.
+
+    Raises:
+        SentryRateLimitException: When the call must wait
+    """
+    now = time()
+    window = settings.SENTRY_API_RATE_LIMIT_WINDOW
+    key = f"{settings.SENTRY_RATE_LIMIT_KEY}:{int(now // window)}"
+
+    pipe = get_redis().pipeline()
+    pipe.get(blocked_key())
+    pipe.incr(key)
+    pipe.expire(key, window)
+    blocked_until, calls, _ = pipe.execute()
+
+    if blocked_until is not None and (retry_after := float(blocked_until) - now) > 0:
+        raise SentryRateLimitException(retry_after)
+    if calls > settings.SENTRY_API_RATE_LIMIT:
+        raise SentryRateLimitException(window - now % window)
+
+
+def block_until(timestamp: float) -> Optional[float]:
+    """Block all the calls until a date.
+
+    Args:
+        timestamp (float): The date, as a POSIX timestamp
+
+    Returns:
+        Optional[float]: Seconds until the date, None if it is already past
+    """
+    retry_after = timestamp - time()
+    if retry_after <= 0:
+        return None
+    get_redis().set(blocked_key(), timestamp, ex=ceil(retry_after))
+    return retry_after
+
+
+def learn_rate_limit(status_code: int, headers: Mapping[str, str]) -> None:
+    """Update the shared budget from a Sentry response.
+
+    Args:
+        status_code (int): The response status
+        headers (Mapping[str, str]): The response headers
+
+    Raises:
+        SentryRateLimitException: When the response is a 429 Too Many Requests
+    """
+    reset = headers.get("x-sentry-rate-limit-reset")
+    remaining = headers.get("x-sentry-rate-limit-remaining")
+    if status_code == 429:
+        if reset is None or (retry_after := block_until(float(reset))) is None:
+            retry_after = block_until(time() + settings.SENTRY_API_RATE_LIMIT_WINDOW)
+        raise SentryRateLimitException(retry_after)
+    if reset is not None and remaining is not None and int(remaining) <= 0:
+        block_until(float(reset))
@@ -1,8 +1,10 @@
 """Serializers."""
+from django.conf import settings
 from rest_framework import serializers
 
 from controller.sentry.choices import MetricType
 from controller.sentry.models import App
+from controller.sentry.utils import depth
 
 
 class AppSerializer(serializers.ModelSerializer):
@@ -30,3 +32,46 @@ class MetricSerializer(serializers.Serializer):
 
     type = serializers.ChoiceField(choices=MetricType.choices)
     data = serializers.JSONField()
+
+    def validate_data(self, value: dict) -> dict:
+        """Check that data is a dict of counters, or a dict of groups of counters.
+
+        Args:
+            value (dict): The data
+
+        Returns:
+            dict: The data
+
+        Raises:
+            ValidationError: if a counter is not an integer
+        """
+        groups = value.values() if depth(value) == 2 else [value]
+        for group in groups:
+            if not isinstance(group, dict) or not all(
+                isinstance(count, int) and not isinstance(count, bool) for count in group.values()
+            ):
+                raise serializers.ValidationError("data must be a dict of integer counters")
+        return value
+
+
+# pylint: disable=abstract-method
+class BulkAppSerializer(serializers.Serializer):
+    """Bulk App Serializer."""
+
+    references = serializers.ListField(
+        child=serializers.CharField(max_length=256),
+        allow_empty=False,
+        max_length=settings.APP_BULK_MAX_REFERENCES,
+    )
+
+
+# pylint: disable=abstract-method
+class WatchSerializer(serializers.Serializer):
+    """Watch Serializer."""
+
+    timeout = serializers.FloatField(
+        min_value=0,
+        max_value=settings.APP_WATCH_MAX_TIMEOUT,
+        default=settings.APP_WATCH_MAX_TIMEOUT,
+        help_text="Maximum time to wait for a new config, in seconds",
+    )
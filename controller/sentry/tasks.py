@@ -1,19 +1,37 @@
 """Tasks."""
-from datetime import timedelta
+import json
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
 from itertools import chain
+from time import monotonic
 from typing import Optional
 
-from celery import group, shared_task
+from celery import Task, group, shared_task
 from celery.utils.log import get_task_logger
 from dateutil import parser
 from django.conf import settings
-from django.db.models import Count, F
+from django.db import transaction
+from django.db.models import F, Sum
 from django.utils import timezone
 
 from controller.sentry.choices import EventType
+from controller.sentry.configs import delete_app_configs, store_app_configs
+from controller.sentry.deletion import delete_in_batches
 from controller.sentry.detector import SpikesDetector
-from controller.sentry.exceptions import SentryNoOutcomeException
-from controller.sentry.models import App, Event, Project
+from controller.sentry.exceptions import (
+    SentryNoOutcomeException,
+    SentryPartialStatsException,
+    SentryRateLimitException,
+)
+from controller.sentry.heartbeats import pop_heartbeats
+from controller.sentry.metrics import (
+    ack_metric_batch,
+    coalesce_metrics,
+    metric_fold_lock,
+    peek_metric_batch,
+)
+from controller.sentry.models import MERGER, App, Event, MetricBucket, Project
+from controller.sentry.throttling import apply_events
 from controller.sentry.webservices.sentry import PaginatedSentryClient
 
 LOGGER = get_task_logger(__name__)
@@ -23,38 +41,141 @@ LOGGER = get_task_logger(__name__)
 def populate_app() -> None:
     """This task is responsible for populating apps.
 
-    For each new app, link the associated project to the app.
+    For each app without project, link the associated project to the app.
+    New apps are linked as soon as they are created, this task catches up on the others.
 
     This task should be run regularly.
     """
-    apps = App.objects.filter(project__isnull=True)
-    for app in apps:
-        res = app.reference.split("_")
-        if len(res) == 3:
-            sentry_id, env, command = res
-            project, _ = Project.objects.get_or_create(sentry_id=sentry_id)
-            app = App.objects.filter(reference=app.reference).update(command=command, env=env, project=project)
+    App.link_projects(App.objects.filter(project__isnull=True).only("reference"))
+
+
+@shared_task()
+def flush_heartbeats() -> None:
+    """This task is responsible for flushing the buffered heartbeats.
+
+    Update the `last_seen` of all the apps seen since the last flush in one query.
+
+    This task should be run regularly.
+    """
+    heartbeats = pop_heartbeats()
+    if heartbeats:
+        apps = [App(reference=reference, last_seen=last_seen) for reference, last_seen in heartbeats.items()]
+        App.objects.bulk_update(apps, ["last_seen"])
+
+
+@shared_task()
+def fold_metrics() -> None:
+    """This task is responsible for folding the queued metrics into hourly buckets.
+
+    Drain the queue in batches of `settings.METRIC_FOLD_BATCH_SIZE` payloads.
+    The payloads of a batch are summed by app, then added to the buckets of the current hour
+    with one bulk update and one bulk insert. The apps rows are locked while merging so no count is lost.
+    A batch is removed from the queue only once committed, so it is folded again if the fold fails.
+    Nothing is done while another fold is running. No batch is started after
+    `settings.METRIC_FOLD_MAX_DURATION_SEC` seconds, so the fold ends while it still holds its lock
+    and the next fold carries on with the rest of the queue.
+
+    This task should be run regularly.
+    """
+    with metric_fold_lock() as acquired:
+        if not acquired:
+            LOGGER.info("Metrics are already being folded")
+            return
+        deadline = monotonic() + settings.METRIC_FOLD_MAX_DURATION_SEC
+        while monotonic() < deadline and (payloads := peek_metric_batch(settings.METRIC_FOLD_BATCH_SIZE)):
+            fold_metric_batch(payloads)
+            ack_metric_batch(len(payloads))
+
+
+def fold_metric_batch(payloads: list[dict]) -> None:
+    """Add a batch of payloads to the buckets of the current hour, in one transaction.
+
+    Args:
+        payloads (list[dict]): The payloads
+    """
+    metrics = coalesce_metrics(payloads)
+    hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+    with transaction.atomic():
+        App.objects.bulk_create([App(reference=reference) for reference in metrics], ignore_conflicts=True)
+        # lock the apps, so concurrent folds never race on the same buckets
+        locked = App.objects.select_for_update().filter(reference__in=metrics).order_by("reference")
+        list(locked.values_list("pk", flat=True))
+
+        buckets = {
+            (bucket.app_id, bucket.type, bucket.group, bucket.name): bucket
+            for bucket in MetricBucket.objects.filter(app__in=metrics, hour=hour)
+        }
+        updated, created = [], []
+        for reference, by_type in metrics.items():
+            for metric_type, data in by_type.items():
+                for metric_group, counters in data.items():
+                    for name, count in counters.items():
+                        if bucket := buckets.get((reference, metric_type, metric_group, name)):
+                            bucket.count += count
+                            updated.append(bucket)
+                        else:
+                            created.append(
+                                MetricBucket(
+                                    app_id=reference,
+                                    type=metric_type,
+                                    group=metric_group,
+                                    name=name,
+                                    hour=hour,
+                                    count=count,
+                                )
+                            )
+        MetricBucket.objects.bulk_update(updated, ["count"])
+        MetricBucket.objects.bulk_create(created)
+
+
+@shared_task()
+def rollup_old_metric_bucket() -> None:
+    """This task is responsible for rolling up old metric buckets.
+
+    Add the buckets older than `settings.METRIC_BUCKET_MAX_AGE_DAY` days to the all time
+    `wsgi_metrics`/`celery_metrics` of their app, then remove them.
+
+    This task should be run regularly.
+    """
+    period_end = timezone.now() - timedelta(days=settings.METRIC_BUCKET_MAX_AGE_DAY)
+    buckets = MetricBucket.objects.filter(hour__lt=period_end)
+    with transaction.atomic():
+        totals = buckets.values_list("app", "type", "group", "name").annotate(total=Sum("count"))
+        metrics: dict[str, dict[str, dict[str, dict[str, int]]]] = defaultdict(
+            lambda: defaultdict(lambda: defaultdict(dict))
+        )
+        for reference, metric_type, metric_group, name, total in totals:
+            metrics[reference][metric_type][metric_group][name] = total
+        if not metrics:
+            return
+
+        LOGGER.info("Rolling up metrics of %s apps", len(metrics))
+        apps = list(App.objects.select_for_update().filter(reference__in=metrics).order_by("reference"))
+        for app in apps:
+            for metric_type, data in metrics[app.reference].items():
+                MERGER[metric_type](app, data)
+        App.objects.bulk_update(apps, ["wsgi_metrics", "celery_metrics"])
+        buckets.delete()
 
 
 @shared_task()
 def prune_inactive_app() -> None:
     """This task is responsible for pruning apps and projects.
 
+    Flush the buffered heartbeats first, so an app seen recently is never pruned.
+
     For each app not seen in `settings.APP_AUTO_PRUNE_MAX_AGE_DAY` days, remove the app.
 
     For each project with no apps, remove the project.
 
+    Rows are deleted by batches, see :func:`delete_in_batches <controller.sentry.deletion.delete_in_batches>`.
+
     This task should be run regularly.
     """
+    flush_heartbeats()
     last_seen = timezone.now() - timedelta(days=settings.APP_AUTO_PRUNE_MAX_AGE_DAY)
-    apps = App.objects.filter(last_seen__lt=last_seen)
-    if apps_count := apps.count():
-        LOGGER.info("Pruning %s apps", apps_count)
-        apps.delete()
-    projects = Project.objects.annotate(apps_count=Count("apps")).filter(apps_count=0)
-    if projects_count := projects.count():
-        LOGGER.info("Pruning %s projects", projects_count)
-        projects.delete()
+    delete_in_batches(App.objects.filter(last_seen__lt=last_seen), on_batch=delete_app_configs)
+    delete_in_batches(Project.objects.filter(apps__isnull=True))
 
 
 @shared_task()
@@ -66,10 +187,7 @@ def prune_old_event() -> None:
     This task should be run regularly.
     """
     period_end = timezone.now() - timedelta(days=settings.EVENT_AUTO_PRUNE_MAX_AGE_DAY)
-    events = Event.objects.filter(timestamp__lt=period_end)
-    if events_count := events.count():
-        LOGGER.info("Pruning %s apps", events_count)
-        events.delete()
+    delete_in_batches(Event.objects.filter(timestamp__lt=period_end))
 
 
 @shared_task()
@@ -81,11 +199,17 @@ def close_window() -> None:
 
         * `active_sample_rate` to `default_sample_rate`
         * `active_window_end` to null
+        * `auto_throttled` to false
+
+    Then refresh the stored config of those apps.
 
     This task should be run regularly.
     """
     apps = App.objects.filter(active_window_end__lt=timezone.now())
-    apps.update(active_sample_rate=F("default_sample_rate"), active_window_end=None)
+    references = list(apps.values_list("reference", flat=True))
+    if references:
+        apps.update(active_sample_rate=F("default_sample_rate"), active_window_end=None, auto_throttled=False)
+        store_app_configs(App.objects.filter(reference__in=references))
 
 
 @shared_task()
@@ -93,62 +217,137 @@ def pull_sentry_project_slug() -> None:
     """This task is responsible for getting the project slug from Sentry API.
 
     For all projects without a `sentry_project_slug`.
-    Find their project slug and update the project
+    Find their project slug and update the project.
+    Nothing is fetched when every project has a slug, and pages stop as soon as all the slugs are found.
+    When the Sentry API is rate limited, the slugs found so far are saved and the task is not retried,
+    the next run looks for the others.
 
     This task should be run regularly.
     """
-    client = PaginatedSentryClient()
     projects = Project.objects.filter(sentry_project_slug__isnull=True)
-
     projects_by_id = {project.sentry_id: project for project in projects}
+    if not projects_by_id:
+        return
 
+    client = PaginatedSentryClient()
     modified_projects = []
-    for project in chain.from_iterable(client.list_projects()):
-        _id = project["id"]
-        if _id not in projects_by_id:
-            continue
-        projects_by_id[_id].sentry_project_slug = project["slug"]
-        modified_projects.append(projects_by_id[_id])
+    try:
+        for project in chain.from_iterable(client.list_projects(fields=("id", "slug"))):
+            _id = project["id"]
+            if _id not in projects_by_id:
+                continue
+            projects_by_id[_id].sentry_project_slug = project["slug"]
+            modified_projects.append(projects_by_id[_id])
+            if len(modified_projects) == len(projects_by_id):
+                break
+    except SentryRateLimitException as err:
+        LOGGER.info("Project slugs are pulled again on the next run: %s", err)
 
     Project.objects.bulk_update(modified_projects, ["sentry_project_slug"])
 
 
 @shared_task()
 def monitor_sentry_usage() -> None:
-    """This task is responsible for starting all the perform_detect tasks."""
-    projects = Project.objects.all()
-    group(perform_detect.s(p.sentry_id) for p in projects).delay()
+    """This task is responsible for starting all the perform_detect_batch tasks.
 
+    Projects are split in batches of `settings.SPIKE_DETECTION_BATCH_SIZE`.
+    """
+    sentry_ids = list(Project.objects.order_by("sentry_id").values_list("sentry_id", flat=True))
+    size = settings.SPIKE_DETECTION_BATCH_SIZE
+    group(perform_detect_batch.s(sentry_ids[i : i + size]) for i in range(0, len(sentry_ids), size)).delay()
 
-@shared_task()
-def perform_detect(sentry_id) -> None:
-    """This task is responsible for the spike detection.
 
-    Get stats for this project and run the spike detection algorithm
+def has_detection_state(project: Project) -> bool:
+    """Return True if the spike detection of a project can resume from its saved state.
+
+    The state is discarded when the `detection_param` of the project changed since it was saved.
 
     Args:
-        sentry_id (str): The sentry id of the project
+        project (Project): The project
+
+    Returns:
+        bool: Can resume
     """
-    client = PaginatedSentryClient()
-    project = Project.objects.get(sentry_id=sentry_id)
+    return project.detection_state is not None and project.detection_state["param"] == project.detection_param
 
-    stats = client.get_stats(project.sentry_id)
-    detector = SpikesDetector.from_project(project)
+
+def get_stats_start(project: Project) -> Optional[datetime]:
+    """Get the start of the stats to fetch for the spike detection.
+
+    When the detection can resume, only the intervals after the last processed one are fetched.
+
+    Args:
+        project (Project): The project
+
+    Returns:
+        Optional[datetime]: The start, None to fetch the whole stats period
+    """
+    if has_detection_state(project):
+        return parser.parse(project.detection_state["end"]) + timedelta(hours=1)
+    return None
+
+
+def get_stats_by_project(
+    client: PaginatedSentryClient, projects: list[Project]
+) -> tuple[dict[str, dict], Optional[SentryRateLimitException]]:
+    """Get the stats of many projects for the spike detection, grouped by start.
+
+    The fetching stops at the first rate limit, the stats fetched until then are returned anyway.
+
+    Args:
+        client (PaginatedSentryClient): The Sentry client
+        projects (list[Project]): The projects
+
+    Returns:
+        tuple[dict[str, dict], Optional[SentryRateLimitException]]: The stats by sentry id and the rate limit if any
+    """
+    sentry_ids_by_start = defaultdict(list)
+    for project in projects:
+        sentry_ids_by_start[get_stats_start(project)].append(project.sentry_id)
+    all_stats = {}
+    try:
+        for start, sentry_ids in sentry_ids_by_start.items():
+            all_stats.update(client.get_stats_by_project(sentry_ids, start=start))
+    except SentryPartialStatsException as err:
+        all_stats.update(err.stats)
+        return all_stats, err
+    except SentryRateLimitException as err:
+        return all_stats, err
+    return all_stats, None
+
+
+def get_complete_series(stats: dict) -> Optional[list[int]]:
+    """Get the series of the complete intervals of the stats.
+
+    The last interval is removed since the stats on the last hour are not complete.
+
+    Args:
+        stats (dict): The stats
+
+    Returns:
+        Optional[list[int]]: The series, None if there is no series with accepted outcome
+    """
     try:
-        res, dump = detector.compute_sentry(stats)
+        return SpikesDetector.get_series(stats)[:-1]
     except SentryNoOutcomeException:
-        return
+        return None
 
-    project.detection_result = dump
-    project.save()
 
-    # remove the last item since this stats on the last hour are not complete
-    res.popitem()
+def build_events(project: Project, res: OrderedDict, last_event: Optional[Event], previous_signal: int) -> list[Event]:
+    """Build the events of a detection result.
 
-    previous_signal = 0
-    events = []
-    last_event: Optional[Event] = project.events.last()
+    Events before `last_event` are ignored since they are already known.
 
+    Args:
+        project (Project): The project
+        res (OrderedDict): The annotated signal
+        last_event (Optional[Event]): The last known event of the project
+        previous_signal (int): The signal before the first interval
+
+    Returns:
+        list[Event]: The new events
+    """
+    events = []
     for date, signal in res.items():
         if previous_signal == signal:
             continue
@@ -162,8 +361,147 @@ def perform_detect(sentry_id) -> None:
         event_type = EventType.FIRING if previous_signal == 0 else EventType.DISCARD
         events.append(Event(type=event_type, project=project, timestamp=date))
         previous_signal = signal
+    return events
 
-    Event.objects.bulk_create(events)
+
+def apply_detection(
+    project: Project,
+    stats: dict,
+    series: list[int],
+    result: tuple[list[int], list[float], list[float]],
+    state: dict,
+    last_event: Optional[Event],
+) -> list[Event]:
+    """Update a project with a detection result and build the new events, nothing is saved.
+
+    When the detection resumed, the new results are appended to `detection_result`,
+    which keeps its length.
+
+    Args:
+        project (Project): The project
+        stats (dict): The stats
+        series (list[int]): The series of the complete intervals
+        result (tuple[list[int], list[float], list[float]]): Signal, avg filter and std filter
+        state (dict): The state of the detector after the last interval
+        last_event (Optional[Event]): The last known event of the project
+
+    Returns:
+        list[Event]: The new events
+    """
+    res, dump = SpikesDetector.annotate(stats, series, result)
+    previous_signal = 0
+    if has_detection_state(project):
+        previous_signal = project.detection_state["signal"]
+        if project.detection_result:
+            dump = (project.detection_result + dump)[-len(project.detection_result) :]
+
+    project.detection_result = dump
+    project.detection_state = {
+        "param": project.detection_param,
+        "end": next(reversed(res)),
+        "signal": result[0][-1],
+        "state": state,
+    }
+    events = build_events(project, res, last_event, previous_signal)
     if events:
         project.last_event = events[-1]
-        project.save()
+    return events
+
+
+@shared_task(bind=True, max_retries=None)
+def perform_detect(self: Task, sentry_id) -> None:
+    """This task is responsible for the spike detection.
+
+    Get stats for this project and run the spike detection algorithm.
+    The detection resumes from the saved state of the project, so only the new intervals are fetched
+    and processed. Everything is recomputed when the `detection_param` changed.
+    The apps of the project are throttled or restored following the new events,
+    see :mod:`controller.sentry.throttling`.
+    The task is retried later when the Sentry API is rate limited, as many times as needed.
+
+    Args:
+        self (Task): The task
+        sentry_id (str): The sentry id of the project
+    """
+    client = PaginatedSentryClient()
+    project = Project.objects.get(sentry_id=sentry_id)
+
+    try:
+        stats = client.get_stats(project.sentry_id, start=get_stats_start(project))
+    except SentryRateLimitException as err:
+        raise self.retry(countdown=err.retry_after)
+    if not (series := get_complete_series(stats)):
+        return
+
+    detector = SpikesDetector.from_project(project)
+    if has_detection_state(project):
+        result, state = detector.resume(series, project.detection_state["state"])
+    else:
+        result, state = detector.compute_with_state(series)
+
+    events = apply_detection(project, stats, series, result, state, project.events.last())
+    Event.objects.bulk_create(events)
+    project.save()
+    apply_events(events)
+
+
+@shared_task(bind=True, max_retries=None)
+def perform_detect_batch(self: Task, sentry_ids: list[str]) -> None:
+    """This task is responsible for the spike detection of many projects.
+
+    Get the stats of these projects with org-wide requests grouped by project,
+    then run the spike detection algorithm.
+    Projects with a saved state resume from it, the others are recomputed once for all the projects
+    sharing the same `detection_param`. Results are saved with one query for all the projects.
+    The apps of the projects are throttled or restored following the new events,
+    see :mod:`controller.sentry.throttling`.
+    When the Sentry API is rate limited, the projects already fetched are processed
+    and the task is retried later with the remaining ones only.
+
+    Args:
+        self (Task): The task
+        sentry_ids (list[str]): The sentry ids of the projects
+    """
+    client = PaginatedSentryClient()
+    projects = list(Project.objects.filter(sentry_id__in=sentry_ids))
+    last_events = {
+        event.project_id: event
+        for event in Event.objects.filter(project__in=projects).order_by("project", "-timestamp").distinct("project")
+    }
+
+    all_stats, rate_limit = get_stats_by_project(client, projects)
+
+    modified_projects, events = [], []
+    recomputed_by_param = defaultdict(list)
+    for project in projects:
+        if (stats := all_stats.get(project.sentry_id)) is None:
+            continue
+        if not (series := get_complete_series(stats)):
+            continue
+        if has_detection_state(project):
+            detector = SpikesDetector.from_project(project)
+            result, state = detector.resume(series, project.detection_state["state"])
+            events.extend(apply_detection(project, stats, series, result, state, last_events.get(project.sentry_id)))
+            modified_projects.append(project)
+        else:
+            recomputed_by_param[json.dumps(project.detection_param, sort_keys=True)].append((project, stats, series))
+
+    for recomputed in recomputed_by_param.values():
+        detector = SpikesDetector.from_project(recomputed[0][0])
+        results = detector.compute_many_with_state([series for _, _, series in recomputed])
+        for (project, stats, series), (result, state) in zip(recomputed, results):
+            events.extend(apply_detection(project, stats, series, result, state, last_events.get(project.sentry_id)))
+            modified_projects.append(project)
+
+    Event.objects.bulk_create(events)
+    Project.objects.bulk_update(modified_projects, ["detection_result", "detection_state", "last_event"])
+    apply_events(events)
+    connection_stats = client.get_connection_stats()
+    LOGGER.debug(
+        "Sentry API: %s requests sent over %s connections",
+        connection_stats["requests"],
+        connection_stats["connections"],
+    )
+    if rate_limit is not None:
+        remaining = [project.sentry_id for project in projects if project.sentry_id not in all_stats]
+        raise self.retry(args=(remaining,), countdown=rate_limit.retry_after)
@@ -1,8 +1,20 @@
 import pytest
+from django.core.cache import cache
 from django.core.management import call_command
 
+from controller.sentry.backends import get_redis
+from controller.sentry.panic import PanicState
+
 
 @pytest.fixture(scope="session")
 def django_db_setup(django_db_setup, django_db_blocker):
     with django_db_blocker.unblock():
         call_command("loadpermissions")
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    yield
+    cache.clear()
+    get_redis().flushdb()
+    PanicState().invalidate()
@@ -5,15 +5,26 @@ import pytest
 from django.conf import settings
 from django.contrib.admin.sites import site as default_site
 from django.contrib.auth.models import Group
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.utils import timezone
 from undecorated import undecorated
 
 from controller.sentry.admin import AppAdmin
-from controller.sentry.choices import EventType
+from controller.sentry.choices import EventType, MetricType, PanicScope
+from controller.sentry.configs import get_app_config, store_app_configs
 from controller.sentry.filters import IsSpammingListFilter
-from controller.sentry.forms import BumpForm, MetricForm
+from controller.sentry.forms import (
+    BumpForm,
+    MetricForm,
+    PanicScopeForm,
+    UnpanicScopeForm,
+)
 from controller.sentry.inlines import AppEventInline, ProjectEventInline
-from controller.sentry.models import App, Event, Project
+from controller.sentry.models import App, Event, MetricBucket, Project
+from controller.sentry.panic import add_panic_scope, get_panic_scopes
 
 
 class MockRequest:
@@ -48,7 +59,6 @@ def user_with_group(request, django_user_model, user_group):
 
 @pytest.fixture
 def client_with_user(client, user_with_group):
-
     client.force_login(user_with_group)
 
     return client
@@ -67,7 +77,7 @@ def admin_with_user(request, user_with_group):
     return admin_site, MockRequest(user_with_group)
 
 
-@patch("controller.sentry.admin.cache")
+@patch("controller.sentry.panic.cache")
 @pytest.mark.django_db
 @pytest.mark.parametrize(
     "user_group,panic,expected",
@@ -91,7 +101,7 @@ def test_app_admin_has_bump_perm(
     assert site.has_bump_sample_rate_permission(request) == expected
 
 
-@patch("controller.sentry.admin.cache")
+@patch("controller.sentry.panic.cache")
 @pytest.mark.django_db
 @pytest.mark.parametrize(
     "user_group,panic,expected",
@@ -115,7 +125,7 @@ def test_app_admin_has_panic_perm(
     assert site.has_panic_permission(request) == expected
 
 
-@patch("controller.sentry.admin.cache")
+@patch("controller.sentry.panic.cache")
 @pytest.mark.django_db
 @pytest.mark.parametrize(
     "user_group,panic,expected",
@@ -142,8 +152,8 @@ def test_app_admin_has_unpanic_perm(
 @pytest.mark.django_db
 @pytest.mark.parametrize("user_group", ["Developer"])
 @pytest.mark.admin_site(model_class=App)
-def test_app_admin_bump(request, admin_with_user):
-    app = App(reference="test", active_sample_rate=0.1, active_window_end=None)
+def test_app_admin_bump(request, admin_with_user, django_assert_num_queries):
+    app = App(reference="test", active_sample_rate=0.1, active_window_end=None, auto_throttled=True)
     app.save()
     form = BumpForm(
         {
@@ -156,16 +166,20 @@ def test_app_admin_bump(request, admin_with_user):
     assert form.is_valid()
     site, request = admin_with_user
     bump_sample_rate = undecorated(site.bump_sample_rate)
-    bump_sample_rate(site, request, App.objects.filter(reference=app.reference), form=form)
+    store_app_configs([app])
+    with django_assert_num_queries(2):
+        bump_sample_rate(site, request, App.objects.filter(reference=app.reference), form=form)
     app.refresh_from_db()
     assert app.active_sample_rate == 0.5
     assert app.active_window_end is not None
+    assert not app.auto_throttled
+    assert get_app_config(app.reference)["config"]["active_sample_rate"] == 0.5
 
 
 @pytest.mark.django_db
 @pytest.mark.parametrize("user_group", ["Developer"])
 @pytest.mark.admin_site(model_class=App)
-def test_app_admin_metrics(request, admin_with_user):
+def test_app_admin_metrics(request, admin_with_user, django_assert_num_queries):
     app = App(wsgi_collect_metrics=False, celery_collect_metrics=False)
     app.save()
     form = MetricForm({"metrics": ["WSGI", "CELERY"]})
@@ -173,10 +187,12 @@ def test_app_admin_metrics(request, admin_with_user):
     assert form.is_valid()
     site, request = admin_with_user
     enable_disable_metrics = undecorated(site.enable_disable_metrics)
-    enable_disable_metrics(site, request, App.objects.filter(reference=app.reference), form=form)
+    with django_assert_num_queries(2):
+        enable_disable_metrics(site, request, App.objects.filter(reference=app.reference), form=form)
     app.refresh_from_db()
     assert app.wsgi_collect_metrics
     assert app.celery_collect_metrics
+    assert get_app_config(app.reference)["config"]["wsgi_collect_metrics"]
 
     form = MetricForm({"metrics": []})
     assert form.is_valid()
@@ -197,7 +213,7 @@ def test_app_admin_metrics(request, admin_with_user):
     assert not app.celery_collect_metrics
 
 
-@patch("controller.sentry.admin.cache")
+@patch("controller.sentry.panic.cache")
 @pytest.mark.django_db
 @pytest.mark.parametrize("user_group", ["Developer"])
 @pytest.mark.admin_site(model_class=App)
@@ -209,7 +225,7 @@ def test_app_admin_panic(cache: Mock, admin_with_user):
     cache.set.assert_called_once_with(settings.PANIC_KEY, True, timeout=None)
 
 
-@patch("controller.sentry.admin.cache")
+@patch("controller.sentry.panic.cache")
 @pytest.mark.django_db
 @pytest.mark.parametrize("user_group", ["Developer"])
 @pytest.mark.admin_site(model_class=App)
@@ -221,13 +237,13 @@ def test_app_admin_unpanic(cache: Mock, admin_with_user):
     cache.delete.assert_called_once_with(settings.PANIC_KEY)
 
 
-@patch("controller.sentry.admin.cache")
+@patch("controller.sentry.panic.cache")
 @pytest.mark.django_db
 @pytest.mark.parametrize(
     "user_group,panic,result",
     [
-        ("Owner", False, ["panic"]),
-        ("Admin", False, ["panic"]),
+        ("Owner", False, ["panic", "panic_scope"]),
+        ("Admin", False, ["panic", "panic_scope"]),
         ("Developer", False, []),
         ("Viewer", False, []),
         ("Owner", True, ["unpanic"]),
@@ -243,7 +259,46 @@ def test_app_admin_get_changelist_actions(cache: Mock, admin_with_user, result,
     assert site.get_changelist_actions(request) == result
 
 
-@patch("controller.sentry.admin.cache")
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "user_group,scoped,expected",
+    [
+        ("Owner", False, False),
+        ("Admin", False, False),
+        ("Owner", True, True),
+        ("Admin", True, True),
+        ("Developer", True, False),
+        ("Viewer", True, False),
+    ],
+)
+@pytest.mark.admin_site(model_class=App)
+def test_app_admin_has_unpanic_scope_perm(admin_with_user, scoped, expected):
+    site, request = admin_with_user
+    if scoped:
+        add_panic_scope(PanicScope.ENV, "prod")
+    assert site.has_unpanic_scope_permission(request) == expected
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("user_group", ["Owner"])
+@pytest.mark.admin_site(model_class=App)
+def test_app_admin_panic_scope(admin_with_user):
+    site, request = admin_with_user
+    form = PanicScopeForm({"scope": "ENV", "value": "prod"})
+    assert form.is_valid()
+    panic_scope = undecorated(site.panic_scope)
+    panic_scope(site, request, {}, form=form)
+    assert list(get_panic_scopes()) == ["ENV:prod"]
+    assert site.get_changelist_actions(request) == ["panic", "panic_scope", "unpanic_scope"]
+
+    form = UnpanicScopeForm({"scopes": ["ENV:prod"]})
+    assert form.is_valid()
+    unpanic_scope = undecorated(site.unpanic_scope)
+    unpanic_scope(site, request, {}, form=form)
+    assert get_panic_scopes() == {}
+
+
+@patch("controller.sentry.panic.cache")
 @pytest.mark.django_db
 @pytest.mark.parametrize(
     "user_group,panic,result",
@@ -265,15 +320,36 @@ def test_app_admin_get_change_actions(cache: Mock, admin_with_user, result, pani
     assert site.get_change_actions(request, None, None) == result
 
 
-@patch("controller.sentry.admin.invalidate_cache")
 @pytest.mark.django_db
 @pytest.mark.parametrize("user_group", ["Developer"])
 @pytest.mark.admin_site(model_class=App)
-def test_app_admin_save_model(invalidate_cache: Mock, admin_with_user):
+def test_app_admin_save_model(admin_with_user):
+    site, request = admin_with_user
+    app = App(reference="test", auto_throttled=True)
+    site.save_model(request, app, Mock(changed_data=["reference"]), None)
+    assert get_app_config("test")["config"]["active_sample_rate"] == app.active_sample_rate
+    assert App.objects.get(reference="test").auto_throttled
+
+    app.active_sample_rate = 0.9
+    site.save_model(request, app, Mock(changed_data=["active_sample_rate"]), None)
+    assert get_app_config("test")["config"]["active_sample_rate"] == 0.9
+    assert not App.objects.get(reference="test").auto_throttled
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("user_group", ["Owner"])
+@pytest.mark.admin_site(model_class=App)
+def test_app_admin_delete(admin_with_user):
     site, request = admin_with_user
-    app = App(reference="test")
-    site.save_model(request, app, None, None)
-    invalidate_cache.assert_called_once_with("/sentry/apps/test/")
+    apps = App.objects.bulk_create([App(reference="test1"), App(reference="test2"), App(reference="kept")])
+    store_app_configs(apps)
+
+    site.delete_model(request, apps[0])
+    assert get_app_config("test1") is None
+    site.delete_queryset(request, App.objects.filter(reference="test2"))
+    assert get_app_config("test2") is None
+    assert list(App.objects.values_list("reference", flat=True)) == ["kept"]
+    assert get_app_config("kept") is not None
 
 
 @pytest.mark.django_db
@@ -310,6 +386,7 @@ def test_app_get_event_status(admin_with_user):
     project.save()
     event = Event(project=project, type=EventType.DISCARD, timestamp=timezone.now())
     event.save()
+    project.last_event = event
     app = App(reference="abc", project=project)
     assert site.get_event_status(app) == '<b style="color:green;">No</b>'
 
@@ -317,10 +394,37 @@ def test_app_get_event_status(admin_with_user):
     project.save()
     event = Event(project=project, type=EventType.FIRING, timestamp=timezone.now())
     event.save()
+    project.last_event = event
     app = App(reference="abc", project=project)
     assert site.get_event_status(app) == '<b style="color:red;">Yes</b>'
 
 
+def create_apps_with_events(count: int, offset: int = 0) -> None:
+    for i in range(offset, offset + count):
+        project = Project.objects.create(sentry_id=str(i), sentry_project_slug=f"project-{i}")
+        project.last_event = Event.objects.create(project=project, type=EventType.FIRING, timestamp=timezone.now())
+        project.save()
+        App.objects.create(reference=f"{i}_env_command", project=project)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("user_group", ["Developer"])
+def test_app_changelist_constant_queries(client_with_user, user_with_group, django_assert_num_queries):
+    user_with_group.is_staff = True
+    user_with_group.save()
+    url = reverse("admin:sentry_app_changelist")
+    create_apps_with_events(5)
+    with CaptureQueriesContext(connection) as context:
+        response = client_with_user.get(url)
+    assert response.status_code == 200
+    assert response.content.count(b'style="color:red;">Yes</b>') == 5
+
+    create_apps_with_events(20, offset=5)
+    with django_assert_num_queries(len(context.captured_queries)):
+        response = client_with_user.get(url)
+    assert response.content.count(b'style="color:red;">Yes</b>') == 25
+
+
 @pytest.mark.django_db
 @pytest.mark.parametrize("user_group", ["Developer"])
 @pytest.mark.admin_site(model_class=App)
@@ -511,3 +615,36 @@ def test_project_admin_save_model(perform_detect: Mock, admin_with_user):
     perform_detect.reset_mock()
     site.save_model(request, project, None, None)
     perform_detect.delay.assert_not_called()
+
+
+@override_settings(METRIC_TOP_SIZE=2)
+@pytest.mark.django_db
+@pytest.mark.parametrize("user_group", ["Developer"])
+@pytest.mark.admin_site(model_class=App)
+def test_app_top_metrics(admin_with_user):
+    site, _ = admin_with_user
+    app = App.objects.create(reference="abc")
+    hour = timezone.now().replace(minute=0, second=0, microsecond=0)
+    MetricBucket.objects.bulk_create(
+        [
+            MetricBucket(app=app, type=MetricType.WSGI, group="path", name="/a", hour=hour, count=1),
+            MetricBucket(app=app, type=MetricType.WSGI, group="path", name="/b", hour=hour, count=3),
+            MetricBucket(app=app, type=MetricType.WSGI, group="path", name="/c", hour=hour, count=2),
+            MetricBucket(
+                app=app, type=MetricType.WSGI, group="path", name="/a", hour=hour - timedelta(hours=2), count=5
+            ),
+        ]
+    )
+
+    html = site.get_wsgi_top_metrics(app)
+    last_hour, last_day, last_week = html.split("<h4>")[1:]
+    assert "Last hour" in last_hour
+    assert "<td>/b</td><td>3</td>" in last_hour
+    assert "<td>/c</td><td>2</td>" in last_hour
+    assert "/a" not in last_hour
+    assert "<td>/a</td><td>6</td>" in last_day
+    assert "<td>/b</td><td>3</td>" in last_day
+    assert "/c" not in last_day
+    assert last_week.count("<tr>") == 3
+
+    assert site.get_celery_top_metrics(app).count("No metric") == 3
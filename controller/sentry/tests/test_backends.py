@@ -0,0 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+from django.test import override_settings
+from redis import Redis
+
+from controller.sentry.backends import LocalRedis, get_redis
+
+
+def test_get_redis_local():
+    assert isinstance(get_redis(), LocalRedis)
+    assert get_redis() is get_redis()
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": "redis://localhost"}}
+)
+def test_get_redis():
+    assert isinstance(get_redis(), Redis)
+
+
+def test_local_redis_hash():
+    redis = LocalRedis()
+    assert redis.hset("hash", "a", 1) == 1
+    assert redis.hset("hash", mapping={"a": 2, "b": "c"}) == 1
+    assert redis.hgetall("hash") == {b"a": b"2", b"b": b"c"}
+    assert redis.hgetall("missing") == {}
+    assert redis.hdel("hash", "a", "missing") == 1
+    assert redis.hgetall("hash") == {b"b": b"c"}
+    assert redis.hdel("missing", "a") == 0
+
+    assert redis.delete("hash", "missing") == 1
+    assert redis.hgetall("hash") == {}
+
+
+def test_local_redis_pipeline():
+    redis = LocalRedis()
+    redis.hset("hash", "a", b"1")
+
+    with redis.pipeline() as pipe:
+        pipe.hgetall("hash").delete("hash")
+        assert pipe.execute() == [{b"a": b"1"}, 1]
+        assert pipe.execute() == []
+
+
+def test_local_redis_concurrent_hset():
+    redis = LocalRedis()
+
+    def work(i):
+        redis.hset("hash", str(i), i)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(work, range(1000)))
+
+    assert len(redis.hgetall("hash")) == 1000
+
+
+def test_local_redis_pubsub():
+    redis = LocalRedis()
+    pubsub = redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe("channel")
+
+    assert redis.publish("other", "message") == 0
+    assert redis.publish("channel", "message") == 1
+    assert pubsub.get_message(timeout=1) == {
+        "type": "message",
+        "pattern": None,
+        "channel": b"channel",
+        "data": b"message",
+    }
+    assert pubsub.get_message() is None
+    assert pubsub.get_message(timeout=0.01) is None
+
+    pubsub.close()
+    assert redis.publish("channel", "message") == 0
+
+
+def test_local_redis_list():
+    redis = LocalRedis()
+    assert redis.rpush("list", "a", "b") == 2
+    assert redis.rpush("list", "c", "d") == 4
+    assert redis.lrange("list", 0, -1) == [b"a", b"b", b"c", b"d"]
+    assert redis.lrange("list", 1, 2) == [b"b", b"c"]
+    assert redis.lrange("list", -2, -1) == [b"c", b"d"]
+
+    assert redis.ltrim("list", 1, -2)
+    assert redis.lrange("list", 0, -1) == [b"b", b"c"]
+    assert redis.ltrim("list", 5, -1)
+    assert redis.lrange("list", 0, -1) == []
+    assert redis.delete("list") == 0
+
+
+@patch("controller.sentry.backends.monotonic")
+def test_local_redis_expire(mock_monotonic: MagicMock):
+    redis = LocalRedis()
+    mock_monotonic.return_value = 100
+
+    assert redis.get("key") is None
+    assert redis.set("key", 1.5, ex=10)
+    assert redis.get("key") == b"1.5"
+    assert redis.incr("counter") == 1
+    assert redis.incr("counter", 2) == 3
+    assert redis.expire("counter", 5)
+    assert not redis.expire("missing", 5)
+
+    mock_monotonic.return_value = 105
+    assert redis.get("key") == b"1.5"
+    assert redis.incr("counter") == 1
+    assert redis.set("key", "value")
+
+    mock_monotonic.return_value = 200
+    assert redis.get("key") == b"value"
+    assert redis.set("key", "value", ex=1)
+    assert redis.set("key", "other", nx=True) is None
+    assert redis.get("key") == b"value"
+    mock_monotonic.return_value = 201
+    assert redis.set("key", "other", nx=True)
+    assert redis.delete("key", "counter") == 2
+    assert redis.get("key") is None
@@ -0,0 +1,42 @@
+import pytest
+
+from controller.sentry.configs import (
+    app_config_key,
+    compute_etag,
+    delete_app_configs,
+    get_app_config,
+    store_app_configs,
+)
+from controller.sentry.models import App
+from controller.sentry.serializers import AppSerializer
+
+
+def test_app_config_key():
+    assert app_config_key("123_env_command") == "app:123_env_command"
+
+
+@pytest.mark.django_db
+def test_store_app_configs(django_assert_num_queries):
+    App.objects.bulk_create([App(reference="abc"), App(reference="def")])
+
+    with django_assert_num_queries(1) as queries:
+        configs = store_app_configs(App.objects.all())
+    assert "wsgi_metrics" not in queries.captured_queries[0]["sql"]
+
+    assert set(configs) == {"abc", "def"}
+    config = AppSerializer(App.objects.get(reference="abc")).data
+    assert get_app_config("abc") == {"etag": compute_etag(config), "config": config}
+    assert store_app_configs([]) == {}
+
+    delete_app_configs(["abc"])
+    delete_app_configs([])
+    assert get_app_config("abc") is None
+    assert get_app_config("def") is not None
+
+
+def test_compute_etag():
+    config = {"reference": "abc", "active_sample_rate": 0.1, "wsgi_ignore_path": ["/health"]}
+    etag = compute_etag(config)
+    assert etag == compute_etag(dict(reversed(config.items())))
+    assert etag != compute_etag({**config, "active_sample_rate": 0.2})
+    assert etag != compute_etag({**config, "wsgi_ignore_path": []})
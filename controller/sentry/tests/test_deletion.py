@@ -0,0 +1,94 @@
+from datetime import timedelta
+from unittest.mock import MagicMock, call, patch
+
+import pytest
+from django.db import transaction
+from django.utils import timezone
+
+from controller.sentry.choices import EventType
+from controller.sentry.deletion import delete_in_batches
+from controller.sentry.models import App, Event, MetricBucket, Project
+
+
+@patch("controller.sentry.deletion.sleep")
+@pytest.mark.django_db
+def test_delete_in_batches(sleep_mock: MagicMock, django_assert_num_queries):
+    App.objects.bulk_create([App(reference=f"app{i:02}") for i in range(25)] + [App(reference="kept")])
+    on_batch = MagicMock()
+
+    # 3 batches of select pks, savepoint, select apps, delete buckets, delete apps, release savepoint
+    with django_assert_num_queries(18):
+        deleted = delete_in_batches(
+            App.objects.filter(reference__startswith="app"), batch_size=10, pause=0.5, on_batch=on_batch
+        )
+
+    assert deleted == 25
+    assert list(App.objects.values_list("reference", flat=True)) == ["kept"]
+    assert on_batch.call_args_list == [
+        call([f"app{i:02}" for i in range(0, 10)]),
+        call([f"app{i:02}" for i in range(10, 20)]),
+        call([f"app{i:02}" for i in range(20, 25)]),
+    ]
+    assert sleep_mock.call_args_list == [call(0.5), call(0.5)]
+
+
+@patch("controller.sentry.deletion.sleep")
+@pytest.mark.django_db
+def test_delete_in_batches_exact_batches(sleep_mock: MagicMock):
+    App.objects.bulk_create([App(reference=f"app{i}") for i in range(4)])
+
+    assert delete_in_batches(App.objects.all(), batch_size=2) == 4
+    assert not App.objects.exists()
+    assert sleep_mock.call_count == 2
+
+
+@pytest.mark.django_db
+def test_delete_in_batches_nothing(django_assert_num_queries):
+    with django_assert_num_queries(1):
+        assert delete_in_batches(Event.objects.all()) == 0
+
+
+@pytest.mark.django_db
+def test_delete_in_batches_cascade():
+    project = Project.objects.create(sentry_id="123")
+    event = Event.objects.create(project=project, type=EventType.FIRING, timestamp=timezone.now())
+    Project.objects.filter(pk=project.pk).update(last_event=event)
+    app = App.objects.create(reference="app", project=project)
+    MetricBucket.objects.create(app=app, type="WSGI", group="path", name="/", hour=timezone.now(), count=1)
+
+    assert delete_in_batches(Event.objects.filter(timestamp__lt=timezone.now() + timedelta(days=1))) == 1
+    assert Project.objects.get(pk=project.pk).last_event is None
+
+    assert delete_in_batches(App.objects.all()) == 1
+    assert not MetricBucket.objects.exists()
+    assert Project.objects.get(pk=project.pk).apps.count() == 0
+
+
+@patch("controller.sentry.deletion.sleep")
+@pytest.mark.django_db
+def test_delete_in_batches_resume(sleep_mock: MagicMock):
+    App.objects.bulk_create([App(reference=f"app{i}") for i in range(6)])
+    sleep_mock.side_effect = [None, KeyboardInterrupt]
+
+    with pytest.raises(KeyboardInterrupt):
+        delete_in_batches(App.objects.all(), batch_size=2)
+    assert App.objects.count() == 2
+
+    sleep_mock.side_effect = None
+    assert delete_in_batches(App.objects.all(), batch_size=2) == 2
+    assert not App.objects.exists()
+
+
+@pytest.mark.django_db
+def test_delete_in_batches_recheck():
+    old = timezone.now() - timedelta(days=1)
+    App.objects.bulk_create([App(reference=f"app{i}", last_seen=old) for i in range(4)])
+    atomic = transaction.atomic
+
+    def seen_meanwhile(*args, **kwargs):
+        App.objects.filter(reference="app1").update(last_seen=timezone.now())
+        return atomic(*args, **kwargs)
+
+    with patch("controller.sentry.deletion.transaction.atomic", side_effect=seen_meanwhile):
+        assert delete_in_batches(App.objects.filter(last_seen__lt=timezone.now() - timedelta(hours=1))) == 3
+    assert list(App.objects.values_list("reference", flat=True)) == ["app1"]
@@ -1,8 +1,11 @@
 import json
+import random
+from unittest.mock import patch
 
 import pytest
 
-from controller.sentry.detector import SpikesDetector
+from benchmarks.detector import generate_series, legacy_compute
+from controller.sentry.detector import TOLERANCE, SpikesDetector
 from controller.sentry.exceptions import SentryNoOutcomeException
 from controller.sentry.models import Project
 
@@ -44,3 +47,122 @@ def test_spike_detector_empty():
 
     with pytest.raises(SentryNoOutcomeException):
         detector.compute_sentry({"groups": []})
+
+
+def assert_same_result(result: tuple, expected: tuple):
+    signal, avg_filter, std_filter = result
+    expected_signal, expected_avg_filter, expected_std_filter = expected
+    assert signal == expected_signal
+    assert avg_filter == pytest.approx(expected_avg_filter, rel=TOLERANCE)
+    assert std_filter == pytest.approx(expected_std_filter, rel=TOLERANCE)
+
+
+@pytest.mark.parametrize("influence", [0, 0.01, 0.5, 1])
+@pytest.mark.parametrize("length", [30 * 24, 90 * 24])
+def test_spike_detector_compute_legacy(influence: float, length: int):
+    detector = SpikesDetector(lag=48, threshold=5, influence=influence)
+    for seed in range(3):
+        series = generate_series(length, seed)
+        expected = legacy_compute(detector, series)
+        assert sum(expected[0]) > 0
+        assert_same_result(detector.compute(series), expected)
+
+
+@pytest.mark.parametrize("influence", [0, 1])
+def test_spike_detector_compute_flat_after_spike(influence: float):
+    detector = SpikesDetector(lag=48, threshold=5, influence=influence)
+    rng = random.Random(0)
+    # huge values leave the window, then the window is flat: the exact stdev is 0
+    series = [rng.randint(0, 10**6) for _ in range(48)] + [7] * 100 + [rng.randint(0, 100) for _ in range(60)]
+    expected = legacy_compute(detector, series)
+    assert expected[2][148] == 0
+
+    assert_same_result(detector.compute(series), expected)
+    assert_same_result(detector.compute_many([series, series[::-1]])[0], expected)
+
+
+def test_spike_detector_compute_fixture(all_json: tuple[dict]):
+    stats, _ = all_json
+    series = stats["groups"][0]["series"]["sum(quantity)"]
+    detector = SpikesDetector(lag=48, threshold=5, influence=0.01)
+    assert_same_result(detector.compute(series), legacy_compute(detector, series))
+
+
+def test_spike_detector_compute_many():
+    detector = SpikesDetector(lag=24, threshold=3, influence=0.5)
+    series = [generate_series(30 * 24, seed) for seed in range(5)]
+
+    results = detector.compute_many(series)
+    assert len(results) == len(series)
+    for result, data in zip(results, series):
+        assert_same_result(result, legacy_compute(detector, data))
+
+
+@pytest.mark.parametrize(
+    "series",
+    [
+        [generate_series(100, 0), generate_series(200, 1)],
+        [generate_series(20, 0)],
+        [],
+    ],
+)
+def test_spike_detector_compute_many_fallback(series: list[list[int]]):
+    detector = SpikesDetector(lag=24, threshold=3, influence=0.5)
+    assert detector.compute_many(series) == [detector.compute(data) for data in series]
+
+
+@patch("controller.sentry.detector.numpy", None)
+def test_spike_detector_compute_many_without_numpy():
+    detector = SpikesDetector(lag=24, threshold=3, influence=0.5)
+    series = [generate_series(100, 0), generate_series(100, 1)]
+    assert detector.compute_many(series) == [detector.compute(data) for data in series]
+
+
+@pytest.mark.parametrize("split", [48, 49, 100, 719])
+def test_spike_detector_resume(split: int):
+    detector = SpikesDetector(lag=48, threshold=5, influence=0.5)
+    series = generate_series(30 * 24)
+    expected = legacy_compute(detector, series)
+
+    (signal, avg_filter, std_filter), state = detector.compute_with_state(series[:split])
+    (new_signal, new_avg_filter, new_std_filter), _ = detector.resume(series[split:], state)
+    assert_same_result(
+        (signal + new_signal, avg_filter + new_avg_filter, std_filter + new_std_filter),
+        expected,
+    )
+
+
+def test_spike_detector_resume_from_many():
+    detector = SpikesDetector(lag=48, threshold=5, influence=0.5)
+    series = [generate_series(30 * 24, seed) for seed in range(3)]
+
+    for data, (_, state) in zip(series, detector.compute_many_with_state([data[:100] for data in series])):
+        (new_signal, new_avg_filter, new_std_filter), _ = detector.resume(data[100:], state)
+        signal, avg_filter, std_filter = legacy_compute(detector, data)
+        assert_same_result(
+            (new_signal, new_avg_filter, new_std_filter), (signal[100:], avg_filter[100:], std_filter[100:])
+        )
+
+
+def test_spike_detector_resume_hourly():
+    detector = SpikesDetector(lag=48, threshold=5, influence=1)
+    rng = random.Random(0)
+    # a year of hourly resumes, the window ends flat: the exact stdev is 0
+    series = [rng.randint(0, 10**6) for _ in range(365 * 24)] + [7] * 49
+
+    _, state = detector.compute_with_state(series[:48])
+    for item in series[48:]:
+        (_, avg_filter, std_filter), state = detector.resume([item], state)
+    assert avg_filter == [7]
+    assert std_filter == [0]
+
+
+def test_spike_detector_resume_legacy_state():
+    detector = SpikesDetector(lag=48, threshold=5, influence=0.5)
+    series = generate_series(30 * 24)
+    expected, state = detector.resume(series[100:], detector.compute_with_state(series[:100])[1])
+
+    # the sums saved by older versions are ignored, they are recomputed from the window
+    assert set(state) == {"window", "pending"}
+    state = {**detector.compute_with_state(series[:100])[1], "mean": 0.0, "squares": 1e12}
+    assert detector.resume(series[100:], state)[0] == expected
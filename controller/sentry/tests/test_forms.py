@@ -1,7 +1,9 @@
 import pytest
 from django.conf import settings
 
-from controller.sentry.forms import BumpForm
+from controller.sentry.choices import PanicScope
+from controller.sentry.forms import BumpForm, UnpanicScopeForm
+from controller.sentry.panic import add_panic_scope
 
 
 @pytest.mark.parametrize("sample_rate", [-1, 2, 5])
@@ -26,3 +28,11 @@ def test_bump_form_invalid_duration(duration):
     form = BumpForm(data)
     assert not form.is_valid()
     assert form.errors["duration"] == [f"duration must be between 0 and {settings.MAX_BUMP_TIME_SEC}"]
+
+
+def test_unpanic_scope_form():
+    add_panic_scope(PanicScope.COMMAND, "celery")
+    form = UnpanicScopeForm({"scopes": ["COMMAND:celery"]})
+    assert form.is_valid()
+    assert form.fields["scopes"].choices[0][0] == "COMMAND:celery"
+    assert not UnpanicScopeForm({"scopes": ["ENV:prod"]}).is_valid()
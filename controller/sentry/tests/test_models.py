@@ -1,5 +1,7 @@
+from datetime import datetime, timezone
+
 from controller.sentry.choices import MetricType
-from controller.sentry.models import App
+from controller.sentry.models import App, MetricBucket
 
 
 def test_app_model_str():
@@ -14,3 +16,34 @@ def test_app_model_merge():
     collect, metrics = app.get_metric(MetricType.CELERY)
     assert not collect
     assert metrics == {"task": {"test1": 5, "test": 6}}
+
+
+def test_app_model_merge_wsgi():
+    app = App(reference="abc")
+    app.merge({"type": MetricType.WSGI, "data": {"/test": 1}})
+    app.merge({"type": MetricType.WSGI, "data": {"path": {"/test": 1}}})
+    collect, metrics = app.get_metric(MetricType.WSGI)
+    assert not collect
+    assert metrics == {"path": {"/test": 2}}
+
+
+def test_app_model_merge_wsgi_flat():
+    app = App(reference="abc")
+    app.wsgi_metrics = {"/test": 1}
+    app.merge({"type": MetricType.WSGI, "data": {"path": {"/test": 1}}})
+    _, metrics = app.get_metric(MetricType.WSGI)
+    assert metrics == {"path": {"/test": 2}}
+
+
+def test_app_model_set_metric():
+    app = App(reference="abc")
+    assert App.metric_field(MetricType.WSGI) == "wsgi_collect_metrics"
+    app.set_metric(MetricType.WSGI, True)
+    assert app.get_metric(MetricType.WSGI)[0]
+    assert not app.get_metric(MetricType.CELERY)[0]
+
+
+def test_metric_bucket_model_str():
+    hour = datetime(2023, 1, 1, 10, tzinfo=timezone.utc)
+    bucket = MetricBucket(app_id="abc", type=MetricType.WSGI, group="path", name="/a", hour=hour)
+    assert str(bucket) == "MetricBucket<abc, WSGI, path, /a, 2023-01-01T10:00:00+00:00>"
@@ -0,0 +1,75 @@
+import json
+from threading import Event
+from unittest.mock import MagicMock, patch
+
+import pytest
+from django.conf import settings
+
+from controller.sentry.backends import get_redis
+from controller.sentry.notifications import (
+    ALL_APPS,
+    ConfigListener,
+    notify_app_configs,
+    notify_panic,
+)
+
+
+def test_notify_app_configs():
+    pubsub = get_redis().pubsub()
+    pubsub.subscribe(settings.APP_CONFIG_CHANNEL)
+
+    notify_app_configs([])
+    assert pubsub.get_message() is None
+
+    notify_app_configs(["a", "b"])
+    notify_panic()
+    assert json.loads(pubsub.get_message()["data"]) == ["a", "b"]
+    assert json.loads(pubsub.get_message()["data"]) == [ALL_APPS]
+    pubsub.close()
+
+
+def test_config_listener_wait_for():
+    listener = ConfigListener()
+    with listener.wait_for("a") as event_a, listener.wait_for("b") as event_b:
+        assert listener.subscribed.is_set()
+        with listener.wait_for("a") as other_event_a:
+            notify_app_configs(["a"])
+            assert event_a.wait(5)
+            assert other_event_a.wait(5)
+            assert not event_b.is_set()
+        assert listener.waiters["a"] == {event_a}
+
+        event_a.clear()
+        notify_panic()
+        assert event_a.wait(5)
+        assert event_b.wait(5)
+
+    assert "a" not in listener.waiters
+    assert "b" not in listener.waiters
+
+
+@patch("controller.sentry.notifications.time")
+def test_config_listener_reconnect(time_mock: MagicMock):
+    listener = ConfigListener()
+    event = Event()
+    listener.waiters["a"].add(event)
+    try:
+        with patch.object(listener, "listen", side_effect=[ConnectionError, KeyboardInterrupt]):
+            with pytest.raises(KeyboardInterrupt):
+                listener.run()
+    finally:
+        listener.waiters.pop("a")
+
+    # missed notifications wake every waiter
+    assert event.is_set()
+    time_mock.sleep.assert_called_once_with(1)
+
+
+@patch("controller.sentry.notifications.get_redis")
+def test_config_listener_listen_close(get_redis_mock: MagicMock):
+    pubsub = get_redis_mock.return_value.pubsub.return_value
+    pubsub.get_message.side_effect = [None, ConnectionError]
+    with pytest.raises(ConnectionError):
+        ConfigListener().listen()
+    pubsub.subscribe.assert_called_once_with(settings.APP_CONFIG_CHANNEL)
+    pubsub.close.assert_called_once_with()
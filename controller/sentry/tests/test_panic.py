@@ -0,0 +1,142 @@
+from unittest.mock import Mock, patch
+
+import pytest
+from django.conf import settings
+from django.core.cache import caches
+from django.test import override_settings
+
+from controller.sentry.choices import PanicScope
+from controller.sentry.notifications import notify_panic
+from controller.sentry.panic import (
+    PanicScopes,
+    PanicState,
+    add_panic_scope,
+    get_app_panic,
+    get_panic,
+    get_panic_scopes,
+    has_panic_scopes,
+    is_panic_activated,
+    panic_scope_field,
+    remove_panic_scopes,
+    set_panic,
+)
+
+
+class MockRequest:
+    pass
+
+
+@patch("controller.sentry.panic.cache")
+def test_is_panic_activated(cache: Mock):
+    cache.get.return_value = True
+    res = is_panic_activated(MockRequest())
+    assert res["PANIC"]
+
+    cache.get.return_value = False
+    PanicState().invalidate()
+    res = is_panic_activated(MockRequest())
+    assert not res["PANIC"]
+
+
+@patch("controller.sentry.panic.cache")
+def test_get_panic_once_per_request(cache: Mock):
+    cache.get.return_value = True
+    request = MockRequest()
+    assert get_panic(request)
+
+    cache.get.return_value = False
+    PanicState().invalidate()
+    assert get_panic(request)
+    assert not get_panic(MockRequest())
+    assert cache.get.call_count == 2
+
+
+@patch("controller.sentry.panic.cache")
+def test_panic_state_ttl(cache: Mock):
+    cache.get.return_value = True
+    assert get_panic()
+    cache.get.return_value = False
+    assert get_panic()
+    cache.get.assert_called_once_with(settings.PANIC_KEY)
+
+    with override_settings(PANIC_CACHE_TTL=0):
+        PanicState().invalidate()
+        assert not get_panic()
+        cache.get.return_value = True
+        assert get_panic()
+
+
+@patch("controller.sentry.panic.get_redis")
+def test_panic_state_has_scopes_ttl(get_redis: Mock):
+    get_redis.return_value.hgetall.return_value = {b"ENV:prod": b"2023-01-01T00:00:00+00:00"}
+    assert has_panic_scopes()
+    get_redis.return_value.hgetall.return_value = {}
+    assert has_panic_scopes()
+    assert get_app_panic("123_prod_wsgi")
+    get_redis.return_value.hgetall.assert_called_once_with(settings.PANIC_SCOPES_KEY)
+
+    PanicState().invalidate()
+    assert not has_panic_scopes()
+
+
+def test_set_panic():
+    assert not get_panic()
+    set_panic(True)
+    assert get_panic()
+    set_panic(False)
+    assert not get_panic()
+
+
+@pytest.mark.parametrize("panic", [True, False])
+def test_panic_state_notified(panic):
+    caches["default"].set(settings.PANIC_KEY, not panic)
+    assert get_panic() == (not panic)
+
+    # another process changes the flag
+    changed = PanicState().changed
+    caches["default"].set(settings.PANIC_KEY, panic)
+    notify_panic()
+    assert changed.wait(timeout=1)
+    assert get_panic() == panic
+
+
+@pytest.mark.parametrize(
+    "field,reference,expected",
+    [
+        ("ENV:prod", "123_prod_wsgi", True),
+        ("ENV:prod", "123_staging_wsgi", False),
+        ("COMMAND:celery", "123_prod_celery", True),
+        ("PROJECT:123", "123_prod_celery", True),
+        ("PROJECT:123", "1234_prod_celery", False),
+        ("REFERENCE:123_*", "123_prod_celery", True),
+        ("REFERENCE:*_celery", "123_prod_wsgi", False),
+        ("REFERENCE:abc*", "abcdef", True),
+        ("ENV:prod", "abcdef", False),
+    ],
+)
+def test_panic_scopes_match(field, reference, expected):
+    assert PanicScopes([field, "REFERENCE:other"]).match(reference) == expected
+    assert not PanicScopes().match(reference)
+
+
+def test_panic_scopes():
+    assert panic_scope_field(PanicScope.ENV, "prod") == "ENV:prod"
+    assert not get_app_panic("123_prod_wsgi")
+    assert not has_panic_scopes()
+
+    add_panic_scope(PanicScope.ENV, "prod")
+    add_panic_scope(PanicScope.REFERENCE, "456_*")
+    assert set(get_panic_scopes()) == {"ENV:prod", "REFERENCE:456_*"}
+    assert has_panic_scopes()
+    assert get_app_panic("123_prod_wsgi")
+    assert get_app_panic("456_staging_wsgi")
+    assert not get_app_panic("123_staging_wsgi")
+    assert not get_panic()
+
+    remove_panic_scopes(["ENV:prod", "missing"])
+    remove_panic_scopes([])
+    assert list(get_panic_scopes()) == ["REFERENCE:456_*"]
+    assert not get_app_panic("123_prod_wsgi")
+
+    set_panic(True)
+    assert get_app_panic("123_staging_wsgi")
@@ -0,0 +1,62 @@
+from datetime import timedelta
+from uuid import uuid4
+
+import pytest
+from django.db import connection
+from django.utils import timezone
+
+from controller.sentry.choices import EventType
+from controller.sentry.filters import IsSpammingListFilter
+from controller.sentry.models import App, Event, Project
+
+
+@pytest.fixture(autouse=True)
+def no_seqscan(db):
+    # test tables are tiny, a sequential scan would always win
+    with connection.cursor() as cursor:
+        cursor.execute("SET LOCAL enable_seqscan = off")
+
+
+def test_close_window_plan():
+    plan = App.objects.filter(active_window_end__lt=timezone.now()).explain()
+    assert "app_active_window_end_idx" in plan
+
+
+def test_prune_inactive_app_plan():
+    # batches of delete_in_batches
+    plan = App.objects.filter(last_seen__lt=timezone.now()).order_by("pk").values_list("pk")[:1000].explain()
+    assert "app_last_seen_idx" in plan
+
+
+def test_prune_old_event_plan():
+    # batches of delete_in_batches
+    plan = Event.objects.filter(timestamp__lt=timezone.now()).order_by("pk").values_list("pk")[:1000].explain()
+    assert "event_timestamp_idx" in plan
+
+
+def test_last_event_plan():
+    project = Project.objects.create(sentry_id="123")
+    Event.objects.create(project=project, type=EventType.FIRING, timestamp=timezone.now() - timedelta(hours=1))
+
+    # perform_detect
+    plan = project.events.order_by("-timestamp")[:1].explain()
+    assert "Index Scan Backward using event_project_timestamp_idx" in plan
+    assert "Sort" not in plan
+
+    # perform_detect_batch
+    plan = Event.objects.filter(project__in=[project]).order_by("project", "-timestamp").distinct("project").explain()
+    assert "event_project_timestamp_idx" in plan
+    assert "Sort" not in plan
+
+
+def test_is_spamming_plan():
+    queryset = IsSpammingListFilter(None, {"spamming": ["yes"]}, App, None).queryset(None, App.objects.all())
+    assert "sentry_event" in str(queryset.query)
+
+    # the join order depends on the table statistics, so each join is checked on its own
+    plan = Project.objects.filter(last_event_id=uuid4()).explain()
+    assert "sentry_project_last_event_id" in plan
+    assert "Index Cond: (last_event_id =" in plan
+    plan = App.objects.filter(project_id="123").explain()
+    assert "sentry_app_sentry_project_id" in plan
+    assert "Index Cond: ((project_id)::text =" in plan
@@ -0,0 +1,64 @@
+from time import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+from django.conf import settings
+from django.test import override_settings
+
+from controller.sentry.backends import get_redis
+from controller.sentry.exceptions import SentryRateLimitException
+from controller.sentry.ratelimit import (
+    acquire_call,
+    block_until,
+    blocked_key,
+    learn_rate_limit,
+)
+
+
+@override_settings(SENTRY_API_RATE_LIMIT=3, SENTRY_API_RATE_LIMIT_WINDOW=10)
+@patch("controller.sentry.ratelimit.time")
+def test_acquire_call_window(mock_time: MagicMock):
+    mock_time.return_value = 1004.0
+    for _ in range(3):
+        acquire_call()
+    with pytest.raises(SentryRateLimitException) as err:
+        acquire_call()
+    assert err.value.retry_after == 6
+
+    # The next window has a new budget
+    mock_time.return_value = 1010.0
+    acquire_call()
+
+
+def test_block_until():
+    assert block_until(time() - 1) is None
+    assert get_redis().get(blocked_key()) is None
+
+    assert 9 < block_until(time() + 10) <= 10
+    with pytest.raises(SentryRateLimitException) as err:
+        acquire_call()
+    assert 9 < err.value.retry_after <= 10
+
+
+def test_learn_rate_limit():
+    reset = str(time() + 10)
+    learn_rate_limit(200, {})
+    learn_rate_limit(200, {"x-sentry-rate-limit-reset": reset})
+    learn_rate_limit(200, {"x-sentry-rate-limit-reset": reset, "x-sentry-rate-limit-remaining": "5"})
+    acquire_call()
+
+    learn_rate_limit(200, {"x-sentry-rate-limit-reset": reset, "x-sentry-rate-limit-remaining": "0"})
+    with pytest.raises(SentryRateLimitException):
+        acquire_call()
+
+
+def test_learn_rate_limit_too_many_requests():
+    with pytest.raises(SentryRateLimitException) as err:
+        learn_rate_limit(429, {})
+    assert 0 < err.value.retry_after <= settings.SENTRY_API_RATE_LIMIT_WINDOW
+
+    with pytest.raises(SentryRateLimitException) as err:
+        learn_rate_limit(429, {"x-sentry-rate-limit-reset": str(time() + 30)})
+    assert 29 < err.value.retry_after <= 30
+    with pytest.raises(SentryRateLimitException):
+        acquire_call()
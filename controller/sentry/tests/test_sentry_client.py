@@ -1,11 +1,27 @@
-from datetime import datetime, timedelta
+import json
+import threading
+import time
+from contextlib import ExitStack
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import MagicMock, call, patch
 
 import pytest
 from django.conf import settings
+from django.test import override_settings
 from requests.exceptions import HTTPError
 
-from controller.sentry.webservices.sentry import BearerAuth, PaginatedSentryClient
+from controller.sentry.detector import SpikesDetector
+from controller.sentry.exceptions import (
+    SentryNoOutcomeException,
+    SentryPartialStatsException,
+    SentryRateLimitException,
+)
+from controller.sentry.webservices.sentry import (
+    BearerAuth,
+    PaginatedSentryClient,
+    decode_json,
+)
 
 
 class Response:
@@ -15,6 +31,10 @@ class Response:
         self.links = links if links else {}
         self.headers = headers if headers else {}
 
+    @property
+    def content(self):
+        return json.dumps(self.data).encode()
+
     def json(self):
         return self.data
 
@@ -23,6 +43,48 @@ class Response:
             raise HTTPError
 
 
+class StubHandler(BaseHTTPRequestHandler):
+    """Serve the queued responses of the server in order, with keep-alive."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):  # noqa: N802
+        self.server.requests.append((self.path, self.headers["Authorization"]))
+        self.server.request_headers.append(self.headers)
+        status, data, headers = self.server.responses.pop(0)
+        body = json.dumps(data).encode() if status != 304 else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(name="stub_server")
+def fixture_stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.requests = []
+    server.request_headers = []
+    server.responses = []
+    server.url = f"http://127.0.0.1:{server.server_port}/api/0/"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    client = PaginatedSentryClient()
+    host = client.host
+    client.host = server.url
+    yield server
+    client.host = host
+    client._session = None
+    server.shutdown()
+    server.server_close()
+
+
 def test_auth():
     auth = BearerAuth("my_token")
     request_mock = MagicMock()
@@ -31,15 +93,15 @@ def test_auth():
     request_mock.headers.__setitem__.assert_called_once_with("authorization", "Bearer my_token")
 
 
-@patch("controller.sentry.webservices.sentry.request")
+@patch("controller.sentry.webservices.sentry.Session.request")
 def test_client(mock_request: MagicMock):
     client = PaginatedSentryClient()
 
     res = client.list_projects()
     mock_request.assert_not_called()
     return_value = [
-        Response(200, [object(), object()], links={"next": {"results": True, "url": "http://next.sentry"}}),
-        Response(200, [object(), object()]),
+        Response(200, [{"id": "1"}, {"id": "2"}], links={"next": {"results": True, "url": "http://next.sentry"}}),
+        Response(200, [{"id": "3"}, {"id": "4"}]),
     ]
 
     mock_request.side_effect = return_value
@@ -47,34 +109,35 @@ def test_client(mock_request: MagicMock):
     for chunk, expected in zip(res, return_value):
         assert chunk == expected.data
 
-    call_1 = call("GET", "https://sentry.io/api/0/projects/", timeout=20, auth=client.auth, params=None)
-    call_2 = call("GET", "http://next.sentry", timeout=20, auth=client.auth, params=None)
+    call_1 = call("GET", "https://sentry.io/api/0/projects/", timeout=20, params=None, headers={})
+    call_2 = call("GET", "http://next.sentry", timeout=20, params=None, headers={})
     mock_request.assert_has_calls((call_1, call_2))
 
 
-@patch("controller.sentry.webservices.sentry.request")
+@patch("controller.sentry.webservices.sentry.Session.request")
 def test_client_rate_limited(mock_request: MagicMock):
     client = PaginatedSentryClient()
 
     res = client.list_projects()
     mock_request.assert_not_called()
     reset = datetime.now() + timedelta(seconds=5)
-    return_value = [
-        Response(429, [object(), object()], headers={"x-sentry-rate-limit-reset": reset.timestamp()}),
-        Response(500, [object(), object()]),
+    mock_request.side_effect = [
+        Response(429, {}, headers={"x-sentry-rate-limit-reset": reset.timestamp()}),
     ]
 
-    mock_request.side_effect = return_value
-
-    with pytest.raises(HTTPError):
+    with pytest.raises(SentryRateLimitException) as err:
         next(res)
+    assert 4 < err.value.retry_after <= 5
 
-    call_1 = call("GET", "https://sentry.io/api/0/projects/", timeout=20, auth=client.auth, params=None)
-    call_2 = call("GET", "https://sentry.io/api/0/projects/", timeout=20, auth=client.auth, params=None)
-    mock_request.assert_has_calls((call_1, call_2))
+    # Other calls are blocked until the reset, without calling Sentry
+    with pytest.raises(SentryRateLimitException):
+        client.get_stats("1234")
+    mock_request.assert_called_once_with(
+        "GET", "https://sentry.io/api/0/projects/", timeout=20, params=None, headers={}
+    )
 
 
-@patch("controller.sentry.webservices.sentry.request")
+@patch("controller.sentry.webservices.sentry.Session.request")
 def test_client_rate_limited_rest_in_past(mock_request: MagicMock):
     client = PaginatedSentryClient()
 
@@ -82,27 +145,48 @@ def test_client_rate_limited_rest_in_past(mock_request: MagicMock):
     mock_request.assert_not_called()
 
     reset = datetime.now() - timedelta(seconds=5)
-    return_value = [
-        Response(429, [object(), object()], headers={"x-sentry-rate-limit-reset": reset.timestamp()}),
-        Response(500, [object(), object()]),
+    mock_request.side_effect = [
+        Response(429, {}, headers={"x-sentry-rate-limit-reset": reset.timestamp()}),
     ]
 
-    mock_request.side_effect = return_value
-
-    with pytest.raises(HTTPError):
+    with pytest.raises(SentryRateLimitException) as err:
         next(res)
+    assert 0 < err.value.retry_after <= settings.SENTRY_API_RATE_LIMIT_WINDOW
 
-    call_1 = call("GET", "https://sentry.io/api/0/projects/", timeout=20, auth=client.auth, params=None)
-    call_2 = call("GET", "https://sentry.io/api/0/projects/", timeout=20, auth=client.auth, params=None)
-    mock_request.assert_has_calls((call_1, call_2))
+
+@patch("controller.sentry.webservices.sentry.Session.request")
+def test_client_rate_limit_exhausted(mock_request: MagicMock):
+    client = PaginatedSentryClient()
+    reset = datetime.now() + timedelta(seconds=5)
+    headers = {"x-sentry-rate-limit-remaining": "0", "x-sentry-rate-limit-reset": str(reset.timestamp())}
+    mock_request.side_effect = [Response(200, {"groups": []}, headers=headers)]
+
+    assert client.get_stats("1234") == {"groups": []}
+    with pytest.raises(SentryRateLimitException):
+        client.get_stats("5678")
+    mock_request.assert_called_once()
+
+
+@override_settings(SENTRY_API_RATE_LIMIT=2, SENTRY_API_RATE_LIMIT_WINDOW=60)
+@patch("controller.sentry.webservices.sentry.Session.request")
+def test_client_rate_limit_budget(mock_request: MagicMock):
+    client = PaginatedSentryClient()
+    mock_request.return_value = Response(200, {"groups": []})
+
+    client.get_stats("1")
+    client.get_stats("2")
+    with pytest.raises(SentryRateLimitException) as err:
+        client.get_stats("3")
+    assert 0 < err.value.retry_after <= 60
+    assert mock_request.call_count == 2
 
 
-@patch("controller.sentry.webservices.sentry.request")
+@patch("controller.sentry.webservices.sentry.Session.request")
 def test_client_get_stats(mock_request: MagicMock):
     client = PaginatedSentryClient()
 
     return_value = [
-        Response(200, object()),
+        Response(200, {"groups": []}),
     ]
     sentry_id = "1234"
     mock_request.side_effect = return_value
@@ -114,7 +198,7 @@ def test_client_get_stats(mock_request: MagicMock):
         "GET",
         f"https://sentry.io/api/0/organizations/{settings.SENTRY_ORGANIZATION_SLUG}/stats_v2/",
         timeout=20,
-        auth=client.auth,
+        headers={},
         params={
             "field": "sum(quantity)",
             "groupBy": ["category", "outcome"],
@@ -124,3 +208,288 @@ def test_client_get_stats(mock_request: MagicMock):
             "category": "transaction",
         },
     )
+
+
+@patch("controller.sentry.webservices.sentry.datetime")
+@patch("controller.sentry.webservices.sentry.Session.request")
+def test_client_get_stats_start(mock_request: MagicMock, mock_datetime: MagicMock):
+    client = PaginatedSentryClient()
+    now = datetime(2023, 2, 1, 18, 30, tzinfo=timezone.utc)
+    mock_datetime.now.return_value = now
+
+    mock_request.side_effect = [Response(200, {"groups": []})]
+    client.get_stats("1234", start=datetime(2023, 2, 1, 17, tzinfo=timezone.utc))
+
+    mock_request.assert_called_once_with(
+        "GET",
+        f"https://sentry.io/api/0/organizations/{settings.SENTRY_ORGANIZATION_SLUG}/stats_v2/",
+        timeout=20,
+        headers=None,
+        params={
+            "field": "sum(quantity)",
+            "groupBy": ["category", "outcome"],
+            "interval": "1h",
+            "project": "1234",
+            "start": "2023-02-01T17:00:00+00:00",
+            "end": "2023-02-01T18:30:00+00:00",
+            "category": "transaction",
+        },
+    )
+
+
+def test_client_session_per_process():
+    client = PaginatedSentryClient()
+    session = client.session
+    assert client.session is session
+    assert session.auth is client.auth
+    assert session.get_adapter("https://sentry.io").poolmanager.connection_pool_kw["maxsize"] == (
+        settings.SENTRY_API_POOL_SIZE
+    )
+
+    with patch("controller.sentry.webservices.sentry.os.getpid", return_value=-1):
+        assert client.session is not session
+
+
+def test_client_stub_keep_alive(stub_server):
+    client = PaginatedSentryClient()
+    next_url = f"{stub_server.url}projects/?cursor=1"
+    stub_server.responses = [
+        (200, [1, 2], {"Link": f'<{next_url}>; rel="next"; results="true"; cursor="1"'}),
+        (200, [3], {"Link": f'<{next_url}>; rel="next"; results="false"; cursor="2"'}),
+        (200, {"groups": []}, {}),
+    ]
+
+    assert list(client.list_projects()) == [[1, 2], [3]]
+    assert client.get_stats("1234") == {"groups": []}
+
+    assert [path.split("?")[0] for path, _ in stub_server.requests] == [
+        "/api/0/projects/",
+        "/api/0/projects/",
+        f"/api/0/organizations/{settings.SENTRY_ORGANIZATION_SLUG}/stats_v2/",
+    ]
+    assert all(auth == f"Bearer {settings.SENTRY_API_TOKEN}" for _, auth in stub_server.requests)
+    assert client.get_connection_stats() == {"requests": 3, "connections": 1}
+
+
+def test_client_stub_retry(stub_server):
+    client = PaginatedSentryClient()
+    stub_server.responses = [(503, {}, {}), (200, {"groups": []}, {})]
+
+    assert client.get_stats("1234") == {"groups": []}
+    assert len(stub_server.requests) == 2
+
+
+@override_settings(SENTRY_API_RETRIES=1)
+def test_client_stub_retry_exhausted(stub_server):
+    client = PaginatedSentryClient()
+    client._session = None
+    stub_server.responses = [(500, {}, {}), (500, {}, {})]
+
+    with pytest.raises(HTTPError):
+        client.get_stats("1234")
+    assert len(stub_server.requests) == 2
+
+
+def test_client_stub_rate_limited(stub_server):
+    client = PaginatedSentryClient()
+    reset = int((datetime.now(tz=timezone.utc) + timedelta(seconds=10)).timestamp())
+    stub_server.responses = [(429, {}, {"X-Sentry-Rate-Limit-Reset": str(reset)})]
+
+    with pytest.raises(SentryRateLimitException):
+        client.get_stats("1234")
+    with pytest.raises(SentryRateLimitException):
+        client.get_stats("1234")
+    assert len(stub_server.requests) == 1
+
+
+@override_settings(SENTRY_API_CONCURRENCY=2, SENTRY_STATS_CHUNK_SIZE=1)
+@patch.object(PaginatedSentryClient, "_PaginatedSentryClient__get_stats_chunk")
+def test_client_get_stats_by_project_concurrency(mock_get_stats_chunk: MagicMock):
+    client = PaginatedSentryClient()
+    lock = threading.Lock()
+    running, max_running = set(), []
+
+    def get_stats_chunk(sentry_ids, start):
+        with lock:
+            running.add(sentry_ids[0])
+            max_running.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.discard(sentry_ids[0])
+        return {"groups": [{"by": {"project": sentry_ids[0]}, "start": start}]}
+
+    mock_get_stats_chunk.side_effect = get_stats_chunk
+    start = datetime(2023, 2, 1, 17, tzinfo=timezone.utc)
+    sentry_ids = [str(i) for i in range(6)]
+
+    stats = client.get_stats_by_project(sentry_ids, start=start)
+    assert {sentry_id: stats[sentry_id]["groups"] for sentry_id in sentry_ids} == {
+        sentry_id: [{"by": {}, "start": start}] for sentry_id in sentry_ids
+    }
+    assert max(max_running) == 2
+
+
+@pytest.fixture(name="org_stats")
+def fixture_org_stats() -> dict:
+    with open("controller/sentry/tests/data/example-2/stats.json") as stats_file:
+        return json.load(stats_file)
+
+
+def test_client_split_stats(org_stats: dict):
+    with open("controller/sentry/tests/data/example-1/stats.json") as stats_file:
+        example = json.load(stats_file)
+
+    split = PaginatedSentryClient.split_stats(["1001", "1002", "1003", "1004"], org_stats)
+
+    assert list(split) == ["1001", "1002", "1003", "1004"]
+    assert split["1001"]["intervals"] == org_stats["intervals"]
+    assert split["1001"]["start"] == org_stats["start"]
+    assert SpikesDetector.get_series(split["1001"]) == SpikesDetector.get_series(example)
+    assert [group["by"] for group in split["1002"]["groups"]] == [
+        {"category": "transaction", "outcome": "filtered"},
+        {"category": "transaction", "outcome": "accepted"},
+    ]
+    assert SpikesDetector.get_series(split["1002"]) == org_stats["groups"][2]["series"]["sum(quantity)"]
+    with pytest.raises(SentryNoOutcomeException):
+        SpikesDetector.get_series(split["1003"])
+    assert split["1004"]["groups"] == []
+    assert "project" in org_stats["groups"][0]["by"]
+
+
+@override_settings(SENTRY_STATS_CHUNK_SIZE=2)
+@patch("controller.sentry.webservices.sentry.Session.request")
+def test_client_get_stats_by_project(mock_request: MagicMock, org_stats: dict):
+    client = PaginatedSentryClient()
+    mock_request.side_effect = lambda method, url, timeout, params, headers: Response(
+        200, {**org_stats, "groups": [g for g in org_stats["groups"] if str(g["by"]["project"]) in params["project"]]}
+    )
+
+    stats = client.get_stats_by_project(iter(["1001", "1002", "1003"]))
+
+    assert stats == PaginatedSentryClient.split_stats(["1001", "1002", "1003"], org_stats)
+    url = f"https://sentry.io/api/0/organizations/{settings.SENTRY_ORGANIZATION_SLUG}/stats_v2/"
+    params = {
+        "field": "sum(quantity)",
+        "groupBy": ["project", "category", "outcome"],
+        "interval": "1h",
+        "statsPeriod": settings.SENTRY_STATS_PERIOD,
+        "category": "transaction",
+    }
+    mock_request.assert_has_calls(
+        [
+            call("GET", url, timeout=20, headers={}, params={**params, "project": ["1001", "1002"]}),
+            call("GET", url, timeout=20, headers={}, params={**params, "project": ["1003"]}),
+        ],
+        any_order=True,
+    )
+
+
+@pytest.mark.parametrize(
+    "error, raised",
+    [(SentryRateLimitException(12.5), SentryPartialStatsException), (HTTPError(), HTTPError)],
+)
+@override_settings(SENTRY_STATS_CHUNK_SIZE=2)
+@patch.object(PaginatedSentryClient, "_PaginatedSentryClient__get_stats_chunk")
+def test_client_get_stats_by_project_chunk_failed(
+    mock_get_stats_chunk: MagicMock, org_stats: dict, error: Exception, raised: type
+):
+    client = PaginatedSentryClient()
+
+    def get_stats_chunk(sentry_ids, start):
+        if "1001" not in sentry_ids:
+            raise error
+        return org_stats
+
+    mock_get_stats_chunk.side_effect = get_stats_chunk
+
+    with pytest.raises(raised) as exc_info:
+        client.get_stats_by_project(["1001", "1002", "1003"])
+
+    assert mock_get_stats_chunk.call_count == 2
+    if raised is SentryPartialStatsException:
+        assert exc_info.value.retry_after == 12.5
+        assert exc_info.value.stats == PaginatedSentryClient.split_stats(["1001", "1002"], org_stats)
+
+
+def test_client_stub_get_stats_by_project(stub_server, org_stats: dict):
+    client = PaginatedSentryClient()
+    stub_server.responses = [(200, org_stats, {})]
+
+    stats = client.get_stats_by_project(["1001", "1002"], start=datetime(2023, 2, 1, 17, tzinfo=timezone.utc))
+
+    assert set(stats) == {"1001", "1002"}
+    path = stub_server.requests[0][0]
+    assert "groupBy=project" in path
+    assert "project=1001&project=1002" in path
+    assert "start=2023-02-01T17%3A00%3A00%2B00%3A00" in path
+
+
+@patch("controller.sentry.webservices.sentry.time")
+@patch("controller.sentry.webservices.sentry.Session.request")
+def test_client_cache(mock_request: MagicMock, mock_time: MagicMock):
+    client = PaginatedSentryClient()
+    mock_time.return_value = 1000
+    first = [{"id": "1"}]
+    second = [{"id": "2"}]
+    mock_request.side_effect = [
+        Response(200, first, links={"next": {"results": "true", "url": "http://next.sentry"}}, headers={"ETag": "a"}),
+        Response(200, second, headers={"Last-Modified": "Wed, 01 Feb 2023 17:00:00 GMT"}),
+        Response(304, None),
+        Response(200, [{"id": "3"}]),
+        Response(200, {"groups": []}),
+    ]
+
+    assert list(client.list_projects()) == [first, second]
+    assert list(client.list_projects()) == [first, second]
+    assert mock_request.call_count == 2
+
+    mock_time.return_value = 1000 + settings.SENTRY_PROJECTS_CACHE_TTL
+    assert list(client.list_projects()) == [first, [{"id": "3"}]]
+    assert mock_request.call_args_list[2:] == [
+        call("GET", "https://sentry.io/api/0/projects/", timeout=20, params=None, headers={"If-None-Match": "a"}),
+        call(
+            "GET",
+            "http://next.sentry",
+            timeout=20,
+            params=None,
+            headers={"If-Modified-Since": "Wed, 01 Feb 2023 17:00:00 GMT"},
+        ),
+    ]
+    assert list(client.list_projects()) == [first, [{"id": "3"}]]
+
+    assert client.get_stats("1234") == {"groups": []}
+    assert client.get_stats("1234") == {"groups": []}
+    assert mock_request.call_count == 5
+
+
+def test_client_stub_cache_revalidation(stub_server):
+    client = PaginatedSentryClient()
+    stub_server.responses = [(200, [{"id": "1"}], {"ETag": '"v1"'}), (304, None, {"ETag": '"v1"'})]
+
+    with override_settings(SENTRY_PROJECTS_CACHE_TTL=0):
+        assert list(client.list_projects()) == [[{"id": "1"}]]
+        assert list(client.list_projects()) == [[{"id": "1"}]]
+
+    assert stub_server.request_headers[1]["If-None-Match"] == '"v1"'
+    assert client.get_connection_stats() == {"requests": 2, "connections": 1}
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_decode_json(use_orjson: bool):
+    content = json.dumps([{"id": "1", "slug": "a", "teams": [{"id": "t"}]}, {"id": "2"}]).encode()
+    with ExitStack() as stack:
+        if not use_orjson:
+            stack.enter_context(patch("controller.sentry.webservices.sentry.orjson", None))
+        assert decode_json(content) == json.loads(content)
+        assert decode_json(content, fields=("id", "slug")) == [{"id": "1", "slug": "a"}, {"id": "2"}]
+
+
+def test_client_stub_list_projects_fields(stub_server):
+    client = PaginatedSentryClient()
+    page = [{"id": "1", "slug": "a", "features": ["x"]}]
+    stub_server.responses = [(200, page, {}), (200, page, {})]
+
+    assert list(client.list_projects(fields=("id", "slug"))) == [[{"id": "1", "slug": "a"}]]
+    assert list(client.list_projects(fields=("id", "slug"))) == [[{"id": "1", "slug": "a"}]]
+    assert list(client.list_projects()) == [page]
+    assert len(stub_server.requests) == 2
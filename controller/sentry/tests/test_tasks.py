@@ -1,24 +1,45 @@
-from collections import OrderedDict
+import json
 from datetime import timedelta
+from typing import Optional
 from unittest.mock import MagicMock, call, patch
 
 import pytest
+from celery.exceptions import Retry
 from dateutil import parser
 from django.conf import settings
+from django.db import DatabaseError
+from django.test import override_settings
 from django.utils import timezone
 
-from controller.sentry.choices import EventType
-from controller.sentry.exceptions import SentryNoOutcomeException
-from controller.sentry.models import App, Event, Project
+from controller.sentry.choices import EventType, MetricType
+from controller.sentry.configs import get_app_config, store_app_configs
+from controller.sentry.detector import TOLERANCE, SpikesDetector
+from controller.sentry.exceptions import (
+    SentryPartialStatsException,
+    SentryRateLimitException,
+)
+from controller.sentry.heartbeats import pop_heartbeats, record_heartbeats
+from controller.sentry.metrics import (
+    coalesce_metrics,
+    enqueue_metrics,
+    metric_fold_lock,
+    peek_metric_batch,
+)
+from controller.sentry.models import App, Event, MetricBucket, Project
 from controller.sentry.tasks import (
     close_window,
+    flush_heartbeats,
+    fold_metrics,
     monitor_sentry_usage,
     perform_detect,
+    perform_detect_batch,
     populate_app,
     prune_inactive_app,
     prune_old_event,
     pull_sentry_project_slug,
+    rollup_old_metric_bucket,
 )
+from controller.sentry.webservices.sentry import PaginatedSentryClient
 
 
 @pytest.mark.django_db
@@ -30,8 +51,10 @@ def test_prune_inactive_app():
 
     app.last_seen = timezone.now() - timedelta(days=settings.APP_AUTO_PRUNE_MAX_AGE_DAY + 1)
     app.save()
+    store_app_configs([app])
     prune_inactive_app()
     assert not App.objects.filter(reference=app.reference).exists()
+    assert get_app_config(app.reference) is None
 
     project = Project(sentry_id="abc")
     project.save()
@@ -46,6 +69,36 @@ def test_prune_inactive_app():
     assert not Project.objects.filter(sentry_id=unlink_project.sentry_id).exists()
 
 
+@pytest.mark.django_db
+def test_prune_inactive_app_flush_heartbeats():
+    app = App(reference="abc", last_seen=timezone.now() - timedelta(days=settings.APP_AUTO_PRUNE_MAX_AGE_DAY + 1))
+    app.save()
+    record_heartbeats(app.reference)
+    prune_inactive_app()
+    assert App.objects.filter(reference=app.reference).exists()
+
+
+@pytest.mark.django_db
+def test_flush_heartbeats(django_assert_num_queries):
+    apps = App.objects.bulk_create([App(reference="abc"), App(reference="def"), App(reference="ghi")])
+    before = timezone.now()
+    record_heartbeats("abc", "def", "unknown")
+
+    with django_assert_num_queries(1):
+        flush_heartbeats()
+
+    assert pop_heartbeats() == {}
+    for app in apps:
+        app.refresh_from_db()
+    assert apps[0].last_seen >= before
+    assert apps[1].last_seen >= before
+    assert apps[2].last_seen is None
+    assert not App.objects.filter(reference="unknown").exists()
+
+    with django_assert_num_queries(0):
+        flush_heartbeats()
+
+
 @pytest.mark.django_db
 def test_prune_old_event():
     project = Project(sentry_id="123")
@@ -75,12 +128,16 @@ def test_close_window():
     assert app.active_sample_rate == 1
     assert app.active_window_end == tomorrow
 
-    app = App(reference="abc2", active_window_end=timezone.now(), active_sample_rate=1)
+    app = App(reference="abc2", active_window_end=timezone.now(), active_sample_rate=1, auto_throttled=True)
     app.save()
+    store_app_configs([app])
     close_window()
     app.refresh_from_db()
     assert app.active_sample_rate == app.default_sample_rate
     assert app.active_window_end is None
+    assert not app.auto_throttled
+    assert get_app_config(app.reference)["config"]["active_sample_rate"] == app.default_sample_rate
+    assert get_app_config("abc1") is None
 
 
 @patch("controller.sentry.tasks.PaginatedSentryClient")
@@ -88,16 +145,113 @@ def test_close_window():
 def test_pull_sentry_project_slug(client_mock: MagicMock):
     client_mock.return_value.list_projects.return_value = [
         [],
-        [{"id": "123", "slug": "test"}],
-        [{"id": "1235", "slug": "test2"}],
+        [{"id": "1235", "slug": "test2"}, {"id": "123", "slug": "test"}],
     ]
     project = Project(sentry_id="123")
     project.save()
+    Project.objects.create(sentry_id="456")
     pull_sentry_project_slug()
     client_mock.assert_called_once_with()
 
     project.refresh_from_db()
     assert project.sentry_project_slug == "test"
+    assert Project.objects.get(sentry_id="456").sentry_project_slug is None
+
+
+@patch("controller.sentry.tasks.PaginatedSentryClient")
+@pytest.mark.django_db
+def test_pull_sentry_project_slug_nothing_missing(client_mock: MagicMock, django_assert_num_queries):
+    Project.objects.create(sentry_id="123", sentry_project_slug="test")
+
+    with django_assert_num_queries(1):
+        pull_sentry_project_slug()
+    client_mock.assert_not_called()
+
+
+@patch("controller.sentry.tasks.PaginatedSentryClient")
+@pytest.mark.django_db
+def test_pull_sentry_project_slug_stop_paging(client_mock: MagicMock):
+    def list_projects(fields):
+        assert fields == ("id", "slug")
+        yield [{"id": "123", "slug": "test"}]
+        pytest.fail("Paging should stop once all slugs are found")
+
+    client_mock.return_value.list_projects.side_effect = list_projects
+    Project.objects.create(sentry_id="123")
+
+    pull_sentry_project_slug()
+    assert Project.objects.get(sentry_id="123").sentry_project_slug == "test"
+
+
+@patch("controller.sentry.tasks.PaginatedSentryClient")
+@pytest.mark.django_db
+def test_pull_sentry_project_slug_rate_limited(client_mock: MagicMock):
+    def list_projects(fields):
+        yield [{"id": "123", "slug": "test"}]
+        raise SentryRateLimitException(12.5)
+
+    client_mock.return_value.list_projects.side_effect = list_projects
+    Project.objects.create(sentry_id="123")
+    Project.objects.create(sentry_id="456")
+
+    # not retried, the next run pulls the missing slugs
+    with patch.object(pull_sentry_project_slug, "retry") as retry_mock:
+        pull_sentry_project_slug()
+    retry_mock.assert_not_called()
+    assert Project.objects.get(sentry_id="123").sentry_project_slug == "test"
+    assert Project.objects.get(sentry_id="456").sentry_project_slug is None
+
+
+@pytest.mark.parametrize(
+    "task, args, method, retry_kwargs",
+    [
+        (perform_detect, ("123",), "get_stats", {}),
+        (perform_detect_batch, (["123"],), "get_stats_by_project", {"args": (["123"],)}),
+    ],
+)
+@patch("controller.sentry.tasks.PaginatedSentryClient")
+@pytest.mark.django_db
+def test_sentry_task_rate_limited(client_mock: MagicMock, task, args: tuple, method: str, retry_kwargs: dict):
+    Project.objects.create(sentry_id="123")
+    getattr(client_mock.return_value, method).side_effect = SentryRateLimitException(12.5)
+
+    with patch.object(task, "retry", side_effect=Retry) as retry_mock:
+        with pytest.raises(Retry):
+            task(*args)
+    retry_mock.assert_called_once_with(countdown=12.5, **retry_kwargs)
+
+
+@pytest.mark.parametrize(
+    "task, args, method, result",
+    [
+        (perform_detect, ("123",), "get_stats", {"groups": []}),
+        (perform_detect_batch, (["123"],), "get_stats_by_project", {"123": {"groups": []}}),
+    ],
+)
+@patch("controller.sentry.tasks.PaginatedSentryClient")
+@pytest.mark.django_db
+def test_sentry_task_rate_limited_repeatedly(client_mock: MagicMock, task, args: tuple, method: str, result):
+    Project.objects.create(sentry_id="123")
+    # more times than the default max retries of celery
+    getattr(client_mock.return_value, method).side_effect = [SentryRateLimitException(1)] * 5 + [result]
+
+    assert task.apply(args=args).successful()
+    assert getattr(client_mock.return_value, method).call_count == 6
+
+
+@patch.object(PaginatedSentryClient, "get_stats_by_project")
+@pytest.mark.django_db
+def test_perform_detect_batch_partially_rate_limited(get_stats_by_project: MagicMock, stats: dict):
+    Project.objects.create(sentry_id="fetched")
+    Project.objects.create(sentry_id="limited")
+    get_stats_by_project.side_effect = SentryPartialStatsException(12.5, {"fetched": stats})
+
+    with patch.object(perform_detect_batch, "retry", side_effect=Retry) as retry_mock:
+        with pytest.raises(Retry):
+            perform_detect_batch(["fetched", "limited"])
+    retry_mock.assert_called_once_with(args=(["limited"],), countdown=12.5)
+    assert Project.objects.get(sentry_id="fetched").detection_state is not None
+    assert Project.objects.get(sentry_id="limited").detection_state is None
 
 
 @pytest.mark.django_db
@@ -113,6 +267,25 @@ def test_populate_app():
     assert app.project.sentry_id == "123"
 
 
+@pytest.mark.django_db
+def test_populate_app_bulk(django_assert_num_queries):
+    Project.objects.create(sentry_id="1")
+    App.objects.create(reference="linked_env_command", project_id="1")
+    App.objects.bulk_create(
+        [App(reference=f"{i % 10}_env{i}_command") for i in range(100)] + [App(reference="wrong_reference")]
+    )
+
+    # apps, insert projects, update apps
+    with django_assert_num_queries(3):
+        populate_app()
+
+    assert Project.objects.count() == 10
+    assert App.objects.filter(project__isnull=True).count() == 1
+    app = App.objects.get(reference="2_env42_command")
+    assert (app.project_id, app.env, app.command) == ("2", "env42", "command")
+    assert App.objects.get(reference="linked_env_command").project_id == "1"
+
+
 @pytest.mark.django_db
 def test_populate_app_wrong_reference():
     app = App(reference="123_env")
@@ -125,30 +298,65 @@ def test_populate_app_wrong_reference():
     assert app.project is None
 
 
+@override_settings(SPIKE_DETECTION_BATCH_SIZE=2)
 @patch("controller.sentry.tasks.group")
-@patch("controller.sentry.tasks.perform_detect")
+@patch("controller.sentry.tasks.perform_detect_batch")
 @pytest.mark.django_db
-def test_monitor_sentry_usage(perform_detect_mock: MagicMock, group_mock: MagicMock):
-    project1 = Project(sentry_id="123")
-    project1.save()
-
-    project2 = Project(sentry_id="456")
-    project2.save()
+def test_monitor_sentry_usage(perform_detect_batch_mock: MagicMock, group_mock: MagicMock):
+    for sentry_id in ["123", "456", "789"]:
+        Project.objects.create(sentry_id=sentry_id)
 
     monitor_sentry_usage()
 
     group_mock.assert_called()
 
-    # force generator to call perform_detect_mock
+    # force generator to call perform_detect_batch_mock
     list(group_mock.call_args[0][0])
 
-    perform_detect_mock.s.assert_has_calls([call("123"), call("456")])
-
-
+    perform_detect_batch_mock.s.assert_has_calls([call(["123", "456"]), call(["789"])])
+
+
+def make_stats(intervals: list[str], series: Optional[list[int]] = None) -> dict:
+    return {
+        "intervals": intervals,
+        "groups": [
+            {
+                "by": {"category": "transaction", "outcome": "accepted"},
+                "series": {"sum(quantity)": series or [0] * len(intervals)},
+            }
+        ],
+    }
+
+
+def slice_stats(stats: dict, start: int, end: Optional[int] = None) -> dict:
+    return {
+        "intervals": stats["intervals"][start:end],
+        "groups": [
+            {"by": group["by"], "series": {"sum(quantity)": group["series"]["sum(quantity)"][start:end]}}
+            for group in stats["groups"]
+        ],
+    }
+
+
+@pytest.fixture(name="stats")
+def _stats() -> dict:
+    with open("controller/sentry/tests/data/example-1/stats.json") as stats_file:
+        return json.load(stats_file)
+
+
+@pytest.mark.parametrize(
+    "signals,new_events",
+    [
+        # the last item is not complete and never used
+        ([0, 1, 0, 1, 0, 0], 2),
+        ([0, 1, 0, 1, 0], 1),
+        ([0, 1, 0], 0),
+    ],
+)
+@patch.object(SpikesDetector, "compute_with_state")
 @patch("controller.sentry.tasks.PaginatedSentryClient")
-@patch("controller.sentry.tasks.SpikesDetector")
 @pytest.mark.django_db
-def test_perform_detect(spike_detector_mock: MagicMock, client_mock: MagicMock):
+def test_perform_detect(client_mock: MagicMock, compute_mock: MagicMock, signals: list[int], new_events: int):
     sentry_id = "123"
     project = Project(sentry_id=sentry_id)
     project.save()
@@ -156,145 +364,392 @@ def test_perform_detect(spike_detector_mock: MagicMock, client_mock: MagicMock):
     event = Event(project=project, type=EventType.DISCARD, timestamp=parser.parse("2023-02-01T17:00:00Z"))
     event.save()
 
-    result = object()
-    client_mock.return_value.get_stats.return_value = result
-
-    detector: MagicMock = spike_detector_mock.from_project.return_value
-    dump = {"test": "a"}
-    detector.compute_sentry.return_value = (
-        OrderedDict(
-            [
-                ("2023-02-01T15:00:00Z", 0),
-                ("2023-02-01T16:00:00Z", 1),
-                ("2023-02-01T17:00:00Z", 0),
-                ("2023-02-01T18:00:00Z", 1),
-                ("2023-02-01T19:00:00Z", 0),
-                ("2023-02-01T20:00:00Z", 0),
-            ]
-        ),
-        dump,
-    )
+    intervals = [f"2023-02-01T{hour}:00:00Z" for hour in range(15, 15 + len(signals))]
+    client_mock.return_value.get_stats.return_value = make_stats(intervals)
+    complete = signals[:-1]
+    compute_mock.return_value = ((complete, [0.0] * len(complete), [0.0] * len(complete)), {"window": []})
 
     perform_detect(sentry_id)
 
     client_mock.assert_called_once_with()
-    client_mock.return_value.get_stats.assert_called_once_with(sentry_id)
+    client_mock.return_value.get_stats.assert_called_once_with(sentry_id, start=None)
+    compute_mock.assert_called_once_with([0] * len(complete))
+
+    project.refresh_from_db()
+    assert project.events.exclude(reference=event.reference).count() == new_events
+    assert project.last_event == (project.events.last() if new_events else None)
+    assert project.detection_result == [[date, 0, signal, 0.0, 0.0] for date, signal in zip(intervals, complete)]
+    assert project.detection_state == {
+        "param": project.detection_param,
+        "end": intervals[-2],
+        "signal": complete[-1],
+        "state": {"window": []},
+    }
+
+
+@pytest.mark.parametrize("signals,throttled", [([0, 1, 1, 0], True), ([0, 1, 0, 0], False)])
+@override_settings(AUTO_THROTTLE=True, AUTO_THROTTLE_FACTOR=0.5)
+@patch.object(SpikesDetector, "compute_with_state")
+@patch("controller.sentry.tasks.PaginatedSentryClient")
+@pytest.mark.django_db
+def test_perform_detect_throttle(client_mock: MagicMock, compute_mock: MagicMock, signals: list[int], throttled: bool):
+    project = Project.objects.create(sentry_id="123")
+    App.objects.create(reference="123_prod_wsgi", project=project, default_sample_rate=0.2, active_sample_rate=0.2)
 
-    spike_detector_mock.from_project.assert_called_once_with(project)
+    intervals = [f"2023-02-01T{hour}:00:00Z" for hour in range(15, 15 + len(signals))]
+    client_mock.return_value.get_stats.return_value = make_stats(intervals)
+    complete = signals[:-1]
+    compute_mock.return_value = ((complete, [0.0] * len(complete), [0.0] * len(complete)), {"window": []})
 
-    detector.compute_sentry.assert_called_once_with(result)
+    perform_detect("123")
 
-    project.refresh_from_db()
-    assert project.events.exclude(reference=event.reference).count() == 2
-    assert project.last_event == project.events.last()
-    assert project.detection_result == dump
+    app = App.objects.get(reference="123_prod_wsgi")
+    assert app.active_sample_rate == (0.1 if throttled else 0.2)
+    assert (app.active_window_end is not None) == throttled
 
 
 @patch("controller.sentry.tasks.PaginatedSentryClient")
-@patch("controller.sentry.tasks.SpikesDetector")
 @pytest.mark.django_db
-def test_perform_detect_last_item_not_used(spike_detector_mock: MagicMock, client_mock: MagicMock):
+def test_perform_detect_no_data(client_mock: MagicMock):
     sentry_id = "123"
     project = Project(sentry_id=sentry_id)
     project.save()
 
-    event = Event(project=project, type=EventType.DISCARD, timestamp=parser.parse("2023-02-01T17:00:00Z"))
-    event.save()
-
-    result = object()
-    client_mock.return_value.get_stats.return_value = result
-
-    detector: MagicMock = spike_detector_mock.from_project.return_value
-    dump = {"test": "a"}
-    detector.compute_sentry.return_value = (
-        OrderedDict(
-            [
-                ("2023-02-01T15:00:00Z", 0),
-                ("2023-02-01T16:00:00Z", 1),
-                ("2023-02-01T17:00:00Z", 0),
-                ("2023-02-01T18:00:00Z", 1),
-                ("2023-02-01T19:00:00Z", 0),
-            ]
-        ),
-        dump,
-    )
+    client_mock.return_value.get_stats.return_value = {"groups": [], "intervals": []}
 
     perform_detect(sentry_id)
 
     client_mock.assert_called_once_with()
-    client_mock.return_value.get_stats.assert_called_once_with(sentry_id)
+    client_mock.return_value.get_stats.assert_called_once_with(sentry_id, start=None)
+
+    project.refresh_from_db()
+    assert project.events.count() == 0
+    assert project.detection_result is None
+    assert project.detection_state is None
+
 
-    spike_detector_mock.from_project.assert_called_once_with(project)
+def get_detection(sentry_id: str) -> tuple:
+    project = Project.objects.get(sentry_id=sentry_id)
+    events = [(event.type, event.timestamp) for event in project.events.all()]
+    return project.detection_result, events, project.last_event and project.last_event.timestamp
 
-    detector.compute_sentry.assert_called_once_with(result)
+
+def assert_same_detection(detection: tuple, expected: tuple):
+    result, events, last_event = detection
+    assert events == expected[1]
+    assert last_event == expected[2]
+    assert len(result) == len(expected[0])
+    for row, expected_row in zip(result, expected[0]):
+        assert row == pytest.approx(expected_row, rel=TOLERANCE)
+
+
+@patch("controller.sentry.tasks.PaginatedSentryClient")
+@pytest.mark.django_db
+def test_perform_detect_incremental(client_mock: MagicMock, stats: dict):
+    get_stats = client_mock.return_value.get_stats
+    Project.objects.create(sentry_id="full")
+    Project.objects.create(sentry_id="incremental")
+
+    get_stats.return_value = stats
+    perform_detect("full")
+    full = get_detection("full")
+    assert full[1]
+
+    # first run with the first 100 complete intervals
+    get_stats.return_value = slice_stats(stats, 0, 101)
+    perform_detect("incremental")
+    # then 2 complete intervals at a time
+    for start in range(100, len(stats["intervals"]) - 1, 2):
+        get_stats.reset_mock()
+        get_stats.return_value = slice_stats(stats, start, start + 3)
+        perform_detect("incremental")
+        get_stats.assert_called_once_with("incremental", start=parser.parse(stats["intervals"][start]))
+
+    result, events, last_event = get_detection("incremental")
+    assert len(result) == 100
+    assert_same_detection((result, events, last_event), (full[0][-100:], full[1], full[2]))
+
+    # nothing new
+    get_stats.return_value = slice_stats(stats, -1)
+    perform_detect("incremental")
+    assert get_detection("incremental") == (result, events, last_event)
+
+
+@patch("controller.sentry.tasks.PaginatedSentryClient")
+@pytest.mark.django_db
+def test_perform_detect_incremental_result_cleared(client_mock: MagicMock, stats: dict):
+    get_stats = client_mock.return_value.get_stats
+    project = Project.objects.create(sentry_id="123")
+    get_stats.return_value = slice_stats(stats, 0, 101)
+    perform_detect("123")
+    Project.objects.filter(sentry_id="123").update(detection_result=None)
+
+    get_stats.return_value = slice_stats(stats, 100, 103)
+    perform_detect("123")
 
     project.refresh_from_db()
-    assert project.events.exclude(reference=event.reference).count() == 1
-    assert project.last_event == project.events.last()
-    assert project.detection_result == dump
+    assert [row[0] for row in project.detection_result] == stats["intervals"][100:102]
 
 
 @patch("controller.sentry.tasks.PaginatedSentryClient")
-@patch("controller.sentry.tasks.SpikesDetector")
 @pytest.mark.django_db
-def test_perform_detect_no_new(spike_detector_mock: MagicMock, client_mock: MagicMock):
-    sentry_id = "123"
-    project = Project(sentry_id=sentry_id)
+def test_perform_detect_param_changed(client_mock: MagicMock, stats: dict):
+    get_stats = client_mock.return_value.get_stats
+    get_stats.return_value = stats
+    project = Project.objects.create(sentry_id="123")
+    perform_detect("123")
+
+    project.refresh_from_db()
+    project.detection_param = {**project.detection_param, "threshold": 3}
     project.save()
 
-    event = Event(project=project, type=EventType.DISCARD, timestamp=parser.parse("2023-02-01T17:00:00Z"))
-    event.save()
+    get_stats.reset_mock()
+    perform_detect("123")
+    get_stats.assert_called_once_with("123", start=None)
 
-    result = object()
-    client_mock.return_value.get_stats.return_value = result
-
-    detector: MagicMock = spike_detector_mock.from_project.return_value
-    dump = {"test": "a"}
-    detector.compute_sentry.return_value = (
-        OrderedDict(
-            [
-                ("2023-02-01T15:00:00Z", 0),
-                ("2023-02-01T16:00:00Z", 1),
-                ("2023-02-01T17:00:00Z", 0),
-            ]
-        ),
-        dump,
+    project.refresh_from_db()
+    assert project.detection_state["param"] == project.detection_param
+    assert len(project.detection_result) == len(stats["intervals"]) - 1
+
+
+@patch.object(PaginatedSentryClient, "get_stats_by_project")
+@patch.object(PaginatedSentryClient, "get_stats")
+@pytest.mark.django_db
+def test_perform_detect_batch(
+    get_stats: MagicMock, get_stats_by_project: MagicMock, stats: dict, django_assert_num_queries
+):
+    no_outcome = {"groups": [], "intervals": []}
+    other_param = {**settings.DEFAULT_SPIKE_DETECTION_PARAM, "threshold": 3}
+    get_stats.return_value = stats
+    get_stats_by_project.side_effect = lambda sentry_ids, start: {
+        sentry_id: no_outcome if sentry_id == "none" else stats for sentry_id in sentry_ids
+    }
+
+    Project.objects.create(sentry_id="single")
+    Project.objects.create(sentry_id="batch1")
+    Project.objects.create(sentry_id="batch2", detection_param=other_param)
+    Project.objects.create(sentry_id="single2", detection_param=other_param)
+    Project.objects.create(sentry_id="none")
+    known = Project.objects.create(sentry_id="known")
+    Event.objects.create(project=known, type=EventType.DISCARD, timestamp=parser.parse("2099-01-01T00:00:00Z"))
+
+    perform_detect("single")
+    perform_detect("single2")
+
+    # projects, last events, insert events, update projects
+    with django_assert_num_queries(4):
+        perform_detect_batch(["batch1", "batch2", "none", "known", "unknown"])
+
+    single, single2 = get_detection("single"), get_detection("single2")
+    assert single[1]
+    assert single[1] != single2[1]
+    assert_same_detection(get_detection("batch1"), single)
+    assert_same_detection(get_detection("batch2"), single2)
+
+    assert get_detection("none") == (None, [], None)
+    assert get_detection("known")[1:] == ([(EventType.DISCARD, parser.parse("2099-01-01T00:00:00Z"))], None)
+    assert get_detection("known")[0] is not None
+
+
+@patch.object(PaginatedSentryClient, "get_stats_by_project")
+@patch.object(PaginatedSentryClient, "get_stats")
+@pytest.mark.django_db
+def test_perform_detect_batch_incremental(get_stats: MagicMock, get_stats_by_project: MagicMock, stats: dict):
+    Project.objects.create(sentry_id="full")
+    Project.objects.create(sentry_id="incremental")
+    Project.objects.create(sentry_id="new")
+
+    get_stats.return_value = stats
+    perform_detect("full")
+
+    get_stats_by_project.return_value = {"incremental": slice_stats(stats, 0, 101)}
+    perform_detect_batch(["incremental"])
+    get_stats_by_project.reset_mock()
+    get_stats_by_project.side_effect = lambda sentry_ids, start: {
+        sentry_id: slice_stats(stats, 100) if start else stats for sentry_id in sentry_ids
+    }
+    perform_detect_batch(["incremental", "new"])
+    get_stats_by_project.assert_has_calls(
+        [call(["incremental"], start=parser.parse(stats["intervals"][100])), call(["new"], start=None)],
+        any_order=True,
     )
 
-    perform_detect(sentry_id)
+    full = get_detection("full")
+    assert_same_detection(get_detection("incremental"), (full[0][-100:], full[1], full[2]))
+    assert_same_detection(get_detection("new"), full)
 
-    client_mock.assert_called_once_with()
-    client_mock.return_value.get_stats.assert_called_once_with(sentry_id)
 
-    spike_detector_mock.from_project.assert_called_once_with(project)
+def test_record_heartbeats_empty():
+    record_heartbeats()
+    assert pop_heartbeats() == {}
 
-    detector.compute_sentry.assert_called_once_with(result)
 
-    project.refresh_from_db()
-    assert project.events.exclude(reference=event.reference).count() == 0
-    assert project.last_event is None
-    assert project.detection_result == dump
+def get_buckets() -> dict:
+    return {
+        (bucket.app_id, bucket.type, bucket.group, bucket.name): bucket.count for bucket in MetricBucket.objects.all()
+    }
 
 
-@patch("controller.sentry.tasks.PaginatedSentryClient")
-@patch("controller.sentry.tasks.SpikesDetector")
 @pytest.mark.django_db
-def test_perform_detect_no_data(spike_detector_mock: MagicMock, client_mock: MagicMock):
-    sentry_id = "123"
-    project = Project(sentry_id=sentry_id)
-    project.save()
+def test_fold_metrics(django_assert_num_queries):
+    app = App.objects.create(reference="abc", wsgi_metrics={"path": {"/a": 1}}, celery_metrics={"test": 2})
+    enqueue_metrics("abc", MetricType.WSGI, {"/a": 1, "/b": 1})
+    enqueue_metrics("abc", MetricType.WSGI, {"path": {"/a": 1}, "user_agent": {"curl": 3}})
+    enqueue_metrics("abc", MetricType.CELERY, {"test": 1})
+    enqueue_metrics("new", MetricType.CELERY, {"task": {"test": 1}})
+
+    # one batch: savepoint, create missing apps, lock, load buckets, insert buckets, release
+    with django_assert_num_queries(6):
+        fold_metrics()
+
+    assert get_buckets() == {
+        ("abc", "WSGI", "path", "/a"): 2,
+        ("abc", "WSGI", "path", "/b"): 1,
+        ("abc", "WSGI", "user_agent", "curl"): 3,
+        ("abc", "CELERY", "task", "test"): 1,
+        ("new", "CELERY", "task", "test"): 1,
+    }
+    # the all time metrics are only written by the rollup
+    app.refresh_from_db()
+    assert app.wsgi_metrics == {"path": {"/a": 1}}
+    assert App.objects.filter(reference="new").exists()
+    assert peek_metric_batch(10) == []
 
-    detector: MagicMock = spike_detector_mock.from_project.return_value
-    dump = {"test": "a"}
-    detector.compute_sentry.side_effect = SentryNoOutcomeException
+    with django_assert_num_queries(0):
+        fold_metrics()
 
-    perform_detect(sentry_id)
+    enqueue_metrics("abc", MetricType.WSGI, {"/a": 1, "/c": 1})
+    # savepoint, create missing apps, lock, load buckets, update buckets, insert buckets, release
+    with django_assert_num_queries(7):
+        fold_metrics()
+    buckets = get_buckets()
+    assert buckets[("abc", "WSGI", "path", "/a")] == 3
+    assert buckets[("abc", "WSGI", "path", "/c")] == 1
+    assert MetricBucket.objects.count() == 6
 
-    client_mock.assert_called_once_with()
-    client_mock.return_value.get_stats.assert_called_once_with(sentry_id)
 
-    spike_detector_mock.from_project.assert_called_once_with(project)
+@override_settings(METRIC_FOLD_BATCH_SIZE=2)
+@pytest.mark.django_db
+def test_fold_metrics_error():
+    for i in range(3):
+        enqueue_metrics("abc", MetricType.CELERY, {f"test{i}": 1})
 
-    project.refresh_from_db()
-    assert project.events.count() == 0
-    assert project.detection_result is None
+    # the second batch fails, the first one is committed and removed from the queue
+    with patch.object(MetricBucket.objects, "bulk_create", side_effect=[None, DatabaseError("deadlock")]):
+        with pytest.raises(DatabaseError):
+            fold_metrics()
+    assert peek_metric_batch(10) == [{"reference": "abc", "type": "CELERY", "data": {"test2": 1}}]
+
+    fold_metrics()
+    assert get_buckets() == {("abc", "CELERY", "task", "test2"): 1}
+    assert peek_metric_batch(10) == []
+
+
+@override_settings(METRIC_FOLD_BATCH_SIZE=1, METRIC_FOLD_MAX_DURATION_SEC=60)
+@patch("controller.sentry.tasks.monotonic")
+@pytest.mark.django_db
+def test_fold_metrics_max_duration(monotonic_mock: MagicMock):
+    for i in range(3):
+        enqueue_metrics("abc", MetricType.CELERY, {f"test{i}": 1})
+
+    # deadline, first batch, second batch after the deadline
+    monotonic_mock.side_effect = [0, 30, 61]
+    fold_metrics()
+    assert get_buckets() == {("abc", "CELERY", "task", "test0"): 1}
+    assert len(peek_metric_batch(10)) == 2
+
+    monotonic_mock.side_effect = None
+    monotonic_mock.return_value = 0
+    fold_metrics()
+    assert len(get_buckets()) == 3
+    assert peek_metric_batch(10) == []
+
+
+@pytest.mark.django_db
+def test_fold_metrics_locked():
+    enqueue_metrics("abc", MetricType.CELERY, {"test": 1})
+    with metric_fold_lock() as acquired:
+        assert acquired
+        fold_metrics()
+        assert len(peek_metric_batch(10)) == 1
+
+    fold_metrics()
+    assert get_buckets() == {("abc", "CELERY", "task", "test"): 1}
+
+
+@override_settings(METRIC_FOLD_BATCH_SIZE=2)
+@pytest.mark.django_db
+def test_fold_metrics_batches(django_assert_num_queries):
+    for _ in range(5):
+        enqueue_metrics("abc", MetricType.CELERY, {"test": 1})
+
+    with django_assert_num_queries(18):
+        fold_metrics()
+
+    assert get_buckets() == {("abc", "CELERY", "task", "test"): 5}
+
+
+@pytest.mark.django_db
+def test_fold_metrics_hourly():
+    with patch("controller.sentry.tasks.timezone.now", return_value=parser.parse("2023-01-01T10:59:00Z")):
+        enqueue_metrics("abc", MetricType.CELERY, {"test": 1})
+        fold_metrics()
+    with patch("controller.sentry.tasks.timezone.now", return_value=parser.parse("2023-01-01T11:00:00Z")):
+        enqueue_metrics("abc", MetricType.CELERY, {"test": 2})
+        fold_metrics()
+
+    assert list(MetricBucket.objects.order_by("hour").values_list("hour", "count")) == [
+        (parser.parse("2023-01-01T10:00:00Z"), 1),
+        (parser.parse("2023-01-01T11:00:00Z"), 2),
+    ]
+
+
+@pytest.mark.django_db
+def test_rollup_old_metric_bucket():
+    app = App.objects.create(reference="abc", wsgi_metrics={"path": {"/a": 1}})
+    other = App.objects.create(reference="other")
+    now = timezone.now()
+    old = now - timedelta(days=settings.METRIC_BUCKET_MAX_AGE_DAY + 1)
+    MetricBucket.objects.bulk_create(
+        [
+            MetricBucket(app=app, type=MetricType.WSGI, group="path", name="/a", hour=old, count=2),
+            MetricBucket(
+                app=app, type=MetricType.WSGI, group="path", name="/a", hour=old - timedelta(hours=1), count=3
+            ),
+            MetricBucket(app=app, type=MetricType.CELERY, group="task", name="test", hour=old, count=1),
+            MetricBucket(app=app, type=MetricType.WSGI, group="path", name="/b", hour=now, count=1),
+            MetricBucket(app=other, type=MetricType.WSGI, group="path", name="/a", hour=now, count=1),
+        ]
+    )
+
+    rollup_old_metric_bucket()
+
+    app.refresh_from_db()
+    assert app.wsgi_metrics == {"path": {"/a": 6}}
+    assert app.celery_metrics == {"task": {"test": 1}}
+    other.refresh_from_db()
+    assert other.wsgi_metrics is None
+    assert get_buckets() == {("abc", "WSGI", "path", "/b"): 1, ("other", "WSGI", "path", "/a"): 1}
+
+
+@pytest.mark.django_db
+def test_rollup_old_metric_bucket_nothing(django_assert_num_queries):
+    # savepoint, aggregate, release
+    with django_assert_num_queries(3):
+        rollup_old_metric_bucket()
+
+
+def test_coalesce_metrics():
+    payloads = [
+        {"reference": "abc", "type": "WSGI", "data": {"/a": 1}},
+        {"reference": "abc", "type": "WSGI", "data": {"path": {"/a": 2}, "user_agent": {"curl": 1}}},
+        {"reference": "abc", "type": "CELERY", "data": {"test": 1}},
+        {"reference": "def", "type": "CELERY", "data": {"task": {"test": 4}}},
+    ]
+    assert coalesce_metrics(payloads) == {
+        "abc": {
+            MetricType.WSGI: {"path": {"/a": 3}, "user_agent": {"curl": 1}},
+            MetricType.CELERY: {"task": {"test": 1}},
+        },
+        "def": {MetricType.CELERY: {"task": {"test": 4}}},
+    }
@@ -0,0 +1,146 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+import pytest
+from django.test import override_settings
+from django.utils import timezone
+
+from controller.sentry.choices import EventType
+from controller.sentry.configs import get_app_config, store_app_configs
+from controller.sentry.models import App, Event, Project
+from controller.sentry.throttling import (
+    apply_events,
+    restore_projects,
+    throttle_projects,
+    update_apps,
+)
+
+
+@pytest.fixture
+def apps():
+    Project.objects.bulk_create([Project(sentry_id="1"), Project(sentry_id="2")])
+    bumped_end = timezone.now() + timedelta(minutes=10)
+    apps = App.objects.bulk_create(
+        [
+            App(reference="1_prod_wsgi", project_id="1", default_sample_rate=0.5, active_sample_rate=0.5),
+            App(reference="1_prod_celery", project_id="1", default_sample_rate=0.2, active_sample_rate=0.2),
+            App(
+                reference="1_dev_wsgi",
+                project_id="1",
+                default_sample_rate=0.2,
+                active_sample_rate=0.9,
+                active_window_end=bumped_end,
+            ),
+            App(
+                reference="1_staging_wsgi",
+                project_id="1",
+                default_sample_rate=0.5,
+                active_sample_rate=0.1,
+                active_window_end=bumped_end,
+            ),
+            App(reference="2_prod_wsgi", project_id="2", default_sample_rate=0.5, active_sample_rate=0.5),
+        ]
+    )
+    store_app_configs(apps)
+    return apps
+
+
+def get_rates() -> dict[str, tuple[float, bool]]:
+    return {
+        app.reference: (app.active_sample_rate, app.active_window_end is not None)
+        for app in App.objects.order_by("reference")
+    }
+
+
+@pytest.mark.django_db
+@override_settings(AUTO_THROTTLE_FACTOR=0.1, AUTO_THROTTLE_DURATION_SEC=3600)
+def test_throttle_restore_projects(apps, django_assert_num_queries):
+    # select references, update apps, select configs
+    with django_assert_num_queries(3):
+        throttled = throttle_projects(["1"])
+
+    assert sorted(throttled) == ["1_prod_celery", "1_prod_wsgi"]
+    rates = get_rates()
+    assert rates["1_prod_wsgi"] == (pytest.approx(0.05), True)
+    assert rates["1_prod_celery"] == (pytest.approx(0.02), True)
+    # bumped up or down by a human, left as is
+    assert rates["1_dev_wsgi"] == (0.9, True)
+    assert rates["1_staging_wsgi"] == (0.1, True)
+    assert rates["2_prod_wsgi"] == (0.5, False)
+    assert sorted(App.objects.filter(auto_throttled=True).values_list("reference", flat=True)) == sorted(throttled)
+    assert get_app_config("1_prod_wsgi")["config"]["active_sample_rate"] == pytest.approx(0.05)
+    app = App.objects.get(reference="1_prod_wsgi")
+    assert app.active_window_end - timezone.now() == pytest.approx(timedelta(hours=1), abs=timedelta(minutes=1))
+
+    assert throttle_projects(["1"]) == []
+
+    with django_assert_num_queries(3):
+        restored = restore_projects(["1"])
+
+    assert sorted(restored) == ["1_prod_celery", "1_prod_wsgi"]
+    rates = get_rates()
+    assert rates["1_prod_wsgi"] == (0.5, False)
+    assert rates["1_prod_celery"] == (0.2, False)
+    assert rates["1_dev_wsgi"] == (0.9, True)
+    assert rates["1_staging_wsgi"] == (0.1, True)
+    assert not App.objects.filter(auto_throttled=True).exists()
+    assert get_app_config("1_prod_wsgi")["config"]["active_sample_rate"] == 0.5
+
+    with django_assert_num_queries(1):
+        assert restore_projects(["1"]) == []
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("enabled", [True, False])
+def test_apply_events(apps, enabled):
+    now = timezone.now()
+    events = [
+        Event(project_id="1", type=EventType.FIRING, timestamp=now - timedelta(hours=2)),
+        Event(project_id="1", type=EventType.DISCARD, timestamp=now - timedelta(hours=1)),
+        Event(project_id="1", type=EventType.FIRING, timestamp=now),
+        Event(project_id="2", type=EventType.FIRING, timestamp=now),
+    ]
+    with override_settings(AUTO_THROTTLE=enabled):
+        apply_events(events)
+        throttled = [reference for reference, (_, window) in get_rates().items() if window]
+        assert throttled == (
+            ["1_dev_wsgi", "1_prod_celery", "1_prod_wsgi", "1_staging_wsgi", "2_prod_wsgi"]
+            if enabled
+            else ["1_dev_wsgi", "1_staging_wsgi"]
+        )
+
+        apply_events([Event(project_id="1", type=EventType.DISCARD, timestamp=now)])
+        throttled = [reference for reference, (_, window) in get_rates().items() if window]
+        assert throttled == (
+            ["1_dev_wsgi", "1_staging_wsgi", "2_prod_wsgi"] if enabled else ["1_dev_wsgi", "1_staging_wsgi"]
+        )
+
+
+@pytest.mark.django_db
+@override_settings(AUTO_THROTTLE_FACTOR=0.1, AUTO_THROTTLE_DURATION_SEC=3600)
+def test_manual_bump_of_throttled_app(apps):
+    throttle_projects(["1"])
+    # a human bumps down a throttled app during the spike
+    App.objects.filter(reference="1_prod_wsgi").update(active_sample_rate=0.01, auto_throttled=False)
+
+    assert restore_projects(["1"]) == ["1_prod_celery"]
+    rates = get_rates()
+    assert rates["1_prod_wsgi"] == (0.01, True)
+    assert rates["1_prod_celery"] == (0.2, False)
+
+
+@pytest.mark.django_db
+def test_update_apps_recheck(apps):
+    queryset = App.objects.filter(project_id="1", active_window_end__isnull=True)
+    values_list = queryset.values_list
+
+    def bumped_meanwhile(*args, **kwargs):
+        references = list(values_list(*args, **kwargs))
+        App.objects.filter(reference="1_prod_wsgi").update(active_window_end=timezone.now())
+        return references
+
+    with patch.object(queryset, "values_list", side_effect=bumped_meanwhile):
+        update_apps(queryset, active_sample_rate=0.01)
+    rates = get_rates()
+    assert rates["1_prod_wsgi"] == (0.5, True)
+    assert rates["1_prod_celery"] == (0.01, False)
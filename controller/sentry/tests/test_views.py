@@ -1,12 +1,20 @@
-from collections import Counter
+from threading import Thread
+from time import monotonic, sleep
 from unittest.mock import Mock, patch
 
 import pytest
 from django.conf import settings
+from django.core.cache import cache
+from django.test import Client
 from django.urls import reverse
 
-from controller.sentry.choices import MetricType
-from controller.sentry.models import App
+from controller.sentry.choices import MetricType, PanicScope
+from controller.sentry.configs import get_app_config, store_app_configs
+from controller.sentry.heartbeats import pop_heartbeats
+from controller.sentry.models import App, MetricBucket
+from controller.sentry.notifications import notify_panic
+from controller.sentry.panic import add_panic_scope, set_panic
+from controller.sentry.tasks import fold_metrics
 
 
 @pytest.mark.django_db
@@ -21,7 +29,63 @@ def test_app_view_retrieve(client):
     assert not response.data["celery_collect_metrics"]
 
 
-@patch("controller.sentry.views.cache")
+@pytest.mark.django_db
+def test_app_view_retrieve_link_project(client):
+    response = client.get(reverse("sentry:apps-detail", kwargs={"pk": "123_env_command"}))
+    assert response.status_code == 200
+
+    app = App.objects.get(reference="123_env_command")
+    assert (app.project_id, app.env, app.command) == ("123", "env", "command")
+
+    App.objects.filter(reference="123_env_command").update(project=None)
+    cache.clear()
+    client.get(reverse("sentry:apps-detail", kwargs={"pk": "123_env_command"}))
+    assert App.objects.get(reference="123_env_command").project_id is None
+
+
+@pytest.mark.django_db
+def test_app_view_bulk_link_project(client):
+    url = reverse("sentry:apps-bulk")
+    response = client.post(url, {"references": ["1_env_a", "1_env_b", "other"]}, content_type="application/json")
+    assert response.status_code == 200
+
+    assert dict(App.objects.values_list("reference", "project_id")) == {"1_env_a": "1", "1_env_b": "1", "other": None}
+
+
+@pytest.mark.django_db
+def test_app_view_retrieve_heartbeat(client, django_assert_num_queries):
+    reference = "test"
+    App.objects.create(reference=reference)
+    url = reverse("sentry:apps-detail", kwargs={"pk": reference})
+
+    with django_assert_num_queries(1):
+        response = client.get(url)
+
+    assert response.status_code == 200
+    assert App.objects.get(reference=reference).last_seen is None
+    assert list(pop_heartbeats()) == [reference]
+
+
+@pytest.mark.django_db
+def test_app_view_retrieve_stored_config(client, django_assert_num_queries):
+    reference = "test"
+    url = reverse("sentry:apps-detail", kwargs={"pk": reference})
+    response = client.get(url)
+    assert response.status_code == 200
+    assert get_app_config(reference)["config"] == response.data
+
+    App.objects.filter(reference=reference).update(active_sample_rate=0.7)
+    with django_assert_num_queries(0):
+        response = client.get(url)
+    assert response.data["active_sample_rate"] == settings.DEFAULT_SAMPLE_RATE
+
+    store_app_configs(App.objects.filter(reference=reference))
+    with django_assert_num_queries(0):
+        response = client.get(url)
+    assert response.data["active_sample_rate"] == 0.7
+
+
+@patch("controller.sentry.panic.cache")
 @pytest.mark.django_db
 def test_app_view_retrieve_panic(cache: Mock, client):
     reference = "test"
@@ -34,6 +98,13 @@ def test_app_view_retrieve_panic(cache: Mock, client):
     cache.get.assert_called_once_with(settings.PANIC_KEY)
 
 
+def get_metrics(reference: str, metric_type: MetricType) -> dict:
+    metrics: dict = {}
+    for bucket in MetricBucket.objects.filter(app_id=reference, type=metric_type):
+        metrics.setdefault(bucket.group, {})[bucket.name] = bucket.count
+    return metrics
+
+
 @pytest.mark.django_db
 @pytest.mark.parametrize("metric,default_name", [(MetricType.WSGI, "path"), (MetricType.CELERY, "task")])
 def test_app_view_metrics(client, metric: MetricType, default_name: str):
@@ -42,10 +113,9 @@ def test_app_view_metrics(client, metric: MetricType, default_name: str):
     url = reverse("sentry:apps-metrics", kwargs={"pk": reference, "metric_name": metric.value})
 
     response = client.post(url, data, content_type="application/json")
-    assert response.status_code == 200, response.data
-    app = App.objects.get(reference=reference)
-    _, metric_data = app.get_metric(metric)
-    assert metric_data == {default_name: data["data"]}
+    assert response.status_code == 202, response.data
+    fold_metrics()
+    assert get_metrics(reference, metric) == {default_name: data["data"]}
 
 
 @pytest.mark.django_db
@@ -56,10 +126,9 @@ def test_app_view_metrics_new(client, metric: MetricType, default_name: str):
     url = reverse("sentry:apps-metrics", kwargs={"pk": reference, "metric_name": metric.value})
 
     response = client.post(url, data, content_type="application/json")
-    assert response.status_code == 200, response.data
-    app = App.objects.get(reference=reference)
-    _, metric_data = app.get_metric(metric)
-    assert metric_data == data["data"]
+    assert response.status_code == 202, response.data
+    fold_metrics()
+    assert get_metrics(reference, metric) == data["data"]
 
 
 @pytest.mark.django_db
@@ -75,10 +144,82 @@ def test_app_view_metrics_with_old_value(client, metric: MetricType, default_nam
     url = reverse("sentry:apps-metrics", kwargs={"pk": reference, "metric_name": metric.value})
 
     response = client.post(url, data, content_type="application/json")
-    assert response.status_code == 200, response.data
-    app = App.objects.get(reference=reference)
+    assert response.status_code == 202, response.data
+    fold_metrics()
+    assert get_metrics(reference, metric) == {default_name: metrics}
+    app.refresh_from_db()
     _, metric_data = app.get_metric(metric)
-    assert metric_data == {default_name: Counter(metrics) + Counter(metrics)}
+    assert metric_data == metrics
+
+
+@pytest.mark.django_db
+def test_app_view_scoped_panic(client):
+    add_panic_scope(PanicScope.ENV, "prod")
+    url = reverse("sentry:apps-bulk")
+    response = client.post(url, {"references": ["1_prod_wsgi", "1_dev_wsgi"]}, content_type="application/json")
+    assert response.status_code == 200
+    assert response.data["1_prod_wsgi"]["active_sample_rate"] == 0
+    assert response.data["1_dev_wsgi"]["active_sample_rate"] != 0
+
+    response = client.get(reverse("sentry:apps-detail", kwargs={"pk": "1_prod_wsgi"}))
+    assert response.data["active_sample_rate"] == 0
+    assert response.headers["ETag"].endswith('-panic"')
+    response = client.get(reverse("sentry:apps-detail", kwargs={"pk": "1_dev_wsgi"}))
+    assert response.data["active_sample_rate"] != 0
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "data",
+    [
+        {"test": "1"},
+        {"test": 1.5},
+        {"test": True},
+        {"path": {"test": "1"}},
+        {"path": {"test": 1}, "test": 1},
+        {"path": {"test": {"test": 1}}},
+        [1],
+    ],
+)
+def test_app_view_metrics_invalid(client, data):
+    url = reverse("sentry:apps-metrics", kwargs={"pk": "test", "metric_name": MetricType.WSGI.value})
+    response = client.post(url, {"type": MetricType.WSGI.value, "data": data}, content_type="application/json")
+    assert response.status_code == 400
+    fold_metrics()
+    assert not App.objects.exists()
+
+
+@pytest.mark.django_db
+def test_app_view_metrics_concurrent(client):
+    """Concurrent pushes from many workers of the same app must not lose any count."""
+    reference = "test"
+    workers, pushes = 8, 25
+    url = reverse("sentry:apps-metrics", kwargs={"pk": reference, "metric_name": MetricType.WSGI.value})
+    data = {"type": MetricType.WSGI.value, "data": {"path": {"/a": 1, "/b": 2}, "user_agent": {"test": 1}}}
+
+    def push():
+        worker_client = Client()
+        for _ in range(pushes):
+            assert worker_client.post(url, data, content_type="application/json").status_code == 202
+
+    def fold():
+        for _ in range(pushes):
+            fold_metrics()
+
+    threads = [Thread(target=push) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    # fold while workers are pushing
+    fold()
+    for thread in threads:
+        thread.join()
+    fold_metrics()
+
+    total = workers * pushes
+    assert get_metrics(reference, MetricType.WSGI) == {
+        "path": {"/a": total, "/b": 2 * total},
+        "user_agent": {"test": total},
+    }
 
 
 @pytest.mark.django_db
@@ -109,3 +250,180 @@ def test_app_view_put(client):
 def test_app_view_delete(client):
     response = client.delete("/sentry/apps/test/")
     assert response.status_code == 405
+
+
+@pytest.mark.django_db
+def test_app_view_bulk(client, django_assert_num_queries):
+    App.objects.create(reference="existing", active_sample_rate=0.5)
+    store_app_configs([App.objects.create(reference="stored", active_sample_rate=0.7)])
+    url = reverse("sentry:apps-bulk")
+    references = ["stored", "existing", "new", "stored"]
+
+    # one select and one insert
+    with django_assert_num_queries(2):
+        response = client.post(url, {"references": references}, content_type="application/json")
+
+    assert response.status_code == 200, response.data
+    assert list(response.data) == ["stored", "existing", "new"]
+    assert response.data["stored"]["active_sample_rate"] == 0.7
+    assert response.data["existing"]["active_sample_rate"] == 0.5
+    assert response.data["new"]["active_sample_rate"] == settings.DEFAULT_SAMPLE_RATE
+    assert App.objects.filter(reference="new").exists()
+    assert set(pop_heartbeats()) == {"stored", "existing", "new"}
+
+    with django_assert_num_queries(0):
+        response = client.post(url, {"references": references}, content_type="application/json")
+    assert list(response.data) == ["stored", "existing", "new"]
+
+
+@patch("controller.sentry.panic.cache")
+@pytest.mark.django_db
+def test_app_view_bulk_panic(cache: Mock, client):
+    cache.get.return_value = True
+    url = reverse("sentry:apps-bulk")
+    response = client.post(url, {"references": ["a", "b"]}, content_type="application/json")
+    assert response.status_code == 200
+    assert response.data["a"]["active_sample_rate"] == 0
+    assert response.data["b"]["active_sample_rate"] == 0
+    cache.get.assert_called_once_with(settings.PANIC_KEY)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "data",
+    [
+        {},
+        {"references": []},
+        {"references": ["a" * 257]},
+        {"references": ["a"] * (settings.APP_BULK_MAX_REFERENCES + 1)},
+    ],
+)
+def test_app_view_bulk_invalid(client, data):
+    url = reverse("sentry:apps-bulk")
+    response = client.post(url, data, content_type="application/json")
+    assert response.status_code == 400
+    assert not App.objects.exists()
+
+
+@pytest.mark.django_db
+def test_app_view_bulk_get(client):
+    response = client.get(reverse("sentry:apps-bulk"))
+    assert response.status_code == 405
+
+
+@pytest.mark.django_db
+def test_app_view_retrieve_etag(client, django_assert_num_queries):
+    reference = "test"
+    url = reverse("sentry:apps-detail", kwargs={"pk": reference})
+    response = client.get(url)
+    etag = response.headers["ETag"]
+    assert etag == f'"{get_app_config(reference)["etag"]}"'
+
+    with django_assert_num_queries(0):
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert not response.content
+
+    response = client.get(url, HTTP_IF_NONE_MATCH="*")
+    assert response.status_code == 304
+
+    response = client.get(url, HTTP_IF_NONE_MATCH='"other"')
+    assert response.status_code == 200
+
+    App.objects.filter(reference=reference).update(celery_collect_metrics=True)
+    store_app_configs(App.objects.filter(reference=reference))
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response.data["celery_collect_metrics"]
+    assert response.headers["ETag"] != etag
+
+
+@pytest.mark.django_db
+def test_app_view_retrieve_etag_panic(client):
+    reference = "test"
+    url = reverse("sentry:apps-detail", kwargs={"pk": reference})
+    etag = client.get(url).headers["ETag"]
+
+    set_panic(True)
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response.data["active_sample_rate"] == 0
+    panic_etag = response.headers["ETag"]
+    assert panic_etag != etag
+
+    assert client.get(url, HTTP_IF_NONE_MATCH=panic_etag).status_code == 304
+
+
+def delayed(function, *args, delay=0.1):
+    def work():
+        sleep(delay)
+        function(*args)
+
+    thread = Thread(target=work)
+    thread.start()
+    return thread
+
+
+@pytest.mark.django_db
+def test_app_view_watch(client):
+    reference = "test"
+    response = client.get(reverse("sentry:apps-watch", kwargs={"pk": reference}))
+    assert response.status_code == 200
+    assert response.data["active_sample_rate"] == settings.DEFAULT_SAMPLE_RATE
+
+
+@pytest.mark.django_db
+def test_app_view_watch_timeout(client):
+    reference = "test"
+    url = reverse("sentry:apps-watch", kwargs={"pk": reference})
+    etag = client.get(url).headers["ETag"]
+
+    start = monotonic()
+    response = client.get(url, {"timeout": 0.2}, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert monotonic() - start >= 0.2
+
+
+@pytest.mark.django_db
+def test_app_view_watch_change(client):
+    reference = "test"
+    url = reverse("sentry:apps-watch", kwargs={"pk": reference})
+    etag = client.get(url).headers["ETag"]
+
+    # an other app changing must not wake the request
+    delayed(store_app_configs, [App(reference="other")], delay=0.05)
+    thread = delayed(store_app_configs, [App(reference=reference, active_sample_rate=0.9)], delay=0.2)
+    start = monotonic()
+    response = client.get(url, {"timeout": 10}, HTTP_IF_NONE_MATCH=etag)
+    thread.join()
+
+    assert response.status_code == 200
+    assert response.data["active_sample_rate"] == 0.9
+    assert response.headers["ETag"] != etag
+    assert monotonic() - start < 10
+
+
+@pytest.mark.django_db
+def test_app_view_watch_panic(client):
+    reference = "test"
+    url = reverse("sentry:apps-watch", kwargs={"pk": reference})
+    etag = client.get(url).headers["ETag"]
+
+    def panic():
+        cache.set(settings.PANIC_KEY, True)
+        notify_panic()
+
+    thread = delayed(panic)
+    response = client.get(url, {"timeout": 10}, HTTP_IF_NONE_MATCH=etag)
+    thread.join()
+
+    assert response.status_code == 200
+    assert response.data["active_sample_rate"] == 0
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("timeout", [-1, settings.APP_WATCH_MAX_TIMEOUT + 1, "abc"])
+def test_app_view_watch_invalid(client, timeout):
+    response = client.get(reverse("sentry:apps-watch", kwargs={"pk": "test"}), {"timeout": timeout})
+    assert response.status_code == 400
@@ -0,0 +1,96 @@
+"""Throttling.
+
+When :data:`settings.AUTO_THROTTLE <controller.settings.AUTO_THROTTLE>` is enabled,
+the spike detection drives the sample rate of the apps:
+
+* on a FIRING event, the apps of the project without an active window get their `active_sample_rate` set to
+  `default_sample_rate * AUTO_THROTTLE_FACTOR` for `AUTO_THROTTLE_DURATION_SEC` seconds at most,
+  and are marked as `auto_throttled`.
+* on a DISCARD event, the apps of the project marked as `auto_throttled` are restored right away
+  instead of waiting for :func:`close_window <controller.sentry.tasks.close_window>`.
+
+Apps bumped by a human, up or down, keep their window: a bump clears the mark.
+Each update is a single query, then the configs are refreshed at once.
+"""
+from datetime import timedelta
+from typing import TYPE_CHECKING, Iterable
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from controller.sentry.choices import EventType
+from controller.sentry.configs import store_app_configs
+from controller.sentry.models import App
+
+if TYPE_CHECKING:  # pragma: no cover
+    from django.db.models import QuerySet
+
+    from controller.sentry.models import Event
+
+
+def update_apps(apps: "QuerySet[App]", **fields: dict) -> list[str]:
+    """Update apps with a single query, then refresh their stored config.
+
+    Args:
+        apps (QuerySet[App]): The apps
+        **fields (dict): The updated fields
+
+    Returns:
+        list[str]: The references of the updated apps
+    """
+    references = list(apps.values_list("reference", flat=True))
+    if references:
+        # the conditions of the apps are checked again, an app changed meanwhile is left as is
+        apps.filter(reference__in=references).update(**fields)
+        store_app_configs(App.objects.filter(reference__in=references))
+    return references
+
+
+def throttle_projects(sentry_ids: Iterable[str]) -> list[str]:
+    """Throttle the apps of projects, apps with an active window are left as is.
+
+    Args:
+        sentry_ids (Iterable[str]): The sentry ids of the projects
+
+    Returns:
+        list[str]: The references of the throttled apps
+    """
+    return update_apps(
+        App.objects.filter(project_id__in=sentry_ids, active_window_end__isnull=True),
+        active_sample_rate=F("default_sample_rate") * settings.AUTO_THROTTLE_FACTOR,
+        active_window_end=timezone.now() + timedelta(seconds=settings.AUTO_THROTTLE_DURATION_SEC),
+        auto_throttled=True,
+    )
+
+
+def restore_projects(sentry_ids: Iterable[str]) -> list[str]:
+    """Restore the throttled apps of projects, apps bumped by a human are left as is.
+
+    Args:
+        sentry_ids (Iterable[str]): The sentry ids of the projects
+
+    Returns:
+        list[str]: The references of the restored apps
+    """
+    return update_apps(
+        App.objects.filter(project_id__in=sentry_ids, auto_throttled=True),
+        active_sample_rate=F("default_sample_rate"),
+        active_window_end=None,
+        auto_throttled=False,
+    )
+
+
+def apply_events(events: "Iterable[Event]") -> None:
+    """Throttle or restore the apps of projects, following the last of their new events.
+
+    Nothing is done unless :data:`settings.AUTO_THROTTLE <controller.settings.AUTO_THROTTLE>` is enabled.
+
+    Args:
+        events (Iterable[Event]): The new events, in chronological order for each project
+    """
+    if not settings.AUTO_THROTTLE:
+        return
+    last_types = {event.project_id: event.type for event in events}
+    throttle_projects([sentry_id for sentry_id, _type in last_types.items() if _type == EventType.FIRING])
+    restore_projects([sentry_id for sentry_id, _type in last_types.items() if _type == EventType.DISCARD])
@@ -1,16 +1,24 @@
 """All the Views."""
+from time import monotonic
 from typing import TYPE_CHECKING
 
-from django.conf import settings
-from django.core.cache import cache
-from django.utils import timezone
-from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
-from rest_framework import decorators, mixins, viewsets
+from django.utils.cache import quote_etag
+from django.utils.http import parse_etags
+from rest_framework import decorators, mixins, status, viewsets
 from rest_framework.response import Response
 
+from controller.sentry.configs import get_app_config, get_app_configs, store_app_configs
+from controller.sentry.heartbeats import record_heartbeats
+from controller.sentry.metrics import enqueue_metrics
 from controller.sentry.models import App
-from controller.sentry.serializers import AppSerializer, MetricSerializer
+from controller.sentry.notifications import ConfigListener
+from controller.sentry.panic import get_app_panic
+from controller.sentry.serializers import (
+    AppSerializer,
+    BulkAppSerializer,
+    MetricSerializer,
+    WatchSerializer,
+)
 
 if TYPE_CHECKING:  # pragma: no cover
     from django.http import HttpRequest
@@ -23,27 +31,100 @@ class AppViewSet(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
     serializer_class = AppSerializer
     queryset = App.objects.all()
 
-    @method_decorator(cache_page(settings.APP_CACHE_TIMEOUT))
-    def retrieve(self, request: "HttpRequest", *args: list, **kwargs: dict) -> Response:
+    def retrieve(self, request: "HttpRequest", *args: list, pk: str = None, **kwargs: dict) -> Response:
         """Retrieve a model.
 
+        The stored config is served as is, the app is only loaded (or created) when it is missing.
+        A created app is linked to its project right away.
+        The response carries an ETag, a request with a matching `If-None-Match` gets a 304 without body.
+
         Args:
             request (HttpRequest): The http request
             *args  (list): List of argument
+            pk  (str): primary key of app
             **kwargs (dict): keyword arguments.
 
         Returns:
             Response: The response
         """
-        app, _ = App.objects.get_or_create(**kwargs)
-        panic = cache.get(settings.PANIC_KEY)
-        now = timezone.now()
-        app.last_seen = now
-        app.save()
+        document = get_app_config(pk)
+        if document is None:
+            app, created = App.objects.get_or_create(reference=pk)
+            if created:
+                App.link_projects([app])
+            document = store_app_configs([app])[app.reference]
+        record_heartbeats(pk)
+
+        panic = get_app_panic(pk)
+        etag = quote_etag(f"{document['etag']}-panic" if panic else document["etag"])
+        if_none_match = parse_etags(request.headers.get("If-None-Match", ""))
+        if etag in if_none_match or "*" in if_none_match:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+        config = document["config"]
         if panic:
-            app.active_sample_rate = 0.0
-        serializer = self.get_serializer(app)
-        return Response(serializer.data)
+            config = {**config, "active_sample_rate": 0.0}
+        return Response(config, headers={"ETag": etag})
+
+    @decorators.action(detail=True, methods=["get"])
+    def watch(self, request: "HttpRequest", pk: str = None) -> Response:  # pylint: disable=C0103
+        """Long poll a model.
+
+        Behave like :meth:`retrieve`, but when the config matches `If-None-Match` the request is held
+        until the config changes or the `timeout` query param (in seconds) expires.
+
+        Args:
+            request (HttpRequest): The http request
+            pk  (str): primary key of app
+
+        Returns:
+            Response: The response, 304 if the config did not change in time
+        """
+        serializer = WatchSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        deadline = monotonic() + serializer.validated_data["timeout"]
+
+        with ConfigListener().wait_for(pk) as changed:
+            response = self.retrieve(request, pk=pk)
+            while response.status_code == status.HTTP_304_NOT_MODIFIED and (remaining := deadline - monotonic()) > 0:
+                if changed.wait(remaining):
+                    changed.clear()
+                    response = self.retrieve(request, pk=pk)
+        return response
+
+    @decorators.action(detail=False, methods=["post"])
+    def bulk(self, request: "HttpRequest") -> Response:
+        """Retrieve many apps in one request.
+
+        Stored configs are fetched at once, missing apps are loaded or created with one query each.
+        Created apps are linked to their project right away.
+
+        Args:
+            request (HttpRequest): The http request
+
+        Returns:
+            Response: The configs by app reference
+        """
+        serializer = BulkAppSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        references = list(dict.fromkeys(serializer.validated_data["references"]))
+
+        documents = get_app_configs(references)
+        if missing := [reference for reference in references if reference not in documents]:
+            apps = list(App.objects.filter(reference__in=missing))
+            found = {app.reference for app in apps}
+            new_apps = [App(reference=reference) for reference in missing if reference not in found]
+            App.objects.bulk_create(new_apps, ignore_conflicts=True)
+            App.link_projects(new_apps)
+            documents.update(store_app_configs(apps + new_apps))
+        record_heartbeats(*references)
+
+        configs = {reference: documents[reference]["config"] for reference in references}
+        configs = {
+            reference: {**config, "active_sample_rate": 0.0} if get_app_panic(reference) else config
+            for reference, config in configs.items()
+        }
+        return Response(configs)
 
     @decorators.action(detail=True, methods=["post"], url_path=r"metrics/(?P<metric_name>[^/.]+)")
     def metrics(
@@ -51,19 +132,19 @@ class AppViewSet(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
     ) -> Response:
         """Add metrics.
 
+        Metrics are queued and folded into the app later, the database is not touched.
+
         Args:
             request (HttpRequest): The http request
             pk  (str): primary key of app
             metric_name (str): metric name
 
         Returns:
-            Response: The response
+            Response: The response, 202 once the metrics are queued
         """
-        app, _ = App.objects.get_or_create(reference=pk)
-
         serializer = MetricSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
 
-        app.merge(serializer.validated_data)
-        app.save()
-        return Response({})
+        enqueue_metrics(pk, serializer.validated_data["type"], serializer.validated_data["data"])
+        record_heartbeats(pk)
+        return Response({}, status=status.HTTP_202_ACCEPTED)
@@ -1,20 +1,68 @@
 """Sentry Web-Services."""
-from datetime import datetime, timedelta, timezone
-from time import sleep
-from typing import Generator, Optional
+import asyncio
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+from time import time
+from typing import Any, Callable, Generator, Iterable, Optional, Sequence, Union
 from urllib.parse import urljoin
 
 from celery.utils.log import get_task_logger
 from django.conf import settings
-from requests.api import request
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
 from requests.auth import AuthBase
 from requests.models import Request, Response
-
+from requests.sessions import Session
+from urllib3.util.retry import Retry
+
+from controller.sentry.exceptions import (
+    SentryPartialStatsException,
+    SentryRateLimitException,
+)
+from controller.sentry.ratelimit import acquire_call, learn_rate_limit
 from controller.sentry.utils import Singleton
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
 LOGGER = get_task_logger(__name__)
 
 
+def response_cache_key(url: str, params: Optional[dict] = None, fields: Optional[Sequence[str]] = None) -> str:
+    """Return the cache key of a Sentry API response.
+
+    Args:
+        url (str): The url
+        params (Optional[dict]): HTTP query params
+        fields (Optional[Sequence[str]]): The selected fields
+
+    Returns:
+        str: The cache key
+    """
+    payload = json.dumps([url, params, fields], sort_keys=True, default=str)
+    return f"sentry:{hashlib.md5(payload.encode(), usedforsecurity=False).hexdigest()}"
+
+
+def decode_json(content: bytes, fields: Optional[Sequence[str]] = None) -> Any:
+    """Decode a JSON body, with orjson when it is installed.
+
+    Args:
+        content (bytes): The body
+        fields (Optional[Sequence[str]]): The body is a list of objects, only keep these fields of each object
+
+    Returns:
+        Any: The decoded body
+    """
+    data = orjson.loads(content) if orjson is not None else json.loads(content)
+    if fields is not None:
+        data = [{field: item[field] for field in fields if field in item} for item in data]
+    return data
+
+
 class BearerAuth(AuthBase):
     """BearerAuth Class.
 
@@ -46,6 +94,9 @@ class BearerAuth(AuthBase):
 class PaginatedSentryClient(metaclass=Singleton):
     """PaginatedSentryClient.
 
+    Requests go through a pooled keep-alive session, so connections to Sentry are reused.
+    Each process gets its own session, since connections can't be shared with a forked process.
+
     Attributes:
         host (str): Sentry host
         auth (BearerAuth): Bearer auth
@@ -53,36 +104,133 @@ class PaginatedSentryClient(metaclass=Singleton):
 
     def __init__(self) -> None:
         """Init PaginatedSentryClient."""
-        self.host = "https://sentry.io/api/0/"
+        self.host = settings.SENTRY_API_URL
         self.auth = BearerAuth(settings.SENTRY_API_TOKEN)
+        self._session: Optional[Session] = None
+        self._pid: Optional[int] = None
+
+    @property
+    def session(self) -> Session:
+        """The session of the current process.
+
+        Returns:
+            Session: The session
+        """
+        if self._session is None or self._pid != os.getpid():
+            self._session = self.create_session()
+            self._pid = os.getpid()
+        return self._session
+
+    def create_session(self) -> Session:
+        """Create a session keeping up to `settings.SENTRY_API_POOL_SIZE` connections per host.
 
-    def __call(self, method: str, url: str, params: dict = None) -> Response:
+        Connection errors and server errors are retried `settings.SENTRY_API_RETRIES` times.
+
+        Returns:
+            Session: The session
+        """
+        retry = Retry(
+            total=settings.SENTRY_API_RETRIES,
+            backoff_factor=0.5,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=("GET",),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_maxsize=settings.SENTRY_API_POOL_SIZE, max_retries=retry)
+        session = Session()
+        session.auth = self.auth
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def get_connection_stats(self) -> dict[str, int]:
+        """Get the number of requests sent and connections opened by the session of the current process.
+
+        Returns:
+            dict[str, int]: The `requests` and `connections` counts
+        """
+        stats = {"requests": 0, "connections": 0}
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                stats["requests"] += pools[key].num_requests
+                stats["connections"] += pools[key].num_connections
+        return stats
+
+    def __call(self, method: str, url: str, params: dict = None, headers: dict = None) -> Response:
         """Internal method to make a HTTP call.
 
-        This method is responsible to retry when we hit a 429 Too Many Request
+        The call is taken from the rate limit budget shared by all the workers,
+        which learns from the rate limit headers of the response.
 
         Args:
             method (str): The HTTP method
             url (str): The url
             params (dict): HTTP query params
+            headers (dict): HTTP headers
 
         Returns:
             Response: Http response
+
+        Raises:
+            SentryRateLimitException: When the call must wait for the rate limit, instead of sleeping
         """
-        while True:
-            response = request(method, url, timeout=20, auth=self.auth, params=params)
-
-            # Checks if the response is rate limited
-            if response.status_code == 429:
-                window_end_timestamp = int(response.headers.get("x-sentry-rate-limit-reset"))
-                window_end = datetime.fromtimestamp(window_end_timestamp, tz=timezone.utc)
-                wait_period: timedelta = window_end - datetime.now(timezone.utc)
-                retry = max(wait_period.total_seconds(), 1)
-                LOGGER.error("Got HTTP 429 on %s waiting %s", url, retry, extra=dict(response.headers))
-                sleep(retry)
-            else:
-                response.raise_for_status()
-                return response
+        acquire_call()
+        response = self.session.request(method, url, timeout=20, params=params, headers=headers)
+        try:
+            learn_rate_limit(response.status_code, response.headers)
+        except SentryRateLimitException as err:
+            LOGGER.error("Got HTTP 429 on %s retry after %s", url, err.retry_after, extra=dict(response.headers))
+            raise
+        response.raise_for_status()
+        return response
+
+    def __get(
+        self, url: str, params: dict = None, ttl: Optional[int] = None, fields: Optional[Sequence[str]] = None
+    ) -> tuple[Any, Optional[str]]:
+        """Internal method to GET a resource through the response cache.
+
+        A cached response is served without any call for `ttl` seconds.
+        After that it is revalidated with its ETag or Last-Modified date when Sentry sent one,
+        a 304 Not Modified keeps the cached response for another `ttl` seconds.
+
+        Args:
+            url (str): The url
+            params (dict): HTTP query params
+            ttl (Optional[int]): Seconds a response is fresh, None to bypass the cache
+            fields (Optional[Sequence[str]]): Only keep these fields of each object, see :func:`decode_json`
+
+        Returns:
+            tuple[Any, Optional[str]]: The decoded body and the next url
+        """
+        if ttl is None:
+            response = self.__call("GET", url, params=params)
+            return decode_json(response.content, fields), self.__get_next(response)
+
+        key = response_cache_key(url, params, fields)
+        cached = cache.get(key)
+        if cached is not None and cached["fresh_until"] > time():
+            return cached["data"], cached["next"]
+
+        headers = {}
+        if cached is not None and cached["etag"] is not None:
+            headers["If-None-Match"] = cached["etag"]
+        if cached is not None and cached["last_modified"] is not None:
+            headers["If-Modified-Since"] = cached["last_modified"]
+        response = self.__call("GET", url, params=params, headers=headers)
+
+        if response.status_code == 304:
+            document = {**cached, "fresh_until": time() + ttl}
+        else:
+            document = {
+                "data": decode_json(response.content, fields),
+                "next": self.__get_next(response),
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "fresh_until": time() + ttl,
+            }
+        cache.set(key, document, timeout=settings.SENTRY_API_CACHE_TIMEOUT)
+        return document["data"], document["next"]
 
     def __get_next(self, response: Response) -> Optional[str]:
         """Internal method to get the next url from a response.
@@ -98,50 +246,182 @@ class PaginatedSentryClient(metaclass=Singleton):
             return None
         return _next["url"]
 
-    def __paginated(self, url: str) -> Generator[list[dict], None, None]:
+    def __paginated(
+        self, url: str, ttl: Optional[int] = None, fields: Optional[Sequence[str]] = None
+    ) -> Generator[list[dict], None, None]:
         """Internal method to iterate over a paginated response.
 
         Args:
             url (str): The starting url
+            ttl (Optional[int]): Seconds each page is cached, None to bypass the cache
+            fields (Optional[Sequence[str]]): Only keep these fields of each object
 
         Yields:
             list[dict]: The result of one request
         """
-        while True:
-            response = self.__call("GET", url)
-            yield response.json()
+        while url is not None:
+            data, url = self.__get(url, ttl=ttl, fields=fields)
+            yield data
 
-            url = self.__get_next(response)
+    def list_projects(self, fields: Optional[Sequence[str]] = None) -> Generator[list[dict], None, None]:
+        """Method to iterate over all the projects.
 
-            if url is None:
-                break
+        Pages are cached for `settings.SENTRY_PROJECTS_CACHE_TTL` seconds.
+        Selecting fields keeps the pages small, in memory and in the cache.
 
-    def list_projects(self) -> Generator[list[dict], None, None]:
-        """Method to iterate over all the projects.
+        Args:
+            fields (Optional[Sequence[str]]): Only keep these fields of each project, all by default
 
         Return:
             Generator[list[dict], None, None]: The result as a generator
         """
         url = urljoin(self.host, "projects/")
-        return self.__paginated(url)
+        return self.__paginated(url, ttl=settings.SENTRY_PROJECTS_CACHE_TTL, fields=fields)
 
-    def get_stats(self, sentry_id: str) -> dict:
-        """Method to get the stats of a project.
+    def __stats_params(self, start: Optional[datetime] = None) -> dict:
+        """Internal method building the query params of `stats_v2`.
 
         Args:
-            sentry_id (str): The id of the project
+            start (Optional[datetime]): Get the stats from this date to now,
+                instead of the last `settings.SENTRY_STATS_PERIOD`
 
         Returns:
-            dict: The stats
+            dict: HTTP query params
         """
-        url = urljoin(self.host, f"organizations/{settings.SENTRY_ORGANIZATION_SLUG}/stats_v2/")
         params = {
             "field": "sum(quantity)",
             "groupBy": ["category", "outcome"],
             "interval": "1h",
-            "project": sentry_id,
             "statsPeriod": settings.SENTRY_STATS_PERIOD,
             "category": "transaction",
         }
-        response = self.__call("GET", url, params=params)
-        return response.json()
+        if start is not None:
+            del params["statsPeriod"]
+            params["start"] = start.isoformat()
+            params["end"] = datetime.now(timezone.utc).isoformat()
+        return params
+
+    @staticmethod
+    def __stats_ttl(start: Optional[datetime] = None) -> Optional[int]:
+        """Internal method getting how long stats are cached.
+
+        Stats up to now are never cached, their url changes on each call.
+
+        Args:
+            start (Optional[datetime]): The start, see :meth:`get_stats`
+
+        Returns:
+            Optional[int]: Seconds the stats are fresh, None to bypass the cache
+        """
+        return settings.SENTRY_STATS_CACHE_TTL if start is None else None
+
+    def get_stats(self, sentry_id: str, start: Optional[datetime] = None) -> dict:
+        """Method to get the stats of a project.
+
+        The stats of the last `settings.SENTRY_STATS_PERIOD` are cached for `settings.SENTRY_STATS_CACHE_TTL` seconds.
+
+        Args:
+            sentry_id (str): The id of the project
+            start (Optional[datetime]): Get the stats from this date to now,
+                instead of the last `settings.SENTRY_STATS_PERIOD`
+
+        Returns:
+            dict: The stats
+        """
+        url = urljoin(self.host, f"organizations/{settings.SENTRY_ORGANIZATION_SLUG}/stats_v2/")
+        params = {**self.__stats_params(start), "project": sentry_id}
+        data, _ = self.__get(url, params=params, ttl=self.__stats_ttl(start))
+        return data
+
+    def get_stats_by_project(self, sentry_ids: Iterable[str], start: Optional[datetime] = None) -> dict[str, dict]:
+        """Method to get the stats of many projects with org-wide requests grouped by project.
+
+        Projects are queried by chunks of `settings.SENTRY_STATS_CHUNK_SIZE`, chunks are fetched concurrently.
+        At most `settings.SENTRY_API_CONCURRENCY` requests are in flight at once,
+        they share the connections of the session.
+
+        Args:
+            sentry_ids (Iterable[str]): The ids of the projects
+            start (Optional[datetime]): Get the stats from this date to now,
+                instead of the last `settings.SENTRY_STATS_PERIOD`
+
+        Returns:
+            dict[str, dict]: The stats of each project by sentry id, in the shape returned by :meth:`get_stats`
+
+        Raises:
+            SentryPartialStatsException: When some chunks were rate limited, with the stats of the other chunks
+        """
+        sentry_ids = list(sentry_ids)
+        size = settings.SENTRY_STATS_CHUNK_SIZE
+        chunks = [sentry_ids[i : i + size] for i in range(0, len(sentry_ids), size)]
+        responses = asyncio.run(self.__gather(self.__get_stats_chunk, ((chunk, start) for chunk in chunks)))
+
+        stats, rate_limit = {}, None
+        for chunk, response in zip(chunks, responses):
+            if isinstance(response, SentryRateLimitException):
+                rate_limit = response
+            elif isinstance(response, BaseException):
+                raise response
+            else:
+                stats.update(self.split_stats(chunk, response))
+        if rate_limit is not None:
+            raise SentryPartialStatsException(rate_limit.retry_after, stats)
+        return stats
+
+    def __get_stats_chunk(self, sentry_ids: list[str], start: Optional[datetime] = None) -> dict:
+        """Internal method getting the stats of a chunk of projects, grouped by project.
+
+        Args:
+            sentry_ids (list[str]): The ids of the projects
+            start (Optional[datetime]): The start, see :meth:`get_stats`
+
+        Returns:
+            dict: The org-wide stats
+        """
+        url = urljoin(self.host, f"organizations/{settings.SENTRY_ORGANIZATION_SLUG}/stats_v2/")
+        params = self.__stats_params(start)
+        params.update({"groupBy": ["project", *params["groupBy"]], "project": sentry_ids})
+        data, _ = self.__get(url, params=params, ttl=self.__stats_ttl(start))
+        return data
+
+    @staticmethod
+    def split_stats(sentry_ids: list[str], stats: dict) -> dict[str, dict]:
+        """Split org-wide stats grouped by project into the stats of each project.
+
+        Args:
+            sentry_ids (list[str]): The ids of the requested projects
+            stats (dict): The org-wide stats
+
+        Returns:
+            dict[str, dict]: The stats of each project by sentry id, projects without outcome have no group
+        """
+        split = {
+            sentry_id: {**{key: value for key, value in stats.items() if key != "groups"}, "groups": []}
+            for sentry_id in sentry_ids
+        }
+        for group in stats["groups"]:
+            group_by = dict(group["by"])
+            sentry_id = str(group_by.pop("project"))
+            if sentry_id in split:
+                split[sentry_id]["groups"].append({**group, "by": group_by})
+        return split
+
+    async def __gather(self, func: Callable[..., dict], queries: Iterable[tuple]) -> list[Union[dict, BaseException]]:
+        """Internal method calling a blocking method concurrently.
+
+        A failed call doesn't cancel the others, its exception is returned in place of its result.
+
+        Args:
+            func (Callable[..., dict]): The method
+            queries (Iterable[tuple]): The arguments of each call
+
+        Returns:
+            list[Union[dict, BaseException]]: The result or the exception of each call
+        """
+        semaphore = asyncio.Semaphore(settings.SENTRY_API_CONCURRENCY)
+
+        async def call(*args) -> dict:
+            async with semaphore:
+                return await asyncio.to_thread(func, *args)
+
+        return await asyncio.gather(*(call(*args) for args in queries), return_exceptions=True)
@@ -142,7 +142,7 @@ TEMPLATES = [
                 "django.template.context_processors.request",
                 "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
-                "controller.sentry.utils.is_panic_activated",
+                "controller.sentry.panic.is_panic_activated",
             ],
         },
     },
@@ -226,10 +226,10 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 CONN_MAX_AGE = None
 
 # CACHE
-APP_CACHE_TIMEOUT = 0
+# Lifetime of the stored app configs, they are also refreshed every time an app changes
+APP_CACHE_TIMEOUT = int(os.getenv("APP_CACHE_TIMEOUT", "600"))
 
 if not TESTING:
-    APP_CACHE_TIMEOUT = int(os.getenv("APP_CACHE_TIMEOUT", "600"))
     CACHES = {
         "default": {
             "BACKEND": "django.core.cache.backends.redis.RedisCache",
@@ -244,6 +244,8 @@ if not TESTING:
 
 
 # App config
+APP_BULK_MAX_REFERENCES = int(os.getenv("APP_BULK_MAX_REFERENCES", "500"))
+
 DEFAULT_SAMPLE_RATE = float(os.getenv("DEFAULT_SAMPLE_RATE", "0.1"))
 
 DEFAULT_WSGI_IGNORE_PATHS = os.getenv("DEFAULT_WSGI_IGNORE_PATHS", "/health,/healthz,/health/,/healthz/").split(",")
@@ -253,18 +255,36 @@ DEFAULT_WSGI_IGNORE_USER_AGENT = os.getenv("DEFAULT_WSGI_IGNORE_USER_AGENT", "ku
 
 DEFAULT_CELERY_IGNORE_TASKS = []
 
-CACHE_META_INVALIDATION = {
-    "SERVER_NAME": os.getenv("CACHE_META_SERVER_NAME", "localhost"),
-    "SERVER_PORT": int(os.getenv("CACHE_META_SERVER_PORT", "8000")),
-    "HTTP_ACCEPT": os.getenv("CACHE_META_HTTP_ACCEPT", "*/*"),
-}
-
 MAX_BUMP_TIME_SEC = int(os.getenv("MAX_BUMP_TIME_SEC", "0"))
 if MAX_BUMP_TIME_SEC == 0:
     MAX_BUMP_TIME_SEC = 30 * 60  # 30 minutes
 
 # CACHE KEY for panic
 PANIC_KEY = "PANIC"
+# Redis hash of the panic scopes
+PANIC_SCOPES_KEY = "PANIC_SCOPES"
+# Maximum delay before a panic change is seen by every process, in seconds
+PANIC_CACHE_TTL = float(os.getenv("PANIC_CACHE_TTL", "1"))
+
+# Redis channel notifying app config changes
+APP_CONFIG_CHANNEL = "APP_CONFIGS"
+APP_WATCH_MAX_TIMEOUT = int(os.getenv("APP_WATCH_MAX_TIMEOUT", "30"))
+
+# Redis hash buffering the apps last_seen
+HEARTBEAT_KEY = "HEARTBEATS"
+
+# Redis list queuing the pushed metrics
+METRIC_QUEUE_KEY = "METRICS"
+METRIC_FOLD_BATCH_SIZE = int(os.getenv("METRIC_FOLD_BATCH_SIZE", "1000"))
+# Redis key locking the fold, so a single fold reads the queue at a time
+METRIC_FOLD_LOCK_KEY = "METRICS_FOLD_LOCK"
+METRIC_FOLD_LOCK_TIMEOUT = int(os.getenv("METRIC_FOLD_LOCK_TIMEOUT", "300"))
+# A fold stops taking batches after this duration, well below the lock timeout, the next fold carries on
+METRIC_FOLD_MAX_DURATION_SEC = int(os.getenv("METRIC_FOLD_MAX_DURATION_SEC", "60"))
+
+# Hourly metric buckets older than this are rolled up into the all time metrics of the app
+METRIC_BUCKET_MAX_AGE_DAY = int(os.getenv("METRIC_BUCKET_MAX_AGE_DAY", "7"))
+METRIC_TOP_SIZE = int(os.getenv("METRIC_TOP_SIZE", "10"))
 
 DEVELOPER_GROUP = os.getenv("DEVELOPER_GROUP", "Developer")
 DEVELOPER_ACTIONS = ["bump_sample_rate_app", "enable_disable_metrics_app"]
@@ -275,6 +295,16 @@ APP_AUTO_PRUNE_MAX_AGE_DAY = int(os.getenv("APP_AUTO_PRUNE_MAX_AGE_DAY", "30"))
 EVENT_AUTO_PRUNE = os.getenv("EVENT_AUTO_PRUNE", "true").lower() == "true"
 EVENT_AUTO_PRUNE_MAX_AGE_DAY = int(os.getenv("EVENT_AUTO_PRUNE_MAX_AGE_DAY", "30"))
 
+# Multiply the sample rate of the apps of a project by a factor while a spike is detected,
+# the window is closed when the spike ends or after the duration at most
+AUTO_THROTTLE = os.getenv("AUTO_THROTTLE", "false").lower() == "true"
+AUTO_THROTTLE_FACTOR = float(os.getenv("AUTO_THROTTLE_FACTOR", "0.1"))
+AUTO_THROTTLE_DURATION_SEC = int(os.getenv("AUTO_THROTTLE_DURATION_SEC", str(6 * 60 * 60)))
+
+# Rows deleted per transaction by the prune tasks, and seconds to wait between two batches
+DELETION_BATCH_SIZE = int(os.getenv("DELETION_BATCH_SIZE", "1000"))
+DELETION_BATCH_PAUSE = float(os.getenv("DELETION_BATCH_PAUSE", "0.1"))
+
 
 # Celery
 BROKER_USER = quote(os.environ.get("CELERY_BROKER_USER", "rabbitmq"))
@@ -298,6 +328,18 @@ CELERY_BEAT_SCHEDULE = {
         "task": "controller.sentry.tasks.pull_sentry_project_slug",
         "schedule": crontab(),  # every minutes
     },
+    "flush-heartbeats": {
+        "task": "controller.sentry.tasks.flush_heartbeats",
+        "schedule": crontab(),  # every minutes
+    },
+    "fold-metrics": {
+        "task": "controller.sentry.tasks.fold_metrics",
+        "schedule": crontab(),  # every minutes
+    },
+    "rollup-old-metric-bucket": {
+        "task": "controller.sentry.tasks.rollup_old_metric_bucket",
+        "schedule": crontab(minute="30", hour="*"),  # every hour at minute 30
+    },
     "populate-app": {
         "task": "controller.sentry.tasks.populate_app",
         "schedule": crontab(),  # every minutes
@@ -321,8 +363,21 @@ if EVENT_AUTO_PRUNE:
     }
 
 
+SENTRY_API_URL = os.getenv("SENTRY_API_URL", "https://sentry.io/api/0/")
 SENTRY_API_TOKEN = os.getenv("SENTRY_API_TOKEN", "TEST")
+SENTRY_API_POOL_SIZE = int(os.getenv("SENTRY_API_POOL_SIZE", "10"))
+SENTRY_API_RETRIES = int(os.getenv("SENTRY_API_RETRIES", "3"))
+SENTRY_API_CONCURRENCY = int(os.getenv("SENTRY_API_CONCURRENCY", "5"))
+# Calls to the Sentry API shared by all the workers, per window of seconds
+SENTRY_RATE_LIMIT_KEY = "SENTRY_RATE_LIMIT"
+SENTRY_API_RATE_LIMIT = int(os.getenv("SENTRY_API_RATE_LIMIT", "20"))
+SENTRY_API_RATE_LIMIT_WINDOW = int(os.getenv("SENTRY_API_RATE_LIMIT_WINDOW", "1"))
+# Seconds Sentry API responses are served from the cache, they are kept longer for revalidation
+SENTRY_PROJECTS_CACHE_TTL = int(os.getenv("SENTRY_PROJECTS_CACHE_TTL", "300"))
+SENTRY_STATS_CACHE_TTL = int(os.getenv("SENTRY_STATS_CACHE_TTL", "300"))
+SENTRY_API_CACHE_TIMEOUT = int(os.getenv("SENTRY_API_CACHE_TIMEOUT", str(24 * 60 * 60)))
 SENTRY_ORGANIZATION_SLUG = os.getenv("SENTRY_ORGANIZATION_SLUG")
+SENTRY_STATS_CHUNK_SIZE = int(os.getenv("SENTRY_STATS_CHUNK_SIZE", "100"))
 SENTRY_STATS_PERIOD = os.getenv("SENTRY_STATS_PERIOD", "30d")
 
 DEFAULT_SPIKE_DETECTION_PARAM = {
@@ -331,6 +386,8 @@ DEFAULT_SPIKE_DETECTION_PARAM = {
     "influence": float(os.getenv("SPIKE_DETECTION_INFLUENCE", "0.01")),
     "floor": int(os.getenv("SPIKE_DETECTION_FLOOR", "50")),
 }
+# Number of projects of each spike detection task
+SPIKE_DETECTION_BATCH_SIZE = int(os.getenv("SPIKE_DETECTION_BATCH_SIZE", "500"))
 
 
 SENTRY_DSN = os.getenv("SENTRY_DSN")